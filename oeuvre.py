@@ -11,19 +11,78 @@ Author:  Ian Fisher (iafisher@protonmail.com)
 Version: July 2020
 """
 import argparse
-import glob
-import json
+import functools
+import heapq
+import itertools
+import math
 import os
 import re
-import readline  # noqa: F401
-import subprocess
 import sys
-import textwrap
-from collections import defaultdict
-from typing import Callable, Dict, IO, Iterable, List, Optional, Set, Tuple, Union
+import time
+from collections import Counter, defaultdict
+from contextlib import (
+    ExitStack,
+    contextmanager,
+    nullcontext,
+    redirect_stderr,
+    redirect_stdout,
+)
+from io import StringIO
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    FrozenSet,
+    Generator,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+# oeuvre is often run from shell prompts and completion scripts, so modules that only
+# some commands need are imported where they are used rather than here.
+if TYPE_CHECKING:
+    import mmap
+    import socket
+    import sqlite3
 
 
 OEUVRE_DIRECTORY = "/home/iafisher/files/oeuvre"
+CACHE_FILENAME = ".oeuvre-cache"
+SOCKET_FILENAME = ".oeuvre.sock"
+# How long, in seconds, `oeuvre serve` waits for a client to send its request or to
+# accept its reply, and a client waits for the server to reply, before giving up. A
+# client that gives up runs the command itself.
+SERVER_TIMEOUT = 10.0
+CLIENT_TIMEOUT = 60.0
+SQLITE_FILENAME = ".oeuvre.sqlite3"
+PACK_FILENAME = ".oeuvre.pack"
+# The directory under which an entry has a lock file while an oeuvre process is writing
+# to it. Lock files are removed when they are released, so the directory only holds the
+# locks of running processes (and subdirectories left over from entries in
+# subdirectories). It can be deleted when no oeuvre process is running. See
+# `Application.lock_entries`.
+LOCK_DIRECTORY = ".oeuvre-locks"
+IGNORE_FILENAME = ".oeuvreignore"
+# The number of files below which entries are parsed serially rather than in parallel.
+PARALLEL_THRESHOLD = 2000
+# The number of results that `search --rank` prints if no limit is given.
+RANK_LIMIT = 20
+
+# A map from each location to the set of all locations that enclose it, directly or
+# indirectly. See `compile_locations`.
+LocationDatabase = Dict[str, FrozenSet[str]]
+# An index that can narrow down the entries a query needs to look at. See
+# `QueryNode.candidates`.
+CandidateIndex = Union["SearchIndex", "SqliteMirror"]
 
 
 class Entry:
@@ -34,6 +93,24 @@ class Entry:
     with list values. Most fields can be omitted.
     """
 
+    # There can be a great many entries in memory at once, so they don't have a
+    # `__dict__`.
+    __slots__ = (
+        "title",
+        "type",
+        "filename",
+        "creator",
+        "year",
+        "language",
+        "plot_summary",
+        "characters",
+        "locations",
+        "keywords",
+        "settings",
+        "quotes",
+        "notes",
+    )
+
     def __init__(
         self,
         *,
@@ -52,11 +129,13 @@ class Entry:
         notes: Optional[str] = None,
     ) -> None:
         self.title = title
-        self.type = type
+        # Types and languages, like keywords (see `KeywordField`), are repeated across
+        # many entries, so only one copy of each is kept.
+        self.type = sys.intern(type)
         self.filename = filename
         self.creator = creator
         self.year = year
-        self.language = language
+        self.language = sys.intern(language) if language is not None else None
         self.plot_summary = plot_summary
         self.characters = characters or []
         self.locations = locations or []
@@ -65,6 +144,16 @@ class Entry:
         self.quotes = quotes
         self.notes = notes
 
+    def __setstate__(self, state: Tuple[None, Dict[str, Any]]) -> None:
+        # Entries parsed by worker processes (see `Application.parse_files`) are
+        # unpickled without calling `__init__`, so their strings are interned here.
+        for name, value in state[1].items():
+            setattr(self, name, value)
+
+        self.type = sys.intern(self.type)
+        if self.language is not None:
+            self.language = sys.intern(self.language)
+
     def format_for_display(self, *, verbosity: int) -> str:
         """
         Returns a string representation of the entry for display to the user.
@@ -96,6 +185,112 @@ class Entry:
         builder.longform_field("quotes", self.quotes)
         return builder.build()
 
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Returns a JSON-serializable representation of the entry.
+        """
+        return {
+            "title": self.title,
+            "type": self.type,
+            "filename": self.filename,
+            "creator": self.creator,
+            "year": self.year,
+            "language": self.language,
+            "plot_summary": self.plot_summary,
+            "characters": [k.to_json() for k in self.characters],
+            "locations": [k.to_json() for k in self.locations],
+            "keywords": [k.to_json() for k in self.keywords],
+            "settings": [k.to_json() for k in self.settings],
+            "quotes": self.quotes,
+            "notes": self.notes,
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Entry":
+        """
+        Inverse of `Entry.to_json`.
+        """
+        fields = dict(data)
+        for field in ("characters", "locations", "keywords", "settings"):
+            fields[field] = [KeywordField.from_json(k) for k in fields[field]]
+        return cls(**fields)
+
+    def to_tuple(self) -> Tuple[Any, ...]:
+        """
+        Returns a representation of the entry, without its filename, made only of
+        tuples, strings and integers, which `marshal` can serialize.
+        """
+        return (
+            self.title,
+            self.type,
+            self.creator,
+            self.year,
+            self.language,
+            self.plot_summary,
+            tuple((k.keyword, k.description) for k in self.characters),
+            tuple((k.keyword, k.description) for k in self.locations),
+            tuple((k.keyword, k.description) for k in self.keywords),
+            tuple((k.keyword, k.description) for k in self.settings),
+            self.quotes,
+            self.notes,
+        )
+
+    @classmethod
+    def from_tuple(
+        cls,
+        data: Tuple[Any, ...],
+        *,
+        filename: str,
+        keyword_fields: Dict[Tuple[str, Optional[str]], "KeywordField"],
+    ) -> "Entry":
+        """
+        Inverse of `Entry.to_tuple`.
+
+        `keyword_fields` maps (keyword, description) pairs to `KeywordField` objects,
+        which are shared between the entries built with the same map, since the same
+        keywords and locations occur in many entries and `KeywordField`s are never
+        modified.
+        """
+
+        def make_fields(pairs: Tuple[Tuple[str, Optional[str]], ...]) -> List[Any]:
+            values = []
+            for pair in pairs:
+                value = keyword_fields.get(pair)
+                if value is None:
+                    value = keyword_fields[pair] = KeywordField(*pair)
+                values.append(value)
+            return values
+
+        (
+            title,
+            type,
+            creator,
+            year,
+            language,
+            plot_summary,
+            characters,
+            locations,
+            keywords,
+            settings,
+            quotes,
+            notes,
+        ) = data
+        return cls(
+            title=title,
+            type=type,
+            filename=filename,
+            creator=creator,
+            year=year,
+            language=language,
+            plot_summary=plot_summary,
+            characters=make_fields(characters),
+            locations=make_fields(locations),
+            keywords=make_fields(keywords),
+            settings=make_fields(settings),
+            quotes=quotes,
+            notes=notes,
+        )
+
     def __repr__(self):
         return (
             f"Entry(title={self.title!r}, type={self.type!r}, creator={self.creator!r}"
@@ -121,17 +316,59 @@ class Application:
           directory: The path to the directory where the database entries are located.
         """
         self.directory = directory
-        try:
-            with open(os.path.join(self.directory, "locations.json"), "r") as f:
-                self.locdb = json.load(f)
-        except FileNotFoundError:
-            self.locdb = {}
-
         self.stdout = stdout
         self.stderr = stderr
         self.stdin = stdin
         self.editor = editor
         self.use_colors = True
+        self.use_cache = True
+        self.use_sqlite = False
+        # Whether to read the database through a packed snapshot even if there isn't
+        # one yet, which is then created. See `main_pack`.
+        self.use_pack = False
+        # The SQLite mirror of the database used when `use_sqlite` is true, once opened.
+        self.mirror: Optional[SqliteMirror] = None
+        # The number of processes to parse entries with, or None to use all CPUs.
+        self.jobs: Optional[int] = None
+        self.stats = Stats()
+        # The in-memory copy of the database kept by `oeuvre serve`, if any.
+        self.resident: Optional[ResidentDatabase] = None
+        # The cache that the last call to `iter_entries` read the whole database
+        # through, if any. See `filter_entries`.
+        self.entries_cache: Optional[Union[EntryCache, PackedSnapshot]] = None
+        # The filenames of the entries that this application holds locks on.
+        self.locked: Set[str] = set()
+        self._locdb: Optional[LocationDatabase] = None
+
+    @property
+    def locdb(self) -> LocationDatabase:
+        """
+        The location database, which is loaded the first time that it is needed.
+        """
+        if self._locdb is None:
+            self._locdb = self.load_locations()
+        return self._locdb
+
+    @locdb.setter
+    def locdb(self, locdb: LocationDatabase) -> None:
+        self._locdb = locdb
+
+    def load_locations(self) -> LocationDatabase:
+        """
+        Loads the location database from `locations.json`.
+        """
+        import json
+
+        locations_path = os.path.join(self.directory, "locations.json")
+        try:
+            with open(locations_path, "r") as f:
+                return compile_locations(json.load(f))
+        except FileNotFoundError:
+            return {}
+        except OeuvreError as e:
+            e.path = locations_path
+            self.error(str(e))
+            raise
 
     def main(self, args: List[str]) -> None:
         """
@@ -139,6 +376,11 @@ class Application:
         """
         parser = argparse.ArgumentParser()
         parser.add_argument("--no-color", action="store_true")
+        parser.add_argument("--no-cache", action="store_true")
+        parser.add_argument("--sqlite", action="store_true")
+        parser.add_argument("--jobs", type=int)
+        parser.add_argument("--stats", action="store_true")
+        parser.add_argument("--profile", metavar="FILE")
         subparsers = parser.add_subparsers()
 
         parser_edit = subparsers.add_parser("edit")
@@ -154,41 +396,81 @@ class Application:
         parser_new.add_argument("path")
         parser_new.set_defaults(func=self.main_new)
 
+        parser_pack = subparsers.add_parser("pack")
+        parser_pack.set_defaults(func=self.main_pack)
+
         parser_reformat = subparsers.add_parser("reformat")
         parser_reformat.set_defaults(func=self.main_reformat)
 
         parser_search = subparsers.add_parser("search")
         parser_search.add_argument("terms", nargs="*")
         parser_search.add_argument("--detailed", action="store_true")
+        parser_search.add_argument("--limit", type=int)
+        parser_search.add_argument("--unsorted", action="store_true")
+        parser_search.add_argument("--fuzzy", action="store_true")
+        parser_search.add_argument("--rank", action="store_true")
         parser_search.add_argument("--strict-location", action="store_true")
         parser_search.set_defaults(func=self.main_search)
 
+        parser_stats = subparsers.add_parser("stats")
+        parser_stats.add_argument("field", choices=STATS_FIELDS)
+        parser_stats.add_argument("--keyword")
+        parser_stats.add_argument("--sorted", action="store_true")
+        parser_stats.set_defaults(func=self.main_stats)
+
         parser_show = subparsers.add_parser("show")
         parser_show.add_argument("--brief", action="store_true")
         parser_show.add_argument("terms", nargs="*")
         parser_show.set_defaults(func=self.main_show)
 
+        parser_serve = subparsers.add_parser("serve")
+        parser_serve.set_defaults(func=self.main_serve)
+
         parsed_args = parser.parse_args(args)
 
-        if (
-            parsed_args.no_color
-            or not os.isatty(self.stdout.fileno())
-            or not os.isatty(self.stderr.fileno())
-        ):
+        if parsed_args.no_color or not self.stdout.isatty() or not self.stderr.isatty():
             self.use_colors = False
 
-        if hasattr(parsed_args, "func"):
-            parsed_args.func(parsed_args)
-        else:
+        if parsed_args.no_cache:
+            self.use_cache = False
+
+        if parsed_args.sqlite:
+            self.use_sqlite = True
+
+        if parsed_args.jobs is not None:
+            self.jobs = parsed_args.jobs
+
+        if not hasattr(parsed_args, "func"):
             self.error("no subcommand")
 
+        self.stats = Stats(enabled=parsed_args.stats)
+        profiler = None
+        if parsed_args.profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+
+        try:
+            with self.stats.phase("total"):
+                if profiler is not None:
+                    profiler.runcall(parsed_args.func, parsed_args)
+                else:
+                    parsed_args.func(parsed_args)
+        finally:
+            if profiler is not None:
+                profiler.dump_stats(parsed_args.profile)
+
+            if parsed_args.stats:
+                print(self.stats.report(), file=self.stderr)
+
     def main_edit(self, args: argparse.Namespace) -> None:
         """
         Opens the entry for editing and formats it before saving.
         """
         locdb = {} if args.strict_location else self.locdb
-        entries = self.read_entries()
-        matching = [e for e, _ in self.filter_entries(entries, args.terms, locdb=locdb)]
+        query = self.compile_query(args.terms)
+        entries = self.read_entries(fields=query.fields_used() | {"keywords"})
+        matching = [e for e, _ in self.filter_entries(entries, query, locdb=locdb)]
         if not matching:
             self.error("no matching entries")
 
@@ -199,10 +481,12 @@ class Application:
         Lists all keywords from the database.
         """
         counter: defaultdict = defaultdict(int)
-        entries = self.read_entries()
-        for entry in entries:
-            for keyword in entry.keywords:
-                counter[keyword.keyword] += 1
+        if self.use_sqlite and self.resident is None:
+            counter.update(self.open_mirror().count_keywords())
+        else:
+            for entry in self.iter_entries(fields={"keywords"}):
+                for keyword in entry.keywords:
+                    counter[keyword.keyword] += 1
 
         # Sort by count and then by name if --sorted flag was present. Otherwise, just
         # by name.
@@ -218,23 +502,39 @@ class Application:
             self.error("entry name must end in .txt")
 
         fullpath = os.path.join(self.directory, args.path)
-        if os.path.exists(fullpath):
-            self.error(f"{fullpath} already exists.")
+        # Hold the lock from before checking that the file doesn't exist until it is
+        # saved or removed, so that another process can't create the same entry.
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(self.lock_entries([args.path]))
+            except OeuvreError as e:
+                self.error(str(e))
+                raise
+
+            if os.path.exists(fullpath):
+                self.error(f"{fullpath} already exists.")
+
+            # Collect the keywords before so that we don't read the blank entry we are
+            # about to create.
+            entries = self.read_entries(best_effort=True, fields={"keywords"})
+            keywords = collect_keywords(entries)
 
-        # Collect the keywords before so that we don't read the blank entry we are about
-        # to create.
-        entries = self.read_entries(best_effort=True)
-        keywords = collect_keywords(entries)
+            blank_entry = Entry(title="", type="", filename=args.path)
+            text = blank_entry.format_for_disk()
+            write_file_atomically(fullpath, text + "\n", sync=True)
 
-        blank_entry = Entry(title="", type="", filename=args.path)
-        text = blank_entry.format_for_disk()
-        with open(fullpath, "w", encoding="utf-8") as f:
-            f.write(text)
-            f.write("\n")
+            save_count = self.edit_entries([blank_entry], keywords)
+            if save_count == 0:
+                os.remove(fullpath)
 
-        save_count = self.edit_entries([blank_entry], keywords)
-        if save_count == 0:
-            os.remove(fullpath)
+    def main_pack(self, args: argparse.Namespace) -> None:
+        """
+        Packs the database into a single file, which is read in place of the entry
+        files from then on (see `PackedSnapshot`).
+        """
+        self.use_pack = True
+        entries = self.read_entries()
+        self.print(f"Packed {len(entries)} entries into {PACK_FILENAME}.")
 
     def main_reformat(self, args: argparse.Namespace) -> None:
         """
@@ -248,327 +548,4002 @@ class Application:
                 continue
 
             path = os.path.join(self.directory, entry.filename)
-            text = entry.format_for_disk()
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(text)
-                f.write("\n")
+            try:
+                with self.lock_entries([entry.filename]):
+                    # The file may have changed since it was read, so it is parsed
+                    # again while it is locked.
+                    text = read_text_file(path)
+                    formatted = parse_entry(text).format_for_disk() + "\n"
+                    if formatted != text:
+                        write_file_atomically(path, formatted, sync=True)
+            except OeuvreError as e:
+                e.path = entry.filename
+                self.warning(f"skipped: {e}")
 
     def main_search(self, args: argparse.Namespace) -> None:
         """
         Searches all database entries and prints the matching ones.
         """
+        if args.rank and args.unsorted:
+            self.error("--rank cannot be used with --unsorted")
+
         locdb = {} if args.strict_location else self.locdb
-        matching = self.filter_entries(self.read_entries(), args.terms, locdb=locdb)
-        for entry, matches in sorted(matching, key=alphabetical_key):
-            self.print(self.format_title_for_display(entry, color=True))
-            if args.detailed:
-                for match in matches:
-                    self.print("  " + match)
+        query = self.compile_query(args.terms, fuzzy=args.fuzzy)
+        matching: Iterable[Tuple[Entry, List[str]]]
+        if args.unsorted:
+            # Print each match as soon as it is found.
+            matching = self.iter_matching(
+                self.iter_candidates(query, fields=query.fields_used()),
+                query,
+                locdb=locdb,
+            )
+            if args.limit is not None:
+                matching = itertools.islice(matching, args.limit)
+        else:
+            if self.use_sqlite and self.resident is None:
+                matching = list(
+                    self.iter_matching(self.iter_candidates(query), query, locdb=locdb)
+                )
+            else:
+                # Only the titles of the matching entries are printed, so the fields
+                # that the query doesn't look at can be skipped.
+                entries = self.read_entries(fields=query.fields_used())
+                matching = self.filter_entries(entries, query, locdb=locdb)
+
+            if args.rank:
+                with self.stats.phase("rank"):
+                    limit = args.limit if args.limit is not None else RANK_LIMIT
+                    ranker = Ranker(query, locdb=locdb)
+                    matching = ranker.top(list(matching), limit)
+            else:
+                key: Callable[[Tuple[Entry, List[str]]], Any] = alphabetical_key
+                if query.is_fuzzy():
+                    # List the closest matches first.
+                    key = lambda pair: (-query.score(pair[0]), alphabetical_key(pair))
+
+                with self.stats.phase("sort"):
+                    if args.limit is not None:
+                        matching = heapq.nsmallest(args.limit, matching, key=key)
+                    else:
+                        matching = sorted(matching, key=key)
+
+        for entry, matches in matching:
+            with self.stats.phase("format"):
+                self.print(
+                    self.format_title_for_display(entry, color=True),
+                    flush=args.unsorted,
+                )
+                if args.detailed:
+                    for match in matches:
+                        self.print("  " + match, flush=args.unsorted)
+
+    def main_serve(self, args: argparse.Namespace) -> None:
+        """
+        Keeps the database in memory and serves commands over a Unix socket.
+
+        When a server is running, `search`, `show` and `keywords` are forwarded to it
+        (see `forward_to_server`), so that they don't have to read the database.
+        """
+        import socket
+
+        self.resident = ResidentDatabase(self, watch=True)
+        self.resident.refresh()
+
+        socket_path = os.path.join(self.directory, SOCKET_FILENAME)
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # The socket is created with only the owner's permissions, so that other
+            # users can't connect to it even briefly.
+            umask = os.umask(0o077)
+            try:
+                server.bind(socket_path)
+            finally:
+                os.umask(umask)
+            server.listen()
+            print(f"serving {self.directory} on {socket_path}", file=self.stderr)
+            while True:
+                connection, _ = server.accept()
+                with connection:
+                    connection.settimeout(SERVER_TIMEOUT)
+                    self.handle_connection(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.resident.close()
+            try:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                pass
+
+    def handle_connection(self, connection: "socket.socket") -> None:
+        """
+        Runs the command sent by a client of `oeuvre serve` and sends back its output.
+
+        A client that goes away, or sends a malformed request, is not allowed to bring
+        down the server.
+        """
+        import json
+
+        try:
+            with connection.makefile("rb") as f:
+                line = f.readline()
+        except OSError:
+            # The client went away or timed out before sending its request.
+            return
+
+        try:
+            request = json.loads(line)
+            response = self.handle_request(request)
+        except ValueError as e:
+            response = {"stdout": "", "stderr": f"error: {e}\n", "status": 1}
+        except (KeyError, TypeError) as e:
+            response = {
+                "stdout": "",
+                "stderr": f"error: malformed request ({e!r})\n",
+                "status": 1,
+            }
+
+        try:
+            connection.sendall(json.dumps(response).encode("utf-8"))
+        except OSError:
+            # The client went away before reading its reply, e.g. because the user
+            # interrupted it.
+            pass
+
+    def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Runs the command in the request with its output captured.
+
+        The command is run by a new application which shares only the resident
+        database and the location database with this one, so that the flags of one
+        request (e.g., `--no-cache` or `--jobs`) don't carry over to the next.
+        """
+        stdout = ForwardedStream(isatty=request["stdout_isatty"])
+        stderr = ForwardedStream(isatty=request["stderr_isatty"])
+        app = Application(
+            self.directory,
+            stdout=stdout,
+            stderr=stderr,
+            stdin=self.stdin,
+            editor=self.editor,
+        )
+        app.resident = self.resident
+        status: Any = 0
+        try:
+            # argparse writes usage and errors to sys.stdout and sys.stderr.
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                # The resident database is brought up to date before the location
+                # database is shared, since refreshing it may reload locations.json and
+                # the command must match against the same locations as the index.
+                assert self.resident is not None
+                self.resident.refresh()
+                app.locdb = self.locdb
+                app.main(request["args"])
+        except SystemExit as e:
+            status = e.code
+        except Exception:
+            # A bug should not bring down the server.
+            import traceback
+
+            traceback.print_exc(file=stderr)
+            status = 1
+
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            stderr.write(f"{status}\n")
+            status = 1
+
+        return {
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+            "status": status,
+        }
 
     def main_show(self, args: argparse.Namespace) -> None:
         """
         Prints the full entry that matches the search terms.
         """
-        matching = self.filter_entries(
-            self.read_entries(), args.terms, locdb=self.locdb
+        query = self.compile_query(args.terms)
+        matching = self.iter_matching(
+            self.iter_candidates(query), query, locdb=self.locdb
         )
-        if len(matching) == 0:
+        first = next(matching, None)
+        second = next(matching, None)
+        if first is None:
             self.print("No matching entries.")
-        elif len(matching) > 1:
+        elif second is not None:
             self.print("Multiple matching entries:")
-            for entry, _ in sorted(matching, key=alphabetical_key):
+            rest = itertools.chain([first, second], matching)
+            for entry, _ in sorted(rest, key=alphabetical_key):
                 self.print("  " + str(entry))
         else:
             verbosity = VERBOSITY_BRIEF if args.brief else VERBOSITY_FULL
-            self.print(matching[0][0].format_for_display(verbosity=verbosity))
+            with self.stats.phase("format"):
+                self.print(first[0].format_for_display(verbosity=verbosity))
+
+    def main_stats(self, args: argparse.Namespace) -> None:
+        """
+        Prints the number of entries for each value of a field, optionally only counting
+        the entries with a given keyword.
+        """
+        with self.stats.phase("columns"):
+            # None of the longform fields are needed.
+            columns = EntryColumns(self.iter_entries(fields=set()))
+
+        rows = columns.rows_with_keyword(args.keyword) if args.keyword else None
+        with self.stats.phase("aggregate"):
+            counter = columns.count(args.field, rows=rows)
+
+        # Sort by count and then by value if --sorted flag was present. Otherwise, just
+        # by value.
+        key = lambda kv: (-kv[1], kv[0]) if args.sorted else kv[0]
+        for value, count in sorted(counter.items(), key=key):
+            label = f"{value}s" if args.field == "decade" else value
+            self.print(f"{label} ({count})")
 
     def edit_entries(self, entries: List[Entry], keywords: Set[str]) -> int:
         """
         Opens the given entries up for editing.
 
-        Returns the number of entries which were successfully saved.
+        Only the files that were changed in the editor are parsed and written back, so
+        that files which were merely opened keep their modification times (and their
+        places in the entry cache).
+
+        The entries are locked (see `lock_entries`) while they are being edited, and
+        this method exits with an error if another process already holds one of the
+        locks.
+
+        Returns the number of entries which were changed and successfully saved.
+        """
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(
+                    self.lock_entries(entry.filename for entry in entries)  # type: ignore
+                )
+            except OeuvreError as e:
+                self.error(str(e))
+                raise
+
+            return self._edit_entries(entries, keywords)
+
+    def _edit_entries(self, entries: List[Entry], keywords: Set[str]) -> int:
         """
+        Core internal method for `edit_entries`, called with the entries locked.
+        """
+        # The original contents of each file, to write back if the user gives up.
+        originals = {}
+        for entry in entries:
+            path = os.path.join(self.directory, entry.filename)  # type: ignore
+            originals[path] = read_text_file(path)
+
+        # Each element is an (entry, path, text, result) tuple, where `text` is the
+        # contents of the file before it is opened in the editor and `result` is what
+        # parsing `text` produced, or None if the file has not been changed since the
+        # entry was read.
+        pending: List[Tuple[Entry, str, str, Optional[Union[Entry, OeuvreError]]]] = [
+            (entry, path, originals[path], None)
+            for entry, path in zip(entries, originals)
+        ]
         save_count = 0
-        while entries:
-            paths = [
-                os.path.join(self.directory, e.filename)  # type: ignore
-                for e in entries
-            ]
+        suggester: Optional[KeywordSuggester] = None
+        while pending:
             try:
-                self.editor(paths)
+                self.editor([path for _, path, _, _ in pending])
             except OeuvreError as e:
                 self.error(str(e))
 
-            remaining_entries = []
-            for old_entry in entries:
-                path = os.path.join(self.directory, old_entry.filename)  # type: ignore
-                with open(path, "r", encoding="utf8") as f:
-                    text = f.read()
+            remaining: List[
+                Tuple[Entry, str, str, Optional[Union[Entry, OeuvreError]]]
+            ] = []
+            for old_entry, path, old_text, result in pending:
+                text = read_text_file(path)
+                if text != old_text:
+                    try:
+                        result = parse_entry(text)
+                    except OeuvreError as e:
+                        e.path = old_entry.filename
+                        result = e
+                elif result is None:
+                    # The file was opened but not changed, so there is nothing to save.
+                    continue
+
+                if isinstance(result, OeuvreError):
+                    self.error(str(result), fatal=False)
+                    if self.confirm("Try again? "):
+                        remaining.append((old_entry, path, text, result))
+                    else:
+                        # Write back the original entry if the user gives up.
+                        write_file_atomically(path, originals[path], sync=True)
+                    continue
+
+                new_entry = result
+                all_keywords = set(k.keyword for k in new_entry.keywords)
+                new_keywords = all_keywords - keywords
+                if new_keywords:
+                    self.print(
+                        f"new keywords for {old_entry.filename}: "
+                        + f"{', '.join(sorted(new_keywords))}"
+                    )
+
+                    if suggester is None:
+                        suggester = KeywordSuggester(keywords)
+
+                    for keyword in sorted(new_keywords):
+                        suggestions = suggester.suggest(keyword)
+                        if suggestions:
+                            self.print(
+                                f"  {keyword}: did you mean {', '.join(suggestions)}?"
+                            )
+
+                    if not self.confirm("Keep? "):
+                        remaining.append((old_entry, path, text, result))
+                        continue
+
+                # Call `format_for_disk` before opening the file for writing, so that if
+                # there's an error the file is not wiped out.
+                formatted = new_entry.format_for_disk() + "\n"
+                if formatted != text:
+                    write_file_atomically(path, formatted, sync=True)
+
+                save_count += 1
+
+                # Only print the entry if only one was opened for editing.
+                if len(pending) == 1:
+                    self.print(new_entry.format_for_display(verbosity=VERBOSITY_FULL))
+
+            pending = remaining
+
+        return save_count
+
+    @contextmanager
+    def lock_entries(
+        self, filenames: Iterable[str], *, blocking: bool = False
+    ) -> Iterator[None]:
+        """
+        Holds advisory locks on the entries with the given filenames, so that other
+        oeuvre processes don't write to them at the same time.
+
+        Each entry has its own lock file under `LOCK_DIRECTORY`, so processes only
+        contend with each other if they write the same entries, and the lock file is
+        removed when the lock is released (see `lock_file`). Locks that this
+        application already holds are not taken again.
+
+        Raises OeuvreError if `blocking` is false and one of the entries is locked by
+        another process.
+        """
+        with ExitStack() as stack:
+            # The locks are taken in sorted order so that blocking callers can't
+            # deadlock.
+            for filename in sorted(set(filenames) - self.locked):
+                lock_path = os.path.join(
+                    self.directory, LOCK_DIRECTORY, filename + ".lock"
+                )
+                try:
+                    stack.enter_context(lock_file(lock_path, blocking=blocking))
+                except OeuvreError as e:
+                    e.path = filename
+                    raise
+
+                self.locked.add(filename)
+                stack.callback(self.locked.discard, filename)
+
+            yield
+
+    def compile_query(self, search_terms: List[str], *, fuzzy: bool = False) -> "Query":
+        """
+        Compiles the search terms into a query, exiting with an error message if they
+        are invalid.
+        """
+        try:
+            with self.stats.phase("compile"):
+                query = compile_query(search_terms, fuzzy=fuzzy)
+        except ValueError as e:
+            self.error(str(e))
+            raise
+
+        self.stats.count(
+            "regexes compiled", sum(isinstance(t, SearchTerm) for t in query.terms())
+        )
+        return query
+
+    def filter_entries(
+        self,
+        entries: List[Entry],
+        query: "Query",
+        *,
+        locdb: LocationDatabase,
+    ) -> List[Tuple[Entry, List[str]]]:
+        """
+        Filters the list of entries by the given query.
+
+        Each element of the returned list is a pair (entry, matches).
+        """
+        if self.resident is not None:
+            # The resident index is keyed by filename, and is up to date because
+            # `entries` was just read from the resident database.
+            with self.stats.phase("index"):
+                candidates = self.resident.index.lookup(query)
+            if candidates is not None:
+                entries = [e for e in entries if e.filename in candidates]
+        elif self.entries_cache is not None and query.is_fuzzy():
+            # Comparing each fuzzy term to every word of every entry is what makes
+            # fuzzy searches slow, so the similar words are looked up in the vocabulary
+            # of the cache instead, which has the words of all the entries that were
+            # just read through it.
+            with self.stats.phase("vocabulary"):
+                vocabulary = self.entries_cache.vocabulary()
+                for term in query.terms():
+                    if isinstance(term, FuzzyTerm):
+                        vocabulary.find_similar_words(term)
+
+        # Otherwise, building a `SearchIndex` would cost more than the single scan that
+        # it saves, so the entries are matched one by one. The price is that a one-shot
+        # search can't rule out entries without matching them; in particular, `text:`
+        # phrases tokenize the longform fields of every entry, which the positional
+        # index used to avoid. Searches that need to be fast on a large database should
+        # go through `oeuvre serve` or `--sqlite`.
+        return list(self.iter_matching(entries, query, locdb=locdb))
+
+    def iter_matching(
+        self,
+        entries: Iterable[Entry],
+        query: "Query",
+        *,
+        locdb: LocationDatabase,
+    ) -> Iterator[Tuple[Entry, List[str]]]:
+        """
+        Lazy version of `filter_entries`, which does not use an index and so never needs
+        to look at more entries than the caller consumes.
+        """
+        for entry in entries:
+            with self.stats.phase("match"):
+                matches = query.match(entry, locdb=locdb)
+
+            if matches is not None:
+                self.stats.count("matches found")
+                yield (entry, matches)
+
+    def iter_candidates(
+        self, query: "Query", *, fields: Optional[Set[str]] = None
+    ) -> Iterator[Entry]:
+        """
+        Yields the entries that might match the query, in sorted order of their paths.
+
+        With `--sqlite`, the SQLite mirror's indexes narrow down the entries. Otherwise,
+        every entry is yielded. See `iter_entries` for the meaning of `fields`.
+        """
+        if self.use_sqlite and self.resident is None:
+            mirror = self.open_mirror()
+            with self.stats.phase("index"):
+                candidates = mirror.lookup(query)
+
+            yield from mirror.read_entries(candidates)
+        else:
+            yield from self.iter_entries(fields=fields)
+
+    def open_mirror(self, *, best_effort: bool = False) -> "SqliteMirror":
+        """
+        Opens the SQLite mirror of the database, and brings it up to date with the
+        files on disk.
+
+        Files that could not be parsed are reported as errors, or as warnings if
+        `best_effort` is true.
+        """
+        import sqlite3
+
+        try:
+            if self.mirror is None:
+                with self.stats.phase("sqlite"):
+                    self.mirror = SqliteMirror.open(
+                        os.path.join(self.directory, SQLITE_FILENAME)
+                    )
+
+            with self.stats.phase("sync"):
+                self.mirror.sync(self)
+        except sqlite3.OperationalError as e:
+            # E.g., the mirror is locked by another process for longer than
+            # `SqliteMirror.TIMEOUT`.
+            self.error(f"could not update the SQLite mirror: {e}")
+
+        assert self.mirror is not None
+        for message in self.mirror.errors():
+            if best_effort:
+                self.warning(message)
+            else:
+                self.error(message)
+
+        return self.mirror
+
+    def read_entries(
+        self, *, best_effort: bool = False, fields: Optional[Set[str]] = None
+    ) -> List[Entry]:
+        """
+        Returns a list of all entries in the database.
+        """
+        return list(self.iter_entries(best_effort=best_effort, fields=fields))
+
+    def iter_entries(
+        self, *, best_effort: bool = False, fields: Optional[Set[str]] = None
+    ) -> Iterator[Entry]:
+        """
+        Yields all entries in the database, in sorted order of their paths.
+
+        Parsed entries are cached on disk (see `EntryCache` and `PackedSnapshot`), so
+        only files which have been created or modified since the last call are actually
+        parsed.
+
+        If `fields` is not None, the caller only needs those fields, and the longform
+        fields not among them may be left empty (see `parse_entry`).
+        """
+        self.entries_cache = None
+        if self.resident is not None:
+            yield from self.iter_resident_entries(best_effort=best_effort)
+            return
+
+        if self.use_sqlite:
+            yield from self.open_mirror(best_effort=best_effort).read_entries()
+            return
+
+        with self.stats.phase("cache"):
+            cache = self.load_cache()
+
+        # Each slot is a (path, signature, cached) triple, where `cached` is whether the
+        # cache has an up-to-date entry for the file.
+        slots: List[Tuple[str, Tuple[int, int], bool]] = []
+        with self.stats.phase("list"):
+            for dir_entry in self.list_entry_files():
+                path = dir_entry.path
+                if cache is not None:
+                    # Take the signature before reading the file so that a concurrent
+                    # modification invalidates the cached entry rather than being
+                    # masked by it.
+                    signature = stat_signature(dir_entry)
+                    filename = path[len(self.directory) + 1 :]
+                    cached = cache.contains(filename, signature, fields=fields)
+                    slots.append((path, signature, cached))
+                else:
+                    slots.append((path, (0, 0), False))
+
+        self.stats.count("files scanned", len(slots))
+        self.stats.count("cache hits", sum(cached for _, _, cached in slots))
+        parsed = self.parse_files(
+            [path for path, _, cached in slots if not cached], fields=fields
+        )
+
+        # Results are merged in sorted order, so errors are reported in the same order
+        # regardless of whether the files were parsed in parallel.
+        finished = False
+        try:
+            for path, signature, cached in slots:
+                filename = path[len(self.directory) + 1 :]
+                if cached:
+                    assert cache is not None
+                    # Entries in a packed snapshot are only decoded here, so that the
+                    # ones the caller doesn't get to are never decoded at all.
+                    with self.stats.phase("decode"):
+                        entry = cache.get(filename, signature, fields=fields)
+                else:
+                    entry, error = next(parsed)
+                    if error is not None:
+                        error.path = path
+                        if best_effort:
+                            self.warning(str(error))
+                        else:
+                            self.error(str(error))
+                        continue
+
+                    assert entry is not None
+                    entry.filename = filename
+                    if cache is not None:
+                        cache.put(filename, signature, entry, fields=fields)
+
+                assert entry is not None
+                yield entry
+
+            finished = True
+            self.entries_cache = cache
+        finally:
+            parsed.close()
+            if cache is not None:
+                with self.stats.phase("cache"):
+                    # Only evict deleted files if the whole database was read;
+                    # otherwise, just save the entries that were parsed before the
+                    # caller stopped.
+                    if finished:
+                        cache.retain(
+                            set(path[len(self.directory) + 1 :] for path, _, _ in slots)
+                        )
+                    cache.save()
+
+    def load_cache(self) -> Optional[Union["EntryCache", "PackedSnapshot"]]:
+        """
+        Loads the packed snapshot of the database if there is one, and the entry cache
+        otherwise.
+
+        Returns None if caching is turned off, unless `use_pack` is set.
+        """
+        pack_path = os.path.join(self.directory, PACK_FILENAME)
+        if self.use_pack:
+            return PackedSnapshot.load(pack_path)
+
+        if not self.use_cache:
+            return None
+
+        if os.path.exists(pack_path):
+            return PackedSnapshot.load(pack_path)
+        else:
+            return EntryCache.load(os.path.join(self.directory, CACHE_FILENAME))
+
+    def iter_resident_entries(self, *, best_effort: bool) -> Iterator[Entry]:
+        """
+        Version of `iter_entries` for the in-memory copy of the database, which
+        `handle_request` has already brought up to date.
+        """
+        assert self.resident is not None
+        self.stats.count("files scanned", len(self.resident.filenames))
+        for filename in self.resident.filenames:
+            entry, error = self.resident.records[filename][1:]
+            if error is not None:
+                if best_effort:
+                    self.warning(str(error))
+                else:
+                    self.error(str(error))
+                continue
+
+            assert entry is not None
+            yield entry
+
+    def list_entry_files(self) -> List["os.DirEntry[str]"]:
+        """
+        Returns the directory entries of all the entry files in the database, in sorted
+        order of their paths (see `scan_entry_files`).
+        """
+        return scan_entry_files(self.directory, IgnoreList.load(self.directory))
+
+    def list_entry_paths(self) -> List[str]:
+        """
+        Returns the paths of all the entry files in the database, in sorted order.
+        """
+        return [dir_entry.path for dir_entry in self.list_entry_files()]
+
+    def parse_files(
+        self, paths: List[str], *, fields: Optional[Set[str]] = None
+    ) -> Generator[Tuple[Optional[Entry], Optional["OeuvreError"]], None, None]:
+        """
+        Parses the files at the given paths, yielding (entry, error) pairs in the same
+        order as `paths`.
+
+        See `parse_entry` for the meaning of `fields`.
+
+        The files are parsed in a pool of worker processes if there are enough of them
+        to make up for the cost of starting the pool.
+        """
+        jobs = self.jobs if self.jobs is not None else (os.cpu_count() or 1)
+        if jobs <= 1 or len(paths) < PARALLEL_THRESHOLD:
+            for path in paths:
+                with self.stats.phase("read"):
+                    with open(path, "rb") as f:
+                        data = f.read()
+
+                with self.stats.phase("parse"):
+                    entry, error = try_parse_entry(data.decode("utf-8"), fields=fields)
+
+                self.stats.count("bytes read", len(data))
+                self.stats.count("entries parsed")
+                yield (entry, error)
+
+            return
+
+        # Send the files to the workers in chunks to amortize the cost of communication,
+        # but keep the chunks small enough that the work is spread evenly.
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunksize = max(1, len(paths) // (jobs * 4))
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            results = executor.map(
+                functools.partial(parse_file, fields=fields), paths, chunksize=chunksize
+            )
+            while True:
+                with self.stats.phase("read and parse (parallel)"):
+                    result = next(results, None)
+
+                if result is None:
+                    break
+
+                entry, error, nbytes = result
+                self.stats.count("bytes read", nbytes)
+                self.stats.count("entries parsed")
+                yield (entry, error)
+        finally:
+            # Don't parse the rest of the files if the caller stopped early.
+            executor.shutdown(cancel_futures=True)
+
+    def format_title_for_display(self, entry: Entry, *, color: bool) -> str:
+        """
+        Returns a string representation of the entry's title.
+        """
+        title = self.blue(entry.title) if color else entry.title
+        creator_suffix = f" ({entry.creator})" if entry.creator else ""
+        filename_suffix = f" [{entry.filename}]" if entry.filename else ""
+        return title + creator_suffix + filename_suffix
+
+    def print(self, *args, **kwargs) -> None:
+        kwargs.setdefault("file", self.stdout)
+        print(*args, **kwargs)
+
+    def error(self, message: str, *, fatal: bool = True) -> None:
+        print(f"error: {message}", file=self.stderr)
+        if fatal:
+            sys.exit(1)
+
+    def warning(self, message: str) -> None:
+        print(f"warning: {message}", file=self.stderr)
+
+    def confirm(self, prompt: str) -> bool:
+        """
+        Prompts the user for confirmation and returns whether they accepted or not.
+        """
+        import readline  # noqa: F401
+
+        while True:
+            print(prompt, end="", flush=True, file=self.stdout)
+            try:
+                yesno = self.stdin.readline()
+            except EOFError:
+                print(file=self.stdout)
+                return False
+            except KeyboardInterrupt:
+                print(file=self.stdout)
+                sys.exit(1)
+
+            yesno = yesno.strip().lower()
+            if yesno.startswith("y"):
+                return True
+            elif yesno.startswith("n"):
+                return False
+
+    def blue(self, text: str) -> str:
+        """Returns a string that will display as blue using ANSI color codes."""
+        return self.color(text, "94")
+
+    def color(self, text: str, color: str) -> str:
+        return f"\033[{color}m{text}\033[0m" if self.use_colors else text
+
+
+class Stats:
+    """
+    A class to record how long each phase of a command takes, along with counters of
+    interesting events, for the --stats flag.
+
+    Phases may be entered many times (e.g., 'parse' is entered once per file), in which
+    case their times are summed. Timing a phase costs about as much as matching an entry
+    against a simple query, so phases are only timed if `enabled` is true.
+    """
+
+    # The context manager returned by `phase` when timing is disabled.
+    NO_PHASE = nullcontext()
+
+    def __init__(self, *, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, int] = defaultdict(int)
+
+    def phase(self, name: str) -> ContextManager[None]:
+        return self.time_phase(name) if self.enabled else self.NO_PHASE
+
+    @contextmanager
+    def time_phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def report(self) -> str:
+        """
+        Returns a human-readable summary of the statistics.
+        """
+        lines = ["phases:"]
+        for name, seconds in self.timings.items():
+            lines.append(f"  {name}: {seconds * 1000:.1f} ms")
+        lines.append("counters:")
+        for name, n in self.counters.items():
+            lines.append(f"  {name}: {n}")
+        return "\n".join(lines)
+
+
+class EntryCache:
+    """
+    A persistent cache of parsed entries.
+
+    The cache is stored as a file in the database directory. Each entry is keyed by its
+    filename and stored along with the file's stat signature (see `stat_signature`), so
+    that a cached entry is only used if the file has not changed since it was parsed.
+
+    The entries are stored as plain tuples (see `Entry.to_tuple`) serialized with
+    `marshal`, which loads several times faster than JSON, and each entry is only built
+    from its tuple when it is asked for. Building the entries, rather than reading the
+    file, is most of the cost of a warm cache.
+
+    The cache file is always replaced atomically, so concurrent processes can read and
+    update it freely. If two processes save the cache at the same time, the last one
+    wins, which costs at most some redundant parsing on the next run.
+
+    Entries parsed without some of their longform fields (see `parse_entry`) are
+    cached along with the set of fields that were skipped, so that they are only used
+    by callers that don't need those fields.
+
+    The cache also keeps a `TrigramVocabulary` of the words of its entries, for fuzzy
+    searches, which is only decoded when it is needed. Words are never removed from it,
+    since a word that no longer occurs in any entry is harmless.
+    """
+
+    VERSION = 4
+
+    # Files modified this recently are not cached, because a second modification within
+    # the granularity of the filesystem's timestamps would go unnoticed.
+    RACY_NANOSECONDS = 2_000_000_000
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # Map from filenames to (signature, entry, skipped fields) triples. Entries that
+        # have not been built yet are given as tuples (see `Entry.to_tuple`).
+        self.records: Dict[
+            str, Tuple[Tuple[int, int], Union[Entry, Tuple[Any, ...]], FrozenSet[str]]
+        ] = {}
+        # See `Entry.from_tuple`.
+        self.keyword_fields: Dict[Tuple[str, Optional[str]], KeywordField] = {}
+        # The encoded vocabulary, until it is decoded by `vocabulary`.
+        self.vocabulary_data = b""
+        self._vocabulary: Optional[TrigramVocabulary] = None
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "EntryCache":
+        """
+        Loads the cache from disk.
+
+        A missing, corrupt, or out-of-date cache file is treated as an empty cache.
+        """
+        import marshal
+
+        cache = cls(path)
+        try:
+            # `marshal.load` reads a file in small pieces, which is much slower than
+            # reading it all at once.
+            with open(path, "rb") as f:
+                data = marshal.loads(f.read())
+
+            # The marshal format can change between versions of Python.
+            if data[0] != (cls.VERSION, marshal.version):
+                return cache
+
+            for filename, mtime, size, entry, skipped in data[1]:
+                cache.records[filename] = ((mtime, size), entry, frozenset(skipped))
+            cache.vocabulary_data = data[2]
+        except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError):
+            cache.records.clear()
+            cache.vocabulary_data = b""
+            cache.dirty = True
+
+        return cache
+
+    def vocabulary(self) -> "TrigramVocabulary":
+        """
+        Returns the vocabulary of the words in the `FUZZY_FIELDS` of the cached entries,
+        and of all the entries that have been put in the cache since it was loaded.
+        """
+        if self._vocabulary is None:
+            try:
+                self._vocabulary = TrigramVocabulary.loads(self.vocabulary_data)
+            except (EOFError, ValueError, TypeError):
+                self._vocabulary = TrigramVocabulary()
+                for filename, (signature, _, _) in list(self.records.items()):
+                    entry = self.get(filename, signature, fields=set(FUZZY_FIELDS))
+                    assert entry is not None
+                    self._vocabulary.add_entry(entry)
+                self.dirty = True
+
+        return self._vocabulary
+
+    def contains(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> bool:
+        """
+        Returns whether there is a cached entry for the file which is up to date and
+        has all of `fields`.
+        """
+        record = self.records.get(filename)
+        return (
+            record is not None
+            and record[0] == signature
+            and record[2] <= skipped_fields(fields)
+        )
+
+    def get(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> Optional[Entry]:
+        """
+        Returns the cached entry for the file, or None if the file has changed or the
+        cached entry is missing some of `fields`.
+        """
+        if not self.contains(filename, signature, fields=fields):
+            return None
+
+        signature, value, skipped = self.records[filename]
+        if isinstance(value, Entry):
+            return value
+
+        entry = Entry.from_tuple(
+            value, filename=filename, keyword_fields=self.keyword_fields
+        )
+        self.records[filename] = (signature, entry, skipped)
+        return entry
+
+    def put(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        entry: Entry,
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> None:
+        """
+        Caches the entry for the file, which was parsed with `fields` (see
+        `parse_entry`).
+        """
+        # The words are added even if the entry is not cached, since the entry is
+        # about to be searched all the same.
+        self.vocabulary().add_entry(entry)
+        if time.time_ns() - signature[0] < self.RACY_NANOSECONDS:
+            if self.records.pop(filename, None) is not None:
+                self.dirty = True
+            return
+
+        self.records[filename] = (signature, entry, skipped_fields(fields))
+        self.dirty = True
+
+    def retain(self, filenames: Set[str]) -> None:
+        """
+        Evicts the entries for all files not in `filenames`.
+        """
+        for filename in list(self.records):
+            if filename not in filenames:
+                del self.records[filename]
+                self.dirty = True
+
+    def save(self) -> None:
+        """
+        Writes the cache to disk, if it has changed since it was loaded.
+        """
+        if not self.dirty:
+            return
+
+        import marshal
+
+        records = tuple(
+            (
+                filename,
+                signature[0],
+                signature[1],
+                value.to_tuple() if isinstance(value, Entry) else value,
+                tuple(sorted(skipped)),
+            )
+            for filename, (signature, value, skipped) in self.records.items()
+        )
+        vocabulary_data = (
+            self._vocabulary.dumps()
+            if self._vocabulary is not None
+            else self.vocabulary_data
+        )
+        data = ((self.VERSION, marshal.version), records, vocabulary_data)
+        try:
+            write_file_atomically(self.path, marshal.dumps(data))
+        except OSError:
+            # The cache is purely an optimization, so failing to write it (e.g.,
+            # because the database directory is read-only) is not an error.
+            return
+
+        self.dirty = False
+
+
+class PackedSnapshot:
+    """
+    A snapshot of the whole database packed into a single binary file, which is created
+    by `oeuvre pack` and from then on is used in place of the `EntryCache`.
+
+    Opening a file for every entry is the dominant cost of reading a large database,
+    especially on a network file system. The snapshot is read through `mmap`, and each
+    entry is only decoded when it is asked for, so reading the database costs a `stat`
+    of each entry file plus the decoding of the entries that are actually used.
+
+    The entry files remain the source of truth. As in the entry cache, each entry is
+    stored along with the signature of its file and only used if the file has not
+    changed, and if any file was created, modified or deleted the whole snapshot is
+    rebuilt when it is saved.
+
+    The file consists of the following sections, with all integers little-endian:
+
+    - A header (see `HEADER`) with a magic number, the format version, the number of
+      entries and of strings, and the offset and length of the vocabulary.
+
+    - The offset table, with one row (see `ROW`) for each entry, in sorted order of
+      filename: the number of the string holding the filename, the file's signature,
+      the offset and length (in integers) of the entry's record, and a bitmask of the
+      longform fields (in the order of `TEXT_FIELDS`) that were skipped when it was
+      parsed.
+
+    - The string table: the offset of each string in the string data, plus the offset
+      of the end of the string data, as 64-bit integers, followed by the string data
+      itself in UTF-8. Each distinct string is stored once.
+
+    - The records of the entries, each a sequence of 32-bit string numbers: one for
+      each of `SCALARS` (`NONE` if the field is empty), then for each of `LIST_FIELDS`
+      the number of values followed by a keyword and a description for each value.
+
+    - The `TrigramVocabulary` of the words of the entries, as encoded by
+      `TrigramVocabulary.dumps`.
+    """
+
+    MAGIC = b"OEUVPACK"
+    VERSION = 2
+    HEADER = "<8sIIIQQ"
+    ROW = "<IqqQIB"
+    NONE = 0xFFFFFFFF
+    SCALARS = (
+        "title",
+        "type",
+        "creator",
+        "year",
+        "language",
+        "plot_summary",
+        "notes",
+        "quotes",
+    )
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.map: Optional["mmap.mmap"] = None
+        # The offsets of the strings in the string data, and of the string data in
+        # `map`.
+        self.string_offsets: Sequence[int] = []
+        self.data_offset = 0
+        # The strings that have been decoded so far, by number. Many strings, such as
+        # keywords, are shared between entries, so they are only decoded once.
+        self.strings: List[Optional[str]] = []
+        # Map from filenames to (signature, entry, skipped fields) triples. Entries that
+        # have not been decoded yet are given as the (offset, length) of their records.
+        self.records: Dict[
+            str, Tuple[Tuple[int, int], Union[Entry, Tuple[int, int]], FrozenSet[str]]
+        ] = {}
+        # The offset and length of the vocabulary in `map`, until it is decoded by
+        # `vocabulary`.
+        self.vocabulary_span = (0, 0)
+        self._vocabulary: Optional[TrigramVocabulary] = None
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str) -> "PackedSnapshot":
+        """
+        Opens the snapshot on disk and reads its offset table.
+
+        A missing, corrupt, or out-of-date snapshot is treated as an empty one, which is
+        rebuilt when it is saved.
+        """
+        import mmap
+        import struct
+        from array import array
+
+        snapshot = cls(path)
+        try:
+            with open(path, "rb") as f:
+                snapshot.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            (
+                magic,
+                version,
+                entry_count,
+                string_count,
+                vocabulary_offset,
+                vocabulary_length,
+            ) = struct.unpack_from(cls.HEADER, snapshot.map, 0)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError("not a packed snapshot")
+            if vocabulary_offset + vocabulary_length > len(snapshot.map):
+                raise ValueError("vocabulary out of bounds")
+
+            rows_offset = struct.calcsize(cls.HEADER)
+            strings_offset = rows_offset + entry_count * struct.calcsize(cls.ROW)
+            snapshot.data_offset = strings_offset + (string_count + 1) * 8
+
+            string_offsets = array("Q")
+            string_offsets.frombytes(
+                snapshot.map[strings_offset : snapshot.data_offset]
+            )
+            if sys.byteorder == "big":
+                string_offsets.byteswap()
+            if len(string_offsets) != string_count + 1:
+                raise ValueError("string table truncated")
+            if snapshot.data_offset + string_offsets[-1] > len(snapshot.map):
+                raise ValueError("string data out of bounds")
+
+            snapshot.string_offsets = string_offsets
+            snapshot.strings = [None] * string_count
+
+            rows = snapshot.map[rows_offset:strings_offset]
+            for string, mtime, size, offset, length, mask in struct.iter_unpack(
+                cls.ROW, rows
+            ):
+                if offset + length * 4 > len(snapshot.map):
+                    raise ValueError("record out of bounds")
+
+                snapshot.records[snapshot.string(string)] = (
+                    (mtime, size),
+                    (offset, length),
+                    frozenset(
+                        field for i, field in enumerate(TEXT_FIELDS) if mask & (1 << i)
+                    ),
+                )
+
+            snapshot.vocabulary_span = (vocabulary_offset, vocabulary_length)
+        except (OSError, ValueError, struct.error):
+            # `mmap` raises ValueError for an empty file, and decoding a string that is
+            # not valid UTF-8 raises UnicodeDecodeError, a subclass of ValueError.
+            snapshot.records.clear()
+            snapshot.dirty = True
+
+        return snapshot
+
+    def vocabulary(self) -> "TrigramVocabulary":
+        """
+        Same as `EntryCache.vocabulary`.
+        """
+        if self._vocabulary is None:
+            offset, length = self.vocabulary_span
+            try:
+                self._vocabulary = TrigramVocabulary.loads(
+                    self.map[offset : offset + length] if self.map is not None else b""
+                )
+            except (EOFError, ValueError, TypeError):
+                self._vocabulary = TrigramVocabulary()
+                for filename, (signature, _, _) in list(self.records.items()):
+                    entry = self.get(filename, signature, fields=set(FUZZY_FIELDS))
+                    assert entry is not None
+                    self._vocabulary.add_entry(entry)
+                self.dirty = True
+
+        return self._vocabulary
+
+    def contains(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> bool:
+        """
+        Same as `EntryCache.contains`.
+        """
+        record = self.records.get(filename)
+        return (
+            record is not None
+            and record[0] == signature
+            and record[2] <= skipped_fields(fields)
+        )
+
+    def get(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> Optional[Entry]:
+        """
+        Same as `EntryCache.get`, decoding the entry from the snapshot if needed.
+        """
+        if not self.contains(filename, signature, fields=fields):
+            return None
+
+        value = self.records[filename][1]
+        if isinstance(value, Entry):
+            return value
+        else:
+            # Like `parse_entry`, the longform fields that the caller doesn't need are
+            # skipped, which saves decoding the longest strings in the snapshot.
+            return self.decode(filename, *value, skip=skipped_fields(fields))
+
+    def put(
+        self,
+        filename: str,
+        signature: Tuple[int, int],
+        entry: Entry,
+        *,
+        fields: Optional[Set[str]] = None,
+    ) -> None:
+        """
+        Same as `EntryCache.put`.
+        """
+        self.vocabulary().add_entry(entry)
+        if time.time_ns() - signature[0] < EntryCache.RACY_NANOSECONDS:
+            if self.records.pop(filename, None) is not None:
+                self.dirty = True
+            return
+
+        self.records[filename] = (signature, entry, skipped_fields(fields))
+        self.dirty = True
+
+    def retain(self, filenames: Set[str]) -> None:
+        """
+        Same as `EntryCache.retain`.
+        """
+        for filename in list(self.records):
+            if filename not in filenames:
+                del self.records[filename]
+                self.dirty = True
+
+    def save(self) -> None:
+        """
+        Rebuilds the snapshot on disk, if any entry has changed since it was loaded.
+        """
+        if not self.dirty:
+            return
+
+        import struct
+
+        # Every entry is decoded before the old snapshot is closed. Since the snapshot
+        # is rebuilt anyway, so is the vocabulary, which drops the words of the entries
+        # that were modified or deleted.
+        records = []
+        vocabulary = TrigramVocabulary()
+        for filename in sorted(self.records):
+            signature, value, skipped = self.records[filename]
+            entry = value if isinstance(value, Entry) else self.decode(filename, *value)
+            records.append((filename, signature, entry, skipped))
+            self.records[filename] = (signature, entry, skipped)
+            vocabulary.add_entry(entry)
+        self._vocabulary = vocabulary
+
+        self.close()
+
+        numbers: Dict[str, int] = {}
+        strings: List[bytes] = []
+
+        def intern_string(string: Optional[str]) -> int:
+            if string is None:
+                return self.NONE
+
+            number = numbers.get(string)
+            if number is None:
+                number = numbers[string] = len(strings)
+                strings.append(string.encode("utf-8"))
+            return number
+
+        encoded = []
+        for filename, _, entry, _ in records:
+            values = []
+            for field in self.SCALARS:
+                value = getattr(entry, field)
+                values.append(intern_string(str(value) if value is not None else None))
+
+            for field in LIST_FIELDS:
+                subvalues = getattr(entry, field)
+                values.append(len(subvalues))
+                for subvalue in subvalues:
+                    values.append(intern_string(subvalue.keyword))
+                    values.append(intern_string(subvalue.description))
+
+            encoded.append(
+                (intern_string(filename), struct.pack(f"<{len(values)}I", *values))
+            )
+
+        string_offsets = [0]
+        for encoded_string in strings:
+            string_offsets.append(string_offsets[-1] + len(encoded_string))
+
+        offset = (
+            struct.calcsize(self.HEADER)
+            + len(records) * struct.calcsize(self.ROW)
+            + len(string_offsets) * 8
+            + string_offsets[-1]
+        )
+        vocabulary_data = vocabulary.dumps()
+        chunks = [
+            struct.pack(
+                self.HEADER,
+                self.MAGIC,
+                self.VERSION,
+                len(records),
+                len(strings),
+                offset + sum(len(record) for _, record in encoded),
+                len(vocabulary_data),
+            )
+        ]
+        for (_, signature, _, skipped), (string, record) in zip(records, encoded):
+            mask = sum(
+                1 << i for i, field in enumerate(TEXT_FIELDS) if field in skipped
+            )
+            chunks.append(
+                struct.pack(
+                    self.ROW,
+                    string,
+                    signature[0],
+                    signature[1],
+                    offset,
+                    len(record) // 4,
+                    mask,
+                )
+            )
+            offset += len(record)
+
+        chunks.append(struct.pack(f"<{len(string_offsets)}Q", *string_offsets))
+        chunks.extend(strings)
+        chunks.extend(record for _, record in encoded)
+        chunks.append(vocabulary_data)
+        try:
+            write_file_atomically(self.path, b"".join(chunks))
+        except OSError:
+            # Like the entry cache, the snapshot is purely an optimization.
+            return
+
+        self.dirty = False
+
+    def decode(
+        self,
+        filename: str,
+        offset: int,
+        length: int,
+        *,
+        skip: FrozenSet[str] = frozenset(),
+    ) -> Entry:
+        """
+        Decodes the entry whose record is at the given offset in the snapshot.
+
+        The fields in `skip` are left empty.
+        """
+        import struct
+
+        values = struct.unpack_from(f"<{length}I", self.map, offset)  # type: ignore
+        fields: Dict[str, Any] = {}
+        for field, value in zip(self.SCALARS, values):
+            if value == self.NONE or field in skip:
+                fields[field] = None
+            else:
+                fields[field] = self.string(value)
+
+        # A blank year is parsed as an empty string rather than as None.
+        if fields["year"]:
+            fields["year"] = int(fields["year"])
+
+        i = len(self.SCALARS)
+        for field in LIST_FIELDS:
+            count = values[i]
+            fields[field] = [
+                KeywordField(
+                    self.string(values[j]),
+                    self.string(values[j + 1]) if values[j + 1] != self.NONE else None,
+                )
+                for j in range(i + 1, i + 1 + 2 * count, 2)
+            ]
+            i += 1 + 2 * count
+
+        return Entry(filename=filename, **fields)
+
+    def string(self, number: int) -> str:
+        """
+        Returns the string with the given number from the string table.
+        """
+        string = self.strings[number]
+        if string is None:
+            assert self.map is not None
+            start = self.data_offset + self.string_offsets[number]
+            end = self.data_offset + self.string_offsets[number + 1]
+            string = self.strings[number] = self.map[start:end].decode("utf-8")
+        return string
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.string_offsets = []
+            self.strings = []
+
+
+class ResidentDatabase:
+    """
+    An in-memory copy of the database, kept by a long-running process such as
+    `oeuvre serve`.
+
+    Besides the parsed entries, the resident database keeps a `SearchIndex` of all the
+    entries (keyed by filename, and including the positional index of the longform
+    fields), so that searches don't have to build one.
+
+    If `watch` is true, the resident database asks a `Watcher` which files have changed
+    instead of checking every file on each refresh.
+    """
+
+    def __init__(self, app: Application, *, watch: bool = False) -> None:
+        self.app = app
+        # Map from filenames to (signature, entry, error) triples.
+        self.records: Dict[
+            str, Tuple[Tuple[int, int], Optional[Entry], Optional["OeuvreError"]]
+        ] = {}
+        self.filenames: List[str] = []
+        self.locations_signature: Optional[Tuple[int, int]] = None
+        self.index = SearchIndex(app.locdb, positional=True)
+        # The watcher is created before the first scan, so that no change made during
+        # the scan is missed.
+        self.watcher: Optional[Watcher] = make_watcher(app.directory) if watch else None
+        self.scanned = False
+
+    def refresh(self) -> None:
+        """
+        Brings the resident database up to date with the files on disk.
+
+        Only the files that have been created, modified or deleted since the last call
+        are parsed (or evicted) and re-indexed.
+        """
+        if self.watcher is None or not self.scanned:
+            self.rescan()
+            return
+
+        paths = self.watcher.poll()
+        if paths is None:
+            self.rescan()
+        elif paths:
+            self.update(paths)
+
+    def rescan(self) -> None:
+        """
+        Brings the resident database up to date by checking the signature of every file.
+        """
+        self.refresh_locations()
+
+        prefix_length = len(self.app.directory) + 1
+        changed: List[Tuple[str, str, Tuple[int, int]]] = []
+        filenames = []
+        for dir_entry in self.app.list_entry_files():
+            path = dir_entry.path
+            filename = path[prefix_length:]
+            try:
+                signature = stat_signature(dir_entry)
+            except FileNotFoundError:
+                # The file was deleted after it was listed, so its record is dropped
+                # below as if it hadn't been listed at all.
+                continue
+
+            filenames.append(filename)
+            record = self.records.get(filename)
+            if record is None or record[0] != signature:
+                changed.append((path, filename, signature))
+
+        for filename in set(self.records) - set(filenames):
+            self.remove(filename)
+
+        self.parse(changed)
+        self.filenames = [f for f in filenames if f in self.records]
+        self.scanned = True
+
+    def update(self, paths: Set[str]) -> None:
+        """
+        Brings the resident database up to date, given the paths of all the files that
+        have been created, modified or deleted since the last refresh.
+        """
+        if os.path.join(self.app.directory, "locations.json") in paths:
+            self.refresh_locations()
+
+        ignore = IgnoreList.load(self.app.directory)
+        prefix_length = len(self.app.directory) + 1
+        changed: List[Tuple[str, str, Tuple[int, int]]] = []
+        for path in sorted(paths):
+            filename = path[prefix_length:]
+            if not path.endswith(".txt") or ignore.ignores_file(filename):
+                continue
+
+            try:
+                signature = stat_signature(path)
+            except FileNotFoundError:
+                self.remove(filename)
+                continue
+
+            # The file is re-parsed even if its signature is unchanged, since the
+            # watcher saw it change.
+            changed.append((path, filename, signature))
+
+        self.parse(changed)
+        self.filenames = sorted(self.records)
+
+    def parse(self, changed: List[Tuple[str, str, Tuple[int, int]]]) -> None:
+        """
+        Parses and indexes the changed files, given as (path, filename, signature)
+        triples.
+        """
+        parsed = self.app.parse_files([path for path, _, _ in changed])
+        for (path, filename, signature), (entry, error) in zip(changed, parsed):
+            self.remove(filename)
+            if error is not None:
+                error.path = path
+            else:
+                assert entry is not None
+                entry.filename = filename
+                self.index.add(filename, entry)
+
+            self.records[filename] = (signature, entry, error)
+
+    def refresh_locations(self) -> None:
+        """
+        Reloads the location database if it has changed, and rebuilds the index since
+        the location postings depend on it.
+        """
+        try:
+            signature = stat_signature(
+                os.path.join(self.app.directory, "locations.json")
+            )
+        except FileNotFoundError:
+            signature = (0, 0)
+
+        if signature == self.locations_signature:
+            return
+
+        if self.locations_signature is not None:
+            self.app.locdb = self.app.load_locations()
+
+        self.locations_signature = signature
+        self.index = SearchIndex(self.app.locdb, positional=True)
+        for filename, (_, entry, _) in self.records.items():
+            if entry is not None:
+                self.index.add(filename, entry)
+
+    def remove(self, filename: str) -> None:
+        record = self.records.pop(filename, None)
+        if record is not None and record[1] is not None:
+            self.index.remove(filename, record[1])
+
+    def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+class Watcher:
+    """
+    Reports which files in the database directory have changed.
+
+    This base class is the polling fallback: it never knows which files have changed,
+    so the resident database checks the signature of every file instead.
+    """
+
+    def poll(self) -> Optional[Set[str]]:
+        """
+        Returns the paths of the files that have been created, modified or deleted since
+        the last call, or None if every file must be checked.
+        """
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    """
+    A watcher that uses Linux's inotify API, through ctypes.
+
+    Every directory in the database is watched, except for the ones that
+    `Application.iter_entries` skips as well (see `IgnoreList`). When the ignore file
+    changes, the watches are brought in line with it and a rescan is requested.
+    """
+
+    # Constants from <sys/inotify.h>.
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (
+        IN_MODIFY
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+    )
+    # Events after which the set of watched directories may be out of date.
+    RESCAN_MASK = IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, directory: str) -> None:
+        import ctypes
+        import ctypes.util
+        import struct
+
+        # The fixed-size header of `struct inotify_event`.
+        self.event_header = struct.Struct("iIII")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.directory = directory
+        self.ignore = IgnoreList.load(directory)
+        self.ignore_path = os.path.join(directory, IGNORE_FILENAME)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # Map from watch descriptors to directory paths.
+        self.watches: Dict[int, str] = {}
+        try:
+            self.add_watches(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watches(self, directory: str) -> None:
+        """
+        Watches the directory and all of its subdirectories, except for the ignored
+        ones.
+        """
+        import ctypes
+
+        for dirpath, dirnames, _ in os.walk(directory):
+            relative_path = os.path.relpath(dirpath, self.directory)
+            dirnames[:] = [
+                d
+                for d in dirnames
+                if not self.ignore.ignores(
+                    d if relative_path == "." else f"{relative_path}/{d}"
+                )
+            ]
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"could not watch {dirpath}")
+
+            self.watches[wd] = dirpath
+
+    def reload_ignore(self) -> None:
+        """
+        Reloads the ignore list, and stops watching the directories that it now ignores
+        and starts watching the ones that it no longer does.
+        """
+        self.ignore = IgnoreList.load(self.directory)
+        for wd, dirpath in list(self.watches.items()):
+            if dirpath == self.directory:
+                continue
+
+            parts = os.path.relpath(dirpath, self.directory).split("/")
+            if any(
+                self.ignore.ignores("/".join(parts[:i]))
+                for i in range(1, len(parts) + 1)
+            ):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+        # Directories that are already watched keep their watch descriptors.
+        self.add_watches(self.directory)
+
+    def poll(self) -> Optional[Set[str]]:
+        paths = set()
+        rescan = False
+        for wd, mask, name in self.read_events():
+            if mask & self.RESCAN_MASK:
+                rescan = True
+                continue
+
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            dirpath = self.watches.get(wd)
+            if dirpath is None or not name:
+                continue
+
+            path = os.path.join(dirpath, name)
+            if path == self.ignore_path:
+                try:
+                    self.reload_ignore()
+                except OSError:
+                    pass
+                rescan = True
+            elif mask & self.IN_ISDIR:
+                # A directory was created, deleted or moved, so the files inside it
+                # have too.
+                relative_path = os.path.relpath(path, self.directory)
+                if mask & (
+                    self.IN_CREATE | self.IN_MOVED_TO
+                ) and not self.ignore.ignores(relative_path):
+                    try:
+                        self.add_watches(path)
+                    except OSError:
+                        pass
+                rescan = True
+            else:
+                paths.add(path)
+
+        return None if rescan else paths
+
+    def read_events(self) -> Iterator[Tuple[int, int, str]]:
+        """
+        Yields the (watch descriptor, mask, name) triples of the pending events.
+        """
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.event_header.unpack_from(data, offset)
+                offset += self.event_header.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                yield wd, mask, os.fsdecode(name)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def make_watcher(directory: str) -> Watcher:
+    """
+    Returns an inotify watcher for the directory if the platform supports it, and a
+    polling watcher otherwise.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        return Watcher()
+
+
+class SqliteMirror:
+    """
+    A mirror of the database in SQLite, used instead of the text files when the
+    `--sqlite` flag is given.
+
+    The text files remain the source of truth: the mirror is brought up to date with
+    them (see `sync`) before it is used, re-parsing only the files that have been
+    created or modified since the last sync. The mirror's tables are normalized so that
+    other tools can query them directly:
+
+      files           one row per entry file, with its signature and parse error
+      entries         one row per entry, with its scalar and longform fields
+      keyword_fields  the characters, locations, keywords and settings of each entry
+      locations       the transitive closure of locations.json
+      tokens          the word tokens of the indexed fields of each entry
+      trigrams        the trigrams of the tokens of the fuzzy fields (see `FuzzyTerm`)
+      entries_text    a full-text (FTS5) index of the longform fields, if available
+
+    Like `SearchIndex`, the mirror is used to find the candidate entries for a query,
+    which are then matched as usual.
+    """
+
+    VERSION = 2
+
+    # How long to wait, in seconds, for another process to finish writing to the mirror
+    # before giving up.
+    TIMEOUT = 10.0
+
+    SCHEMA = """
+        CREATE TABLE meta (
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        );
+
+        CREATE TABLE files (
+          filename TEXT PRIMARY KEY,
+          mtime_ns INTEGER NOT NULL,
+          size INTEGER NOT NULL,
+          error TEXT
+        );
+
+        CREATE TABLE entries (
+          id INTEGER PRIMARY KEY,
+          filename TEXT NOT NULL UNIQUE
+            REFERENCES files (filename) ON DELETE CASCADE,
+          title TEXT NOT NULL,
+          type TEXT NOT NULL,
+          creator TEXT,
+          year INTEGER,
+          language TEXT,
+          plot_summary TEXT,
+          notes TEXT,
+          quotes TEXT,
+          data TEXT NOT NULL
+        );
+
+        CREATE TABLE keyword_fields (
+          entry_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+          field TEXT NOT NULL,
+          position INTEGER NOT NULL,
+          keyword TEXT NOT NULL,
+          description TEXT,
+          PRIMARY KEY (entry_id, field, position)
+        );
+        CREATE INDEX keyword_fields_by_keyword ON keyword_fields (field, keyword);
+
+        CREATE TABLE locations (
+          location TEXT NOT NULL,
+          enclosing TEXT NOT NULL,
+          PRIMARY KEY (enclosing, location)
+        );
+
+        CREATE TABLE tokens (
+          entry_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+          field TEXT NOT NULL,
+          token TEXT NOT NULL,
+          PRIMARY KEY (field, token, entry_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX tokens_by_entry ON tokens (entry_id);
+
+        CREATE TABLE trigrams (
+          trigram TEXT NOT NULL,
+          token TEXT NOT NULL,
+          PRIMARY KEY (trigram, token)
+        ) WITHOUT ROWID;
+    """
+
+    # The longform fields are stored in the full-text index as their case-folded word
+    # tokens (see `tokenize`), so that the index agrees with `TextTerm` on what a word
+    # is.
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE entries_text USING fts5 (
+          plot_summary, notes, quotes, tokenize = "unicode61 remove_diacritics 0"
+        );
+    """
+
+    def __init__(self, connection: "sqlite3.Connection", *, fts: bool) -> None:
+        self.connection = connection
+        self.fts = fts
+
+    @classmethod
+    def open(cls, path: str) -> "SqliteMirror":
+        """
+        Opens the mirror at the given path, creating it if it does not exist or was
+        created by a different version of this program.
+        """
+        import sqlite3
+
+        connection = sqlite3.connect(path, timeout=cls.TIMEOUT)
+        try:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+
+        if row is None or row[0] != str(cls.VERSION):
+            connection.close()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            connection = sqlite3.connect(path, timeout=cls.TIMEOUT)
+            with connection:
+                connection.executescript(cls.SCHEMA)
+                try:
+                    connection.executescript(cls.FTS_SCHEMA)
+                except sqlite3.OperationalError:
+                    # SQLite was compiled without FTS5.
+                    pass
+
+                connection.execute(
+                    "INSERT INTO meta VALUES ('version', ?)", (str(cls.VERSION),)
+                )
+
+        connection.execute("PRAGMA foreign_keys = ON")
+        fts = (
+            connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'entries_text'"
+            ).fetchone()
+            is not None
+        )
+        return cls(connection, fts=fts)
+
+    def sync(self, app: Application) -> None:
+        """
+        Brings the mirror up to date with the files in the application's directory.
+        """
+        with self.connection:
+            # The write lock is taken up front, since a process that upgrades from a
+            # read lock can fail at once instead of waiting for a concurrent sync.
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.sync_locations(app)
+
+            signatures = {
+                filename: (mtime_ns, size)
+                for filename, mtime_ns, size in self.connection.execute(
+                    "SELECT filename, mtime_ns, size FROM files"
+                )
+            }
+
+            prefix_length = len(app.directory) + 1
+            changed: List[Tuple[str, str, Tuple[int, int]]] = []
+            seen = set()
+            for dir_entry in app.list_entry_files():
+                path = dir_entry.path
+                filename = path[prefix_length:]
+                try:
+                    signature = stat_signature(dir_entry)
+                except FileNotFoundError:
+                    continue
+
+                seen.add(filename)
+                if signatures.get(filename) != signature:
+                    changed.append((path, filename, signature))
+
+            for filename in signatures.keys() - seen:
+                self.delete(filename)
+
+            app.stats.count("files scanned", len(seen))
+            parsed = app.parse_files([path for path, _, _ in changed])
+            for (path, filename, signature), (entry, error) in zip(changed, parsed):
+                # A file modified very recently might be modified again without its
+                # signature changing (see `EntryCache`), so make sure that it is
+                # re-parsed next time.
+                if time.time_ns() - signature[0] < EntryCache.RACY_NANOSECONDS:
+                    signature = (-1, -1)
+
+                self.delete(filename)
+                if error is not None:
+                    error.path = path
+                    self.connection.execute(
+                        "INSERT INTO files VALUES (?, ?, ?, ?)",
+                        (filename, *signature, str(error)),
+                    )
+                else:
+                    assert entry is not None
+                    entry.filename = filename
+                    self.connection.execute(
+                        "INSERT INTO files VALUES (?, ?, ?, NULL)",
+                        (filename, *signature),
+                    )
+                    self.insert(entry)
+
+    def sync_locations(self, app: Application) -> None:
+        """
+        Replaces the `locations` table if locations.json has changed.
+        """
+        import json
+
+        try:
+            signature = stat_signature(os.path.join(app.directory, "locations.json"))
+        except FileNotFoundError:
+            signature = (0, 0)
+
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'locations_signature'"
+        ).fetchone()
+        if row is not None and tuple(json.loads(row[0])) == signature:
+            return
+
+        self.connection.execute("DELETE FROM locations")
+        self.connection.executemany(
+            "INSERT INTO locations VALUES (?, ?)",
+            (
+                (location, enclosing)
+                for location, enclosings in app.locdb.items()
+                for enclosing in enclosings
+            ),
+        )
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('locations_signature', ?)",
+            (json.dumps(signature),),
+        )
+
+    def insert(self, entry: Entry) -> None:
+        """
+        Inserts the entry into the `entries` table and the tables that index it.
+        """
+        import json
+
+        cursor = self.connection.execute(
+            "INSERT INTO entries"
+            + " (filename, title, type, creator, year, language, plot_summary, notes,"
+            + " quotes, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.filename,
+                entry.title,
+                entry.type,
+                entry.creator,
+                entry.year,
+                entry.language,
+                entry.plot_summary,
+                entry.notes,
+                entry.quotes,
+                json.dumps(entry.to_json()),
+            ),
+        )
+        entry_id = cursor.lastrowid
+
+        keyword_fields = []
+        for field in ("characters", "locations", "keywords", "settings"):
+            for position, value in enumerate(getattr(entry, field)):
+                keyword_fields.append(
+                    (entry_id, field, position, value.keyword, value.description)
+                )
+        self.connection.executemany(
+            "INSERT INTO keyword_fields VALUES (?, ?, ?, ?, ?)", keyword_fields
+        )
+
+        tokens = set()
+        for field in SQLITE_TOKEN_FIELDS:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            subvalues = (
+                [k.keyword for k in value] if isinstance(value, list) else [value]
+            )
+            for subvalue in subvalues:
+                for token in tokenize(str(subvalue)):
+                    tokens.add((entry_id, field, token))
+        self.connection.executemany("INSERT INTO tokens VALUES (?, ?, ?)", tokens)
+        # Like `SearchIndex`, the trigrams of tokens that no longer occur are not
+        # deleted, since they lead to no entries.
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO trigrams VALUES (?, ?)",
+            {
+                (trigram, token)
+                for _, field, token in tokens
+                if field in FUZZY_FIELDS
+                for trigram in trigrams(token)
+            },
+        )
+
+        if self.fts:
+            self.connection.execute(
+                "INSERT INTO entries_text (rowid, plot_summary, notes, quotes)"
+                + " VALUES (?, ?, ?, ?)",
+                (
+                    entry_id,
+                    " ".join(tokenize(entry.plot_summary or "")),
+                    " ".join(tokenize(entry.notes or "")),
+                    " ".join(tokenize(entry.quotes or "")),
+                ),
+            )
+
+    def delete(self, filename: str) -> None:
+        """
+        Deletes the file and its entry, if any, from the mirror.
+        """
+        if self.fts:
+            self.connection.execute(
+                "DELETE FROM entries_text WHERE rowid IN"
+                + " (SELECT id FROM entries WHERE filename = ?)",
+                (filename,),
+            )
+
+        # The entry and the rows that index it are deleted by cascading.
+        self.connection.execute("DELETE FROM files WHERE filename = ?", (filename,))
+
+    def errors(self) -> List[str]:
+        """
+        Returns the error messages for the files that could not be parsed, in sorted
+        order of their paths.
+        """
+        return [
+            error
+            for (error,) in self.connection.execute(
+                "SELECT error FROM files WHERE error IS NOT NULL ORDER BY filename"
+            )
+        ]
+
+    def read_entries(self, filenames: Optional[Set[str]] = None) -> Iterator[Entry]:
+        """
+        Yields the entries in the mirror, in sorted order of their paths.
+
+        If `filenames` is not None, only the entries with those filenames are yielded.
+        """
+        import json
+
+        if filenames is None:
+            rows = self.connection.execute("SELECT data FROM entries ORDER BY filename")
+        else:
+            rows = self.connection.execute(
+                "SELECT data FROM entries"
+                + " WHERE filename IN (SELECT value FROM json_each(?))"
+                + " ORDER BY filename",
+                (json.dumps(sorted(filenames)),),
+            )
+
+        for (data,) in rows:
+            yield Entry.from_json(json.loads(data))
+
+    def count_keywords(self) -> Dict[str, int]:
+        """
+        Returns the number of times each keyword occurs in the database.
+        """
+        return dict(
+            self.connection.execute(
+                "SELECT keyword, COUNT(*) FROM keyword_fields"
+                + " WHERE field = 'keywords' GROUP BY keyword"
+            ).fetchall()
+        )
+
+    def lookup(self, query: "Query") -> Optional[Set[Any]]:
+        """
+        Returns the filenames of the candidate entries for the query, or None if the
+        mirror cannot narrow down the search.
+        """
+        if query.root is None:
+            return set()
+
+        return query.root.candidates(self)
+
+    def lookup_term(self, term: "SearchTerm") -> Optional[Set[Any]]:
+        """
+        Returns the filenames of the candidate entries for a single search term, or None
+        if the mirror cannot narrow down the search.
+        """
+        if term.field == "locations":
+            return self.lookup_location(term.term)
+
+        if term.field and term.field not in SQLITE_TOKEN_FIELDS:
+            return None
+
+        if not term.tokens:
+            return None
+
+        if term.field:
+            return self.lookup_tokens(term.field, term.tokens)
+
+        candidates = self.lookup_location(term.term)
+        for field in INDEXED_FIELDS:
+            candidates |= self.lookup_tokens(field, term.tokens)
+        return candidates
+
+    def lookup_text(self, term: "TextTerm") -> Optional[Set[Any]]:
+        """
+        Returns the filenames of the candidate entries for a search term over the
+        longform fields, or None if the mirror cannot narrow down the search.
+        """
+        if not self.fts or not term.tokens:
+            return None
+
+        words = " ".join(f'"{token}"' for token in term.tokens)
+        if term.proximity is not None:
+            expression = f"NEAR({words}, {term.proximity})"
+        else:
+            expression = f'"{" ".join(term.tokens)}"'
+
+        rows = self.connection.execute(
+            "SELECT filename FROM entries_text"
+            + " JOIN entries ON entries.id = entries_text.rowid"
+            + " WHERE entries_text MATCH ?",
+            ("{" + " ".join(term.fields) + "} : " + expression,),
+        )
+        return {filename for (filename,) in rows}
+
+    def lookup_fuzzy(self, term: "FuzzyTerm") -> Optional[Set[Any]]:
+        """
+        Returns the filenames of the candidate entries for a fuzzy search term.
+        """
+        import json
+
+        candidates: Optional[Set[Any]] = None
+        for i, token_trigrams in enumerate(term.trigrams):
+            shared = dict(
+                self.connection.execute(
+                    "SELECT token, COUNT(*) FROM trigrams"
+                    + " WHERE trigram IN (SELECT value FROM json_each(?))"
+                    + " GROUP BY token",
+                    (json.dumps(sorted(token_trigrams)),),
+                )
+            )
+            words = similar_words(token_trigrams, shared)
+            term.add_similar_words(i, words)
+
+            rows = self.connection.execute(
+                "SELECT DISTINCT filename FROM tokens"
+                + " JOIN entries ON entries.id = tokens.entry_id"
+                + f" WHERE field IN ({', '.join('?' * len(term.fields))})"
+                + " AND token IN (SELECT value FROM json_each(?))",
+                (*term.fields, json.dumps(list(words))),
+            )
+            keys = {filename for (filename,) in rows}
+            if candidates is None:
+                candidates = keys
+            else:
+                candidates &= keys
+
+        return candidates
+
+    def lookup_location(self, location: str) -> Set[Any]:
+        """
+        Returns the filenames of the entries with the location or a location that it
+        encloses.
+        """
+        rows = self.connection.execute(
+            "SELECT DISTINCT filename FROM keyword_fields"
+            + " JOIN entries ON entries.id = keyword_fields.entry_id"
+            + " WHERE field = 'locations' AND (keyword = ? OR keyword IN"
+            + " (SELECT location FROM locations WHERE enclosing = ?))",
+            (location, location),
+        )
+        return {filename for (filename,) in rows}
+
+    def lookup_tokens(self, field: str, tokens: List[str]) -> Set[Any]:
+        """
+        Returns the filenames of the entries whose field contains all of the tokens.
+        """
+        distinct_tokens = sorted(set(tokens))
+        rows = self.connection.execute(
+            "SELECT filename FROM tokens JOIN entries ON entries.id = tokens.entry_id"
+            + f" WHERE field = ? AND token IN ({', '.join('?' * len(distinct_tokens))})"
+            + " GROUP BY entry_id HAVING COUNT(*) = ?",
+            (field, *distinct_tokens, len(distinct_tokens)),
+        )
+        return {filename for (filename,) in rows}
+
+
+class ForwardedStream(StringIO):
+    """
+    An output stream that captures the output of a command run on behalf of a client
+    of `oeuvre serve`, and reports whether the client's own stream is a terminal.
+    """
+
+    def __init__(self, *, isatty: bool) -> None:
+        super().__init__()
+        self._isatty = isatty
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+
+# The subcommands that are forwarded to `oeuvre serve`, if it is running. The others
+# either modify the database or interact with the user.
+FORWARDED_SUBCOMMANDS = {"search", "show", "keywords", "stats"}
+
+
+def forward_to_server(directory: str, args: List[str]) -> Optional[int]:
+    """
+    Runs the command on the `oeuvre serve` process for the directory, if there is one,
+    and prints its output.
+
+    Returns the exit status of the command, or None if the command could not be
+    forwarded and so should be run in-process.
+    """
+    if find_subcommand(args) not in FORWARDED_SUBCOMMANDS or "--profile" in args:
+        return None
+
+    # Most of the time there is no server, so don't pay for importing `socket` and
+    # `json` to find that out.
+    socket_path = os.path.join(directory, SOCKET_FILENAME)
+    if not os.path.exists(socket_path):
+        return None
+
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CLIENT_TIMEOUT)
+    try:
+        client.connect(socket_path)
+        request = {
+            "args": args,
+            "stdout_isatty": sys.stdout.isatty(),
+            "stderr_isatty": sys.stderr.isatty(),
+        }
+        with client.makefile("rwb") as f:
+            f.write(json.dumps(request).encode("utf-8") + b"\n")
+            f.flush()
+            response = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
+
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["status"]
+
+
+def find_subcommand(args: List[str]) -> Optional[str]:
+    """
+    Returns the name of the subcommand in the command-line arguments.
+    """
+    args_iter = iter(args)
+    for arg in args_iter:
+        if arg in ("--jobs", "--profile"):
+            # Skip the option's argument.
+            next(args_iter, None)
+        elif not arg.startswith("-"):
+            return arg
+
+    return None
+
+
+def stat_signature(path: Union[str, "os.DirEntry[str]"]) -> Tuple[int, int]:
+    """
+    Returns a (modification time, size) pair which changes whenever the file does.
+
+    If `path` is a directory entry from `os.scandir`, its cached `stat` result is used.
+    """
+    st = path.stat() if isinstance(path, os.DirEntry) else os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def scan_entry_files(directory: str, ignore: "IgnoreList") -> List["os.DirEntry[str]"]:
+    """
+    Returns the directory entries of all the entry files (`*.txt`) under the directory,
+    in sorted order of their paths.
+
+    Ignored directories are pruned before they are descended into, and hidden files and
+    directories are skipped, as `glob` does.
+    """
+    dir_entries = []
+    # A stack of (path, path relative to `directory`) pairs of directories to scan.
+    stack = [(directory, "")]
+    while stack:
+        dirpath, relative_path = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                for dir_entry in it:
+                    name = dir_entry.name
+                    if dir_entry.is_dir():
+                        subpath = relative_path + name
+                        if not ignore.ignores(subpath):
+                            stack.append((dir_entry.path, subpath + "/"))
+                    elif name.endswith(".txt") and not name.startswith("."):
+                        dir_entries.append(dir_entry)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            # The directory was deleted while it was being scanned, or can't be read.
+            continue
+
+    # Sorting the whole list rather than each directory gives the same order as sorting
+    # the paths, even though '/' sorts after some characters that can be in names.
+    dir_entries.sort(key=lambda dir_entry: dir_entry.path)
+    return dir_entries
+
+
+class IgnoreList:
+    """
+    The subdirectories of the database directory which don't contain entries, and so
+    are not descended into when looking for them.
+
+    The `editing/` directory and hidden directories are always ignored. More directories
+    can be listed in the `.oeuvreignore` file in the database directory, one pattern per
+    line, with shell-style wildcards. As in `.gitignore`, a pattern with a slash in it
+    (other than a trailing one) is matched against the path of the directory relative to
+    the database directory, and a pattern without one against the name of a directory at
+    any depth. Blank lines and lines starting with `#` are skipped.
+    """
+
+    DEFAULT_PATTERNS = ("/editing",)
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        import fnmatch
+
+        path_patterns = []
+        name_patterns = [fnmatch.translate(".*")]
+        for pattern in itertools.chain(self.DEFAULT_PATTERNS, patterns):
+            pattern = pattern.strip().rstrip("/")
+            if not pattern or pattern.startswith("#"):
+                continue
+
+            if "/" in pattern:
+                path_patterns.append(fnmatch.translate(pattern.lstrip("/")))
+            else:
+                name_patterns.append(fnmatch.translate(pattern))
+
+        self.path_regex = re.compile("|".join(path_patterns)) if path_patterns else None
+        self.name_regex = re.compile("|".join(name_patterns))
+
+    @classmethod
+    def load(cls, directory: str) -> "IgnoreList":
+        """
+        Loads the ignore list of the database directory.
+        """
+        try:
+            with open(os.path.join(directory, IGNORE_FILENAME), encoding="utf-8") as f:
+                return cls(f.read().splitlines())
+        except FileNotFoundError:
+            return cls([])
+
+    def ignores(self, relative_path: str) -> bool:
+        """
+        Returns whether the directory at the given path, relative to the database
+        directory, is ignored. Its parent directory is assumed not to be.
+        """
+        name = relative_path.rpartition("/")[2]
+        return bool(
+            self.name_regex.match(name)
+            or (self.path_regex is not None and self.path_regex.match(relative_path))
+        )
+
+    def ignores_file(self, relative_path: str) -> bool:
+        """
+        Returns whether the file at the given path, relative to the database directory,
+        is hidden or in an ignored directory.
+        """
+        if relative_path.rpartition("/")[2].startswith("."):
+            return True
+
+        parts = relative_path.split("/")
+        return any(self.ignores("/".join(parts[:i])) for i in range(1, len(parts)))
+
+
+def write_file_atomically(
+    path: str, text: Union[str, bytes], *, sync: bool = False
+) -> None:
+    """
+    Writes `text` to the file at `path`. If `text` is a string, it is encoded as UTF-8.
+
+    The text is written to a temporary file which is then renamed to `path`, so that
+    readers see either the old contents or the new contents and never a partial file.
+    If `sync` is true, the temporary file is flushed to disk before it is renamed, so
+    that the new contents survive a crash as well.
+
+    The file keeps its permissions if it already exists. If `path` is a symbolic link,
+    the file that it points to is written and the link is kept.
+    """
+    import tempfile
+
+    # The temporary file is created next to the real file, since a rename can't cross
+    # file systems.
+    path = os.path.realpath(path)
+    fd, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".oeuvre-", suffix=".tmp"
+    )
+    try:
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            # `mkstemp` creates files that only the owner can read, so give the file
+            # the permissions that `open` would have.
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(temporary_path, mode & 0o7777)
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(text.encode("utf-8") if isinstance(text, str) else text)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@contextmanager
+def lock_file(path: str, *, blocking: bool) -> Iterator[None]:
+    """
+    Holds an exclusive advisory lock on the file at `path`, creating it (and its parent
+    directories) if it does not exist, and removing it when the lock is released.
+
+    Raises OeuvreError if `blocking` is false and the file is locked by another process.
+    Does nothing on platforms without `fcntl`.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            raise OeuvreError("entry is locked by another oeuvre process") from None
+
+        # The process that held the lock may have removed the file after it was opened
+        # here, in which case the lock is on a file that other processes no longer see,
+        # so the file is opened and locked again.
+        try:
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        # The file is removed before the lock is released, so that a process that was
+        # waiting for the lock sees that the file is gone.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+        # Closing the file releases the lock.
+        os.close(fd)
+
+
+def read_text_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def shell_editor(paths: List[str]) -> None:
+    import subprocess
+
+    editor = os.environ.get("EDITOR", "nano").split()
+    r = subprocess.run(editor + paths)
+    if r.returncode != 0:
+        raise OeuvreError(f"editor process exited with error code {r.returncode}")
+
+
+def match(
+    entry: Entry, search_terms: List[str], *, locdb: LocationDatabase
+) -> List[str]:
+    """
+    Returns a list of matches.
+
+    Each match is a string with a description of the match that is meant to be displayed
+    to the user.
+
+    If the list is empty, then the entry doesn't match the search terms.
+
+    Search terms are joined by an implicit AND operator, and may be combined with the
+    OR and NOT operators and with parentheses (see `compile_query`).
+
+    To match many entries against the same search terms, use `compile_query` instead.
+    """
+    return compile_query(search_terms).match(entry, locdb=locdb) or []
+
+
+def compile_query(search_terms: List[str], *, fuzzy: bool = False) -> "Query":
+    """
+    Compiles the search terms into a `Query`.
+
+    If `fuzzy` is true, then the terms that could be fuzzy terms (see `FuzzyTerm`) also
+    match fuzzily even if they do not start with '~'.
+
+    The grammar of queries is
+
+      query := and ('OR' and)*
+      and   := unary ('AND'? unary)*
+      unary := 'NOT' unary | '-' unary | '(' query ')' | term
+
+    so that adjacent terms are joined by an implicit AND, which binds more tightly than
+    OR. Parentheses may be attached to terms, e.g. '(kw:war' or 'kw:peace)'.
+
+    Raises a `ValueError` if the query is malformed or if any of the search terms refers
+    to an unknown field.
+    """
+    tokens = tokenize_query(search_terms)
+    if not tokens:
+        return Query(None)
+
+    return Query(QueryParser(tokens, fuzzy=fuzzy).parse())
+
+
+def tokenize_query(search_terms: List[str]) -> List[str]:
+    """
+    Splits the search terms into operator and term tokens.
+
+    Parentheses and a leading minus sign are split off from the terms they are attached
+    to, and the minus sign is turned into a 'NOT' operator.
+    """
+    tokens = []
+    for search_term in search_terms:
+        suffix = []
+        while search_term.endswith(")"):
+            search_term = search_term[:-1]
+            suffix.append(")")
+
+        while search_term:
+            if search_term.startswith("("):
+                tokens.append("(")
+                search_term = search_term[1:]
+            elif search_term.startswith("-") and len(search_term) > 1:
+                tokens.append("NOT")
+                search_term = search_term[1:]
+            else:
+                tokens.append(search_term)
+                break
+
+        tokens.extend(suffix)
+
+    return tokens
+
+
+class QueryParser:
+    """
+    A recursive-descent parser for the query grammar described in `compile_query`.
+    """
+
+    OPERATORS = {"AND", "OR", "NOT", "(", ")"}
+
+    def __init__(self, tokens: List[str], *, fuzzy: bool = False) -> None:
+        self.tokens = tokens
+        self.position = 0
+        self.fuzzy = fuzzy
+
+    def parse(self) -> "QueryNode":
+        node = self.parse_or()
+        if not self.done():
+            raise ValueError(f"unexpected {self.tokens[self.position]!r} in query")
+        return node
+
+    def parse_or(self) -> "QueryNode":
+        children = [self.parse_and()]
+        while self.accept("OR"):
+            children.append(self.parse_and())
+
+        return children[0] if len(children) == 1 else OrNode(children)
+
+    def parse_and(self) -> "QueryNode":
+        children = [self.parse_unary()]
+        while not self.done() and self.peek() not in ("OR", ")"):
+            self.accept("AND")
+            children.append(self.parse_unary())
+
+        return children[0] if len(children) == 1 else AndNode(children)
+
+    def parse_unary(self) -> "QueryNode":
+        if self.done():
+            raise ValueError("unexpected end of query")
+
+        if self.accept("NOT"):
+            return NotNode(self.parse_unary())
+        elif self.accept("("):
+            node = self.parse_or()
+            if not self.accept(")"):
+                raise ValueError("unbalanced parentheses in query")
+            return node
+        elif self.peek() in self.OPERATORS:
+            raise ValueError(f"unexpected {self.peek()!r} in query")
+        else:
+            token = self.peek()
+            self.position += 1
+            return compile_term(token, fuzzy=self.fuzzy)
+
+    def accept(self, token: str) -> bool:
+        if not self.done() and self.peek() == token:
+            self.position += 1
+            return True
+        else:
+            return False
+
+    def peek(self) -> str:
+        return self.tokens[self.position]
+
+    def done(self) -> bool:
+        return self.position == len(self.tokens)
+
+
+def compile_term(search_term: str, *, fuzzy: bool = False) -> "QueryNode":
+    """
+    Compiles a single search term, e.g. 'DeLillo', 'kw:postmodernist' or '~Dostoevsky'.
+
+    If `fuzzy` is true, then bare terms and terms on the `FUZZY_FIELDS` match either
+    exactly or fuzzily. The exact match is kept since a bare fuzzy term only searches
+    the `FUZZY_FIELDS`, not all the fields that a bare term does.
+    """
+    field, term = split_term(search_term)
+    if field:
+        field = resolve_alias(field)
+        if field != "text" and field not in FIELDS:
+            raise ValueError(f"unknown field {field!r}")
+
+    if term.startswith("~"):
+        return FuzzyTerm(field, term[1:])
+    elif fuzzy and (not field or field in FUZZY_FIELDS):
+        exact = SearchTerm(field, term)
+        if not exact.tokens:
+            # A term with no words, e.g. '-', can't be compared fuzzily.
+            return exact
+
+        return OrNode([exact, FuzzyTerm(field, term)])
+    elif field == "text" or field in TEXT_FIELDS:
+        return TextTerm(field, term)
+    else:
+        return SearchTerm(field, term)
+
+
+class Query:
+    """
+    A compiled search query.
+
+    The search terms are parsed and validated once, when the query is compiled, so that
+    matching the query against an entry does no more work than necessary.
+    """
+
+    def __init__(self, root: Optional["QueryNode"]) -> None:
+        """
+        Args:
+          root: The root node of the query, or None for an empty query, which matches
+            nothing.
+        """
+        self.root = root
+
+    def match(self, entry: Entry, *, locdb: LocationDatabase) -> Optional[List[str]]:
+        """
+        Returns None if the entry does not match the query, or else a list of match
+        descriptions as described in the documentation for `match`.
+
+        The list may be empty if the entry only matched because of a NOT operator.
+        """
+        if self.root is None:
+            return None
+
+        return self.root.match(entry, locdb)
+
+    def terms(self) -> List["QueryNode"]:
+        """
+        Returns the search terms at the leaves of the query.
+        """
+        return self.root.terms() if self.root is not None else []
+
+    def positive_terms(self) -> List["QueryNode"]:
+        """
+        Returns the search terms at the leaves of the query that are not negated by a
+        NOT operator.
+        """
+        return self.root.positive_terms() if self.root is not None else []
+
+    def fields_used(self) -> Set[str]:
+        """
+        Returns the set of entry fields that `match` looks at.
+        """
+        return self.root.fields_used() if self.root is not None else set()
+
+    def is_fuzzy(self) -> bool:
+        """
+        Returns whether the query has any fuzzy terms, in which case its matches should
+        be ranked by `score`.
+        """
+        return any(isinstance(term, FuzzyTerm) for term in self.terms())
+
+    def score(self, entry: Entry) -> float:
+        """
+        Returns how closely the entry matches the fuzzy terms of the query, from 0 to
+        the number of fuzzy terms (see `FuzzyTerm.score`).
+        """
+        return sum(
+            term.score(entry) for term in self.terms() if isinstance(term, FuzzyTerm)
+        )
+
+
+class QueryNode:
+    """
+    Base class for the nodes of a compiled query.
+    """
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        """
+        Returns None if the entry does not match, or else a (possibly empty) list of
+        match descriptions.
+        """
+        raise NotImplementedError
+
+    def cost(self) -> int:
+        """
+        Returns a rough estimate of the cost of calling `match`, used to decide which
+        nodes to evaluate first.
+        """
+        raise NotImplementedError
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        """
+        Returns the keys of the candidate entries for the node, or None if the index
+        cannot narrow down the search.
+        """
+        raise NotImplementedError
+
+    def fields_used(self) -> Set[str]:
+        """
+        Returns the set of entry fields that `match` looks at.
+        """
+        raise NotImplementedError
+
+    def terms(self) -> List["QueryNode"]:
+        """
+        Returns the search terms at the leaves of the query.
+        """
+        raise NotImplementedError
+
+    def positive_terms(self) -> List["QueryNode"]:
+        """
+        Returns the search terms at the leaves of the query that are not negated by a
+        NOT operator.
+        """
+        raise NotImplementedError
+
+
+class AndNode(QueryNode):
+    def __init__(self, children: List[QueryNode]) -> None:
+        self.children = children
+        # Evaluate the cheapest children first, so that most entries are rejected
+        # before the expensive children have to be evaluated. The original positions
+        # are kept so that match descriptions are reported in the order of the terms.
+        self.plan = sorted(enumerate(children), key=lambda pair: pair[1].cost())
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        results: List[List[str]] = [[] for _ in self.children]
+        for i, child in self.plan:
+            child_matches = child.match(entry, locdb)
+            if child_matches is None:
+                return None
+
+            results[i] = child_matches
+
+        return [m for child_matches in results for m in child_matches]
+
+    def cost(self) -> int:
+        return sum(child.cost() for child in self.children)
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        candidates: Optional[Set[Any]] = None
+        for child in self.children:
+            child_candidates = child.candidates(index)
+            if child_candidates is None:
+                continue
+
+            if candidates is None:
+                candidates = set(child_candidates)
+            else:
+                candidates &= child_candidates
+
+        return candidates
+
+    def fields_used(self) -> Set[str]:
+        return set().union(*(child.fields_used() for child in self.children))
+
+    def terms(self) -> List[QueryNode]:
+        return [term for child in self.children for term in child.terms()]
+
+    def positive_terms(self) -> List[QueryNode]:
+        return [term for child in self.children for term in child.positive_terms()]
+
+
+class OrNode(QueryNode):
+    def __init__(self, children: List[QueryNode]) -> None:
+        self.children = children
+        self.plan = sorted(children, key=lambda child: child.cost())
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        for child in self.plan:
+            child_matches = child.match(entry, locdb)
+            if child_matches is not None:
+                return child_matches
+
+        return None
+
+    def cost(self) -> int:
+        return sum(child.cost() for child in self.children)
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        candidates: Set[Any] = set()
+        for child in self.children:
+            child_candidates = child.candidates(index)
+            if child_candidates is None:
+                return None
+
+            candidates |= child_candidates
+
+        return candidates
+
+    def fields_used(self) -> Set[str]:
+        return set().union(*(child.fields_used() for child in self.children))
+
+    def terms(self) -> List[QueryNode]:
+        return [term for child in self.children for term in child.terms()]
+
+    def positive_terms(self) -> List[QueryNode]:
+        return [term for child in self.children for term in child.positive_terms()]
+
+
+class NotNode(QueryNode):
+    def __init__(self, child: QueryNode) -> None:
+        self.child = child
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        return [] if self.child.match(entry, locdb) is None else None
+
+    def cost(self) -> int:
+        return self.child.cost()
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        # The index only returns a superset of the matching entries, so it cannot be
+        # used to find the entries that don't match.
+        return None
+
+    def fields_used(self) -> Set[str]:
+        return self.child.fields_used()
+
+    def terms(self) -> List[QueryNode]:
+        return self.child.terms()
+
+    def positive_terms(self) -> List[QueryNode]:
+        return []
+
+
+class SearchTerm(QueryNode):
+    """
+    A single compiled search term, such as 'DeLillo' or 'kw:postmodernist'.
+    """
+
+    # Relative costs of matching a term against each field, for the query planner.
+    COSTS = {
+        "type": 1,
+        "year": 1,
+        "language": 2,
+        "locations": 2,
+        "filename": 3,
+        "title": 3,
+        "creator": 3,
+        "characters": 4,
+        "keywords": 4,
+        "settings": 4,
+        "plot_summary": 20,
+        "notes": 20,
+        "quotes": 20,
+    }
+
+    def __init__(self, field: str, term: str) -> None:
+        """
+        Args:
+          field: The (resolved) field that the term is scoped to, or the empty string
+            if the term is not scoped to a field.
+          term: The text of the term itself.
+        """
+        self.field = field
+        self.term = term
+        self.fields = (field,) if field else BARE_FIELDS
+        self.tokens = tokenize(term)
+        self.pattern = re.compile(r"\b" + re.escape(term) + r"\b", flags=re.IGNORECASE)
+        # The values of these fields are single words, so a word-boundary match is the
+        # same as a case-insensitive comparison of the whole value.
+        self.exact = field in ("type", "year") and term != ""
+        self.folded_term = term.casefold()
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        if self.exact:
+            value = getattr(entry, self.field)
+            if value and str(value).casefold() == self.folded_term:
+                return [f"{self.field}: matched text ({value})"]
+            else:
+                return None
+
+        matches: List[str] = []
+        for field in self.fields:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            if field == "locations":
+                matches.extend(match_location(value, self.term, locdb))
+            elif isinstance(value, list):
+                for subvalue in value:
+                    if self.pattern.search(subvalue.keyword):
+                        matches.append(f"{field}: matched keyword ({subvalue.keyword})")
+            elif self.pattern.search(str(value)):
+                matches.append(f"{field}: matched text ({value})")
+
+        return matches or None
+
+    def cost(self) -> int:
+        return sum(self.COSTS[field] for field in self.fields)
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        return index.lookup_term(self)
+
+    def fields_used(self) -> Set[str]:
+        return set(self.fields)
+
+    def terms(self) -> List[QueryNode]:
+        return [self]
+
+    def positive_terms(self) -> List[QueryNode]:
+        return [self]
+
+
+class TextTerm(QueryNode):
+    """
+    A search term over the longform fields, such as 'notes:oswald'.
+
+    Unlike `SearchTerm`, the text is matched word by word, ignoring punctuation and
+    line breaks. A term of several words matches them as a phrase, unless it ends with a
+    proximity suffix, e.g. 'notes:"kennedy oswald"~10', in which case it matches if
+    all the words occur, in any order, within that many words of one another.
+
+    The field may be 'text' to search all of the longform fields.
+    """
+
+    def __init__(self, field: str, term: str) -> None:
+        self.field = field
+        self.term = term
+        self.fields = TEXT_FIELDS if field == "text" else (field,)
+
+        self.proximity: Optional[int] = None
+        m = re.match(r"^(.*)~([0-9]+)$", term)
+        if m:
+            term = m.group(1)
+            self.proximity = int(m.group(2))
+
+        if len(term) >= 2 and term.startswith('"') and term.endswith('"'):
+            term = term[1:-1]
+
+        self.tokens = tokenize(term)
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        matches = []
+        for field in self.fields:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            if not self.tokens:
+                matches.append(f"{field}: matched text")
+                continue
+
+            offsets = [m.span() for m in re.finditer(r"\w+", value)]
+            tokens = [value[start:end].casefold() for start, end in offsets]
+            for first, last in self.find_hits(tokens)[:SNIPPETS_PER_FIELD]:
+                snippet = make_snippet(value, offsets[first][0], offsets[last][1])
+                matches.append(f"{field}: matched text ({snippet})")
+
+        return matches or None
+
+    def find_hits(self, tokens: List[str]) -> List[Tuple[int, int]]:
+        """
+        Returns the (first, last) token positions of each hit of the term in the list of
+        tokens.
+        """
+        n = len(self.tokens)
+        if self.proximity is None:
+            return [
+                (i, i + n - 1)
+                for i in range(len(tokens) - n + 1)
+                if tokens[i : i + n] == self.tokens
+            ]
+
+        # Slide a window over the occurrences of the words, and report each window in
+        # which all of the words occur close enough together.
+        words = set(self.tokens)
+        occurrences = [(i, token) for i, token in enumerate(tokens) if token in words]
+        counts: Dict[str, int] = defaultdict(int)
+        hits: List[Tuple[int, int]] = []
+        start = 0
+        for end, (position, token) in enumerate(occurrences):
+            counts[token] += 1
+            while position - occurrences[start][0] > self.proximity:
+                counts[occurrences[start][1]] -= 1
+                start += 1
+
+            if all(counts[word] > 0 for word in words):
+                if not hits or hits[-1][1] < occurrences[start][0]:
+                    hits.append((occurrences[start][0], position))
+
+        return hits
+
+    def cost(self) -> int:
+        return 20 * len(self.fields)
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        return index.lookup_text(self)
+
+    def fields_used(self) -> Set[str]:
+        return set(self.fields)
+
+    def terms(self) -> List[QueryNode]:
+        return [self]
+
+    def positive_terms(self) -> List[QueryNode]:
+        return [self]
+
+
+class FuzzyTerm(QueryNode):
+    """
+    A typo-tolerant search term, such as '~Dostoevsky' or 'creator:~Dostoevsky'.
+
+    Each word of the term matches any word of the field whose trigram similarity to it
+    (see `trigram_similarity`) is at least `FUZZY_THRESHOLD`, so that misspellings and
+    variant transliterations still match. An entry matches if every word of the term
+    matches some word of the entry. Only the `FUZZY_FIELDS` can be searched this way.
+    """
+
+    def __init__(self, field: str, term: str) -> None:
+        if field and field not in FUZZY_FIELDS:
+            raise ValueError(
+                f"fuzzy search is only supported on: {', '.join(FUZZY_FIELDS)}"
+            )
+
+        self.field = field
+        self.term = term
+        self.fields = (field,) if field else FUZZY_FIELDS
+        self.tokens = tokenize(term)
+        if not self.tokens:
+            raise ValueError(f"fuzzy search term {term!r} has no words")
+
+        self.trigrams = [trigrams(token) for token in self.tokens]
+        # Maps each word that the term has been compared to to its similarity to each
+        # word of the term, since the same words recur across many entries.
+        self.similarities: Dict[str, List[float]] = {}
+        # Whether an index has found all the words similar to the term (see
+        # `add_similar_words`), so that any other word is known to be dissimilar.
+        self.exhaustive = False
+
+    def match(self, entry: Entry, locdb: LocationDatabase) -> Optional[List[str]]:
+        best, matches = self.compare(entry)
+        if min(best) < FUZZY_THRESHOLD:
+            return None
+
+        return matches
+
+    def score(self, entry: Entry) -> float:
+        """
+        Returns the average, over the words of the term, of the similarity of the most
+        similar word in the entry, or 0 if the entry does not match.
+        """
+        best, _ = self.compare(entry)
+        if min(best) < FUZZY_THRESHOLD:
+            return 0.0
+
+        return sum(best) / len(best)
+
+    def compare(self, entry: Entry) -> Tuple[List[float], List[str]]:
+        """
+        Returns the highest similarity of any word in the entry to each word of the
+        term, and the match descriptions of the values that are similar to the term.
+        """
+        best = [0.0] * len(self.tokens)
+        matches = []
+        for field in self.fields:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            if isinstance(value, list):
+                subvalues = [(k.keyword, "keyword") for k in value]
+            else:
+                subvalues = [(str(value), "text")]
+
+            for subvalue, kind in subvalues:
+                similar = False
+                for word in tokenize(subvalue):
+                    similarities = self.similarities.get(word)
+                    if similarities is None:
+                        if self.exhaustive:
+                            continue
+
+                        word_trigrams = trigrams(word)
+                        similarities = [
+                            trigram_similarity(word_trigrams, token_trigrams)
+                            for token_trigrams in self.trigrams
+                        ]
+                        self.similarities[word] = similarities
+
+                    for i, similarity in enumerate(similarities):
+                        if similarity >= FUZZY_THRESHOLD:
+                            similar = True
+                            best[i] = max(best[i], similarity)
+
+                if similar:
+                    matches.append(f"{field}: fuzzy matched {kind} ({subvalue})")
+
+        return (best, matches)
+
+    def add_similar_words(self, i: int, words: Dict[str, float]) -> None:
+        """
+        Records the words found by an index to be similar to the i'th word of the term.
+
+        Once this has been called for every word of the term, the term is only matched
+        against entries from the same index, which contains every word of those entries,
+        so words that the index did not find can be skipped.
+        """
+        for word, similarity in words.items():
+            similarities = self.similarities.setdefault(word, [0.0] * len(self.tokens))
+            similarities[i] = similarity
+
+        if i == len(self.tokens) - 1:
+            self.exhaustive = True
+
+    def cost(self) -> int:
+        return 5 * len(self.fields)
+
+    def candidates(self, index: CandidateIndex) -> Optional[Set[Any]]:
+        return index.lookup_fuzzy(self)
+
+    def fields_used(self) -> Set[str]:
+        return set(self.fields)
+
+    def terms(self) -> List[QueryNode]:
+        return [self]
+
+    def positive_terms(self) -> List[QueryNode]:
+        return [self]
+
+
+# The maximum number of hits in a single longform field to describe.
+SNIPPETS_PER_FIELD = 3
+# The number of characters of context to show on either side of a hit.
+SNIPPET_CONTEXT = 30
+
+
+def make_snippet(text: str, start: int, end: int) -> str:
+    """
+    Returns the text from `start` to `end` with a little context on either side, for
+    display to the user.
+    """
+    snippet_start = max(0, start - SNIPPET_CONTEXT)
+    snippet_end = min(len(text), end + SNIPPET_CONTEXT)
+    # Avoid cutting words in half.
+    while snippet_start < start and not text[snippet_start - 1].isspace():
+        snippet_start += 1
+    while end < snippet_end < len(text) and not text[snippet_end].isspace():
+        snippet_end -= 1
+
+    snippet = " ".join(text[snippet_start:snippet_end].split())
+    prefix = "..." if snippet_start > 0 else ""
+    suffix = "..." if snippet_end < len(text) else ""
+    return prefix + snippet + suffix
+
+
+def match_location(
+    locations: List["KeywordField"], search_term: str, locdb: LocationDatabase
+) -> List[str]:
+    """
+    Returns a match if any of the locations is or is enclosed by the search term.
+    """
+    for location in locations:
+        if location.keyword == search_term or search_term in locdb.get(
+            location.keyword, ()
+        ):
+            return [f"location: matched ({location.keyword})"]
+
+    return []
+
+
+def compile_locations(hierarchy: Dict[str, List[str]]) -> LocationDatabase:
+    """
+    Computes the transitive closure of the location hierarchy.
+
+    `hierarchy` maps each location to the list of locations that directly enclose it,
+    as in `locations.json`.
+
+    Raises an `OeuvreError` if the hierarchy contains a cycle.
+    """
+    locdb: Dict[str, FrozenSet[str]] = {}
+    for root in hierarchy:
+        if root in locdb:
+            continue
+
+        # Iterative depth-first search, so that deep hierarchies cannot overflow the
+        # stack. `path` holds the chain of locations currently being visited.
+        path = [root]
+        stack = [iter(hierarchy.get(root, []))]
+        while stack:
+            for parent in stack[-1]:
+                if parent in path:
+                    cycle = path[path.index(parent) :] + [parent]
+                    raise OeuvreError(
+                        "cycle in location database: " + " -> ".join(cycle)
+                    )
+
+                if parent not in locdb:
+                    path.append(parent)
+                    stack.append(iter(hierarchy.get(parent, [])))
+                    break
+            else:
+                location = path.pop()
+                stack.pop()
+                enclosing: Set[str] = set()
+                for parent in hierarchy.get(location, []):
+                    enclosing.add(parent)
+                    enclosing.update(locdb[parent])
+                locdb[location] = frozenset(enclosing)
+
+    return locdb
+
+
+# All the fields of `Entry` which can be searched.
+FIELDS = (
+    "title",
+    "type",
+    "filename",
+    "creator",
+    "year",
+    "language",
+    "plot_summary",
+    "characters",
+    "locations",
+    "keywords",
+    "settings",
+    "quotes",
+    "notes",
+)
+# The fields which are searched by bare search terms.
+BARE_FIELDS = (
+    "filename",
+    "title",
+    "creator",
+    "characters",
+    "locations",
+    "keywords",
+    "settings",
+)
+# The fields which are indexed by `SearchIndex`, apart from 'locations'.
+INDEXED_FIELDS = ("filename", "title", "creator", "characters", "keywords", "settings")
+# The longform fields, which are searched word by word (see `TextTerm`).
+TEXT_FIELDS = ("plot_summary", "notes", "quotes")
+# The fields whose values are lists of `KeywordField` objects.
+LIST_FIELDS = ("characters", "locations", "keywords", "settings")
+# The single-line fields, which are checked by `validate_field`.
+SCALAR_FIELDS = ("title", "type", "creator", "language", "year")
+# The fields which can be searched by fuzzy search terms (see `FuzzyTerm`).
+FUZZY_FIELDS = ("title", "creator", "characters")
+# The trigram similarity at or above which two words are considered alike. This is the
+# same as the default threshold of PostgreSQL's pg_trgm module.
+FUZZY_THRESHOLD = 0.3
+# The fields whose tokens are stored in the SQLite mirror (see `SqliteMirror`).
+SQLITE_TOKEN_FIELDS = INDEXED_FIELDS + ("type", "year", "language")
+
+
+class SearchIndex:
+    """
+    An inverted index from tokens to entries, used by the resident database of `oeuvre
+    serve` to narrow down the entries that a search needs to look at. (A one-shot search
+    looks at every entry only once, so building an index would not pay for itself; only
+    its fuzzy terms are looked up in the `TrigramVocabulary` kept with the cache. See
+    `Application.filter_entries`.)
+
+    The index maps each case-folded word token in the `INDEXED_FIELDS` of each entry to
+    the set of keys of the entries it occurs in. Locations are indexed under both their
+    own name and the names of all their enclosing locations.
+
+    If `positional` is true, the index also maps each token in the `TEXT_FIELDS` to the
+    positions at which it occurs in each entry, so that phrases can be looked up
+    without scanning the text of every entry.
+
+    For fuzzy search terms, the index also maps each trigram (see `trigrams`) to the
+    words of the `FUZZY_FIELDS` that contain it, so that the words similar to a search
+    term can be found without comparing the term to every word. This part of the index
+    is only built when it is first needed.
+
+    The index only finds candidates: any entry that matches a search term is guaranteed
+    to be among the candidates for that term, but not every candidate necessarily
+    matches. `match` should still be called on the candidates to check for a match and
+    to produce the match descriptions.
+    """
+
+    def __init__(self, locdb: LocationDatabase, *, positional: bool = False) -> None:
+        self.locdb = locdb
+        self.positional = positional
+        self.postings: Dict[str, Dict[str, Set[Any]]] = {
+            field: defaultdict(set) for field in INDEXED_FIELDS
+        }
+        self.location_postings: Dict[str, Set[Any]] = defaultdict(set)
+        self.text_postings: Dict[str, Dict[str, Dict[Any, List[int]]]] = {
+            field: defaultdict(dict) for field in TEXT_FIELDS
+        }
+        # Words are not removed from the trigram index when the entries they occur in
+        # are removed, since a word that no longer occurs maps to no entries anyway.
+        self.vocabulary: Optional[TrigramVocabulary] = None
+
+    def add(self, key: Any, entry: Entry) -> None:
+        """
+        Adds the entry to the index under the given key.
+        """
+        for field in INDEXED_FIELDS:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            postings = self.postings[field]
+            fuzzy = self.vocabulary is not None and field in FUZZY_FIELDS
+            subvalues = (
+                [k.keyword for k in value] if isinstance(value, list) else [value]
+            )
+            for subvalue in subvalues:
+                tokens = tokenize(str(subvalue))
+                for token in tokens:
+                    postings[token].add(key)
+
+                if fuzzy:
+                    assert self.vocabulary is not None
+                    self.vocabulary.add_words(tokens)
+
+        for location in entry.locations:
+            self.location_postings[location.keyword].add(key)
+            for enclosing in self.locdb.get(location.keyword, ()):
+                self.location_postings[enclosing].add(key)
+
+        if self.positional:
+            for field in TEXT_FIELDS:
+                text = getattr(entry, field)
+                if not text:
+                    continue
+
+                text_postings = self.text_postings[field]
+                for position, token in enumerate(tokenize(text)):
+                    text_postings[token].setdefault(key, []).append(position)
+
+    def remove(self, key: Any, entry: Entry) -> None:
+        """
+        Removes the entry, which must have been added under the given key, from the
+        index.
+        """
+        for field in INDEXED_FIELDS:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            postings = self.postings[field]
+            subvalues = (
+                [k.keyword for k in value] if isinstance(value, list) else [value]
+            )
+            for subvalue in subvalues:
+                for token in tokenize(str(subvalue)):
+                    discard_posting(postings, token, key)
+
+        for location in entry.locations:
+            discard_posting(self.location_postings, location.keyword, key)
+            for enclosing in self.locdb.get(location.keyword, ()):
+                discard_posting(self.location_postings, enclosing, key)
+
+        if self.positional:
+            for field in TEXT_FIELDS:
+                text = getattr(entry, field)
+                if not text:
+                    continue
+
+                text_postings = self.text_postings[field]
+                for token in set(tokenize(text)):
+                    text_postings[token].pop(key, None)
+                    if not text_postings[token]:
+                        del text_postings[token]
+
+    def lookup(self, query: "Query") -> Optional[Set[Any]]:
+        """
+        Returns the keys of the candidate entries for the query, or None if the index
+        cannot narrow down the search.
+        """
+        if query.root is None:
+            return set()
+
+        return query.root.candidates(self)
+
+    def lookup_term(self, term: "SearchTerm") -> Optional[Set[Any]]:
+        """
+        Returns the keys of the candidate entries for a single search term, or None if
+        the index cannot narrow down the search.
+        """
+        if term.field == "locations":
+            return self.location_postings.get(term.term, set())
+
+        if term.field and term.field not in INDEXED_FIELDS:
+            return None
+
+        if not term.tokens:
+            return None
+
+        if term.field:
+            return self.lookup_tokens(term.field, term.tokens)
+
+        candidates = set(self.location_postings.get(term.term, set()))
+        for field in INDEXED_FIELDS:
+            candidates |= self.lookup_tokens(field, term.tokens)
+        return candidates
+
+    def lookup_text(self, term: "TextTerm") -> Optional[Set[Any]]:
+        """
+        Returns the keys of the candidate entries for a search term over the longform
+        fields, or None if the index cannot narrow down the search.
+        """
+        if not self.positional or not term.tokens:
+            return None
+
+        candidates: Set[Any] = set()
+        for field in term.fields:
+            text_postings = self.text_postings[field]
+            postings = [text_postings.get(token, {}) for token in term.tokens]
+            keys = set(postings[0])
+            for token_postings in postings[1:]:
+                keys &= token_postings.keys()
+
+            if term.proximity is None and len(term.tokens) > 1:
+                # Keep only the entries in which the words occur next to each other.
+                keys = {
+                    key
+                    for key in keys
+                    if any(
+                        all(
+                            start + i in token_postings[key]
+                            for i, token_postings in enumerate(postings)
+                        )
+                        for start in postings[0][key]
+                    )
+                }
+
+            candidates |= keys
+
+        return candidates
+
+    def lookup_fuzzy(self, term: "FuzzyTerm") -> Optional[Set[Any]]:
+        """
+        Returns the keys of the candidate entries for a fuzzy search term.
+        """
+        if self.vocabulary is None:
+            self.vocabulary = TrigramVocabulary()
+            for field in FUZZY_FIELDS:
+                self.vocabulary.add_words(self.postings[field])
+
+        candidates: Optional[Set[Any]] = None
+        for i, token_trigrams in enumerate(term.trigrams):
+            words = self.vocabulary.similar_words(token_trigrams)
+            term.add_similar_words(i, words)
+
+            keys: Set[Any] = set()
+            for word in words:
+                for field in term.fields:
+                    keys |= self.postings[field].get(word, set())
+
+            if candidates is None:
+                candidates = keys
+            else:
+                candidates &= keys
+
+        return candidates
+
+    def lookup_tokens(self, field: str, tokens: List[str]) -> Set[Any]:
+        """
+        Returns the keys of the entries whose field contains all of the tokens.
+        """
+        postings = self.postings[field]
+        candidates = set(postings.get(tokens[0], set()))
+        for token in tokens[1:]:
+            candidates &= postings.get(token, set())
+        return candidates
+
+
+def discard_posting(postings: Dict[str, Set[Any]], token: str, key: Any) -> None:
+    """
+    Removes the key from the token's posting list, and removes the posting list if it
+    is then empty.
+    """
+    keys = postings.get(token)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del postings[token]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits the text into case-folded word tokens.
+
+    A search term matches text only on word boundaries, so each token of a search term
+    must appear as a token of any text that it matches.
+    """
+    return [token.casefold() for token in re.findall(r"\w+", text)]
+
+
+def trigrams(word: str) -> Set[str]:
+    """
+    Returns the set of three-character substrings of the word, padded with two spaces
+    at the start and one at the end (as in PostgreSQL's pg_trgm module) so that words
+    which begin alike are more similar than words which end alike.
+    """
+    padded = "  " + word + " "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
 
-                try:
-                    new_entry = parse_entry(text)
-                except OeuvreError as e:
-                    e.path = old_entry.filename
-                    self.error(str(e), fatal=False)
-                    if not self.confirm("Try again? "):
-                        # Write back the original entry if the user gives up.
-                        old_text = old_entry.format_for_disk()
-                        with open(path, "w", encoding="utf-8") as f:
-                            f.write(old_text)
-                            f.write("\n")
-                        continue
-                    else:
-                        remaining_entries.append(old_entry)
-                else:
-                    all_keywords = set(k.keyword for k in new_entry.keywords)
-                    new_keywords = all_keywords - keywords
-                    if new_keywords:
-                        self.print(
-                            f"new keywords for {old_entry.filename}: "
-                            + f"{', '.join(sorted(new_keywords))}"
-                        )
+def trigram_similarity(trigrams1: Set[str], trigrams2: Set[str]) -> float:
+    """
+    Returns the similarity of two words, given their trigrams, as the fraction of all
+    of their trigrams that they share.
+    """
+    shared = len(trigrams1 & trigrams2)
+    return shared / (len(trigrams1) + len(trigrams2) - shared)
 
-                        if not self.confirm("Keep? "):
-                            remaining_entries.append(old_entry)
-                            continue
 
-                    # Call `format_for_disk` before opening the file for writing, so
-                    # that if there's an error the file is not wiped out.
-                    text = new_entry.format_for_disk()
-                    with open(path, "w", encoding="utf8") as f:
-                        f.write(text)
-                        f.write("\n")
+def similar_words(word_trigrams: Set[str], shared: Dict[str, int]) -> Dict[str, float]:
+    """
+    Returns the words that are alike (see `FUZZY_THRESHOLD`) to the word with the given
+    trigrams, mapped to their similarity to it, out of the words in `shared`, which maps
+    each word that has any trigrams in common with it to the number in common.
+    """
+    n = len(word_trigrams)
+    words = {}
+    for word, count in shared.items():
+        # The similarity can be at most count / n, which rules out most words without
+        # having to compute their trigrams.
+        if count < FUZZY_THRESHOLD * n:
+            continue
 
-                    save_count += 1
+        similarity = count / (n + len(trigrams(word)) - count)
+        if similarity >= FUZZY_THRESHOLD:
+            words[word] = similarity
 
-                    # Only print the entry if only one was opened for editing.
-                    if len(entries) == 1:
-                        self.print(
-                            new_entry.format_for_display(verbosity=VERBOSITY_FULL)
-                        )
+    return words
 
-            entries = remaining_entries
 
-        return save_count
+class TrigramVocabulary:
+    """
+    A set of words indexed by their trigrams (see `trigrams`), so that the words similar
+    to a fuzzy search term (see `FuzzyTerm`) can be found without comparing the term to
+    every word.
+
+    `SearchIndex` keeps a vocabulary of the words in its entries. The entry cache and the
+    packed snapshot each keep one of the words of the `FUZZY_FIELDS` of their entries,
+    so that one-shot searches can find similar words without building an index (see
+    `Application.filter_entries`).
+
+    The vocabulary is stored with `marshal` (see `dumps` and `loads`), so that it can be
+    saved with the entry cache and only decoded when a fuzzy search or a newly parsed
+    entry needs it.
+    """
 
-    def filter_entries(
+    def __init__(
         self,
-        entries: List[Entry],
-        search_terms: List[str],
-        *,
-        locdb: Dict[str, List[str]],
-    ) -> List[Tuple[Entry, List[str]]]:
+        words: Optional[Set[str]] = None,
+        postings: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        self.words: Set[str] = words if words is not None else set()
+        # Map from trigrams to the words that contain them.
+        self.postings: Dict[str, List[str]] = postings if postings is not None else {}
+
+    @classmethod
+    def loads(cls, data: bytes) -> "TrigramVocabulary":
         """
-        Filters the list of entries by the given search terms.
+        Decodes a vocabulary encoded by `dumps`. Empty data decodes to an empty
+        vocabulary.
 
-        Each element of the returned list is a pair (entry, matches).
+        Raises ValueError, EOFError or TypeError if the data is corrupt.
         """
-        ret = []
-        for entry in entries:
-            try:
-                matches = match(entry, search_terms, locdb=locdb)
-            except ValueError as e:
-                self.error(str(e))
+        import marshal
+
+        if not data:
+            return cls()
+
+        words, postings = marshal.loads(data)
+        if not isinstance(words, set) or not isinstance(postings, dict):
+            raise ValueError("not a vocabulary")
+        return cls(words, postings)
 
-            if matches:
-                ret.append((entry, matches))
-        return ret
+    def dumps(self) -> bytes:
+        import marshal
 
-    def read_entries(self, *, best_effort: bool = False) -> List[Entry]:
+        return marshal.dumps((self.words, self.postings))
+
+    def add_entry(self, entry: Entry) -> None:
         """
-        Returns a list of all entries in the database.
+        Adds the words of the entry's `FUZZY_FIELDS` to the vocabulary.
         """
-        entries = []
-        for path in sorted(glob.glob(self.directory + "/**/*.txt", recursive=True)):
-            if path.startswith(self.directory + "/editing/"):
+        for field in FUZZY_FIELDS:
+            value = getattr(entry, field)
+            if not value:
                 continue
 
-            with open(path, "r", encoding="utf8") as f:
-                text = f.read()
-
-            try:
-                entry = parse_entry(text)
-            except OeuvreError as e:
-                e.path = path
-                if best_effort:
-                    self.warning(str(e))
-                else:
-                    self.error(str(e))
+            if isinstance(value, list):
+                for subvalue in value:
+                    self.add_words(tokenize(subvalue.keyword))
             else:
-                entry.filename = path[len(self.directory) + 1 :]
-                entries.append(entry)
-
-        return entries
+                self.add_words(tokenize(str(value)))
 
-    def format_title_for_display(self, entry: Entry, *, color: bool) -> str:
+    def add_words(self, words: Iterable[str]) -> None:
         """
-        Returns a string representation of the entry's title.
+        Adds the words to the vocabulary, if they are not already in it.
         """
-        title = self.blue(entry.title) if color else entry.title
-        creator_suffix = f" ({entry.creator})" if entry.creator else ""
-        filename_suffix = f" [{entry.filename}]" if entry.filename else ""
-        return title + creator_suffix + filename_suffix
-
-    def print(self, *args, **kwargs) -> None:
-        kwargs.setdefault("file", self.stdout)
-        print(*args, **kwargs)
-
-    def error(self, message: str, *, fatal: bool = True) -> None:
-        print(f"error: {message}", file=self.stderr)
-        if fatal:
-            sys.exit(1)
+        for word in words:
+            if word not in self.words:
+                self.words.add(word)
+                for trigram in trigrams(word):
+                    self.postings.setdefault(trigram, []).append(word)
 
-    def warning(self, message: str) -> None:
-        print(f"warning: {message}", file=self.stderr)
+    def similar_words(self, word_trigrams: Set[str]) -> Dict[str, float]:
+        """
+        Returns the words in the vocabulary that are alike to the word with the given
+        trigrams, mapped to their similarity to it. See `similar_words`.
+        """
+        shared = Counter(
+            itertools.chain.from_iterable(
+                self.postings.get(trigram, ()) for trigram in word_trigrams
+            )
+        )
+        return similar_words(word_trigrams, shared)
 
-    def confirm(self, prompt: str) -> bool:
+    def find_similar_words(self, term: "FuzzyTerm") -> None:
         """
-        Prompts the user for confirmation and returns whether they accepted or not.
+        Records in the fuzzy search term the words of the vocabulary that are similar to
+        each of its words (see `FuzzyTerm.add_similar_words`).
+
+        The term must only be matched against entries whose words are all in the
+        vocabulary.
         """
-        while True:
-            print(prompt, end="", flush=True, file=self.stdout)
-            try:
-                yesno = self.stdin.readline()
-            except EOFError:
-                print(file=self.stdout)
-                return False
-            except KeyboardInterrupt:
-                print(file=self.stdout)
-                sys.exit(1)
+        for i, token_trigrams in enumerate(term.trigrams):
+            term.add_similar_words(i, self.similar_words(token_trigrams))
 
-            yesno = yesno.strip().lower()
-            if yesno.startswith("y"):
-                return True
-            elif yesno.startswith("n"):
-                return False
 
-    def blue(self, text: str) -> str:
-        """Returns a string that will display as blue using ANSI color codes."""
-        return self.color(text, "94")
+def collect_keywords(entries: List[Entry]) -> Set[str]:
+    """
+    Returns the set of all keywords on the entries in the given list.
+    """
+    keywords = set()
+    for entry in entries:
+        keywords.update([k.keyword for k in entry.keywords])
+    return keywords
 
-    def color(self, text: str, color: str) -> str:
-        return f"\033[{color}m{text}\033[0m" if self.use_colors else text
 
+# The fields that `oeuvre stats` can count entries by.
+STATS_FIELDS = ("type", "language", "creator", "year", "decade")
 
-def shell_editor(paths: List[str]) -> None:
-    editor = os.environ.get("EDITOR", "nano").split()
-    r = subprocess.run(editor + paths)
-    if r.returncode != 0:
-        raise OeuvreError(f"editor process exited with error code {r.returncode}")
 
+class EntryColumns:
+    """
+    The scalar fields of a list of entries stored column by column, for computing
+    aggregates with `oeuvre stats`.
 
-def match(
-    entry: Entry, search_terms: List[str], *, locdb: Dict[str, List[str]]
-) -> List[str]:
+    The `type`, `language` and `creator` columns hold a code for each entry (an index
+    into the column's list of labels, or -1 if the field is empty) and the `year` column
+    holds the year, or `MISSING_YEAR` if the field is empty. Keywords are stored as the
+    list of the rows (i.e., the positions of the entries) that have each keyword.
+
+    If NumPy is installed, the columns are NumPy arrays and aggregates are computed with
+    vectorized NumPy operations. Otherwise, they are `array`s and aggregates are computed
+    with `Counter`, which is slower but still a single pass in C over each column.
     """
-    Returns a list of matches.
 
-    Each match is a string with a description of the match that is meant to be displayed
-    to the user.
+    CODED_FIELDS = ("type", "language", "creator")
+    MISSING_YEAR = -(2**63)
 
-    If the list is empty, then the entry doesn't match the search terms.
+    def __init__(self, entries: Iterable[Entry], *, use_numpy: bool = True) -> None:
+        self.numpy: Any = None
+        if use_numpy:
+            try:
+                import numpy  # type: ignore
+
+                self.numpy = numpy
+            except ImportError:
+                pass
+
+        codes: Dict[str, List[int]] = {field: [] for field in self.CODED_FIELDS}
+        self.labels: Dict[str, List[str]] = {field: [] for field in self.CODED_FIELDS}
+        label_codes: Dict[str, Dict[str, int]] = {
+            field: {} for field in self.CODED_FIELDS
+        }
+        years = []
+        keyword_rows: Dict[str, List[int]] = defaultdict(list)
+        for row, entry in enumerate(entries):
+            for field in self.CODED_FIELDS:
+                value = getattr(entry, field)
+                if value:
+                    code = label_codes[field].get(value)
+                    if code is None:
+                        code = label_codes[field][value] = len(self.labels[field])
+                        self.labels[field].append(value)
+                    codes[field].append(code)
+                else:
+                    codes[field].append(-1)
 
-    Search terms are joined by an implicit AND operator.
-    """
-    matches: List[str] = []
-    for search_term in search_terms:
-        search_field, term = split_term(search_term)
-        before = len(matches)
-        if search_field:
-            search_field = resolve_alias(search_field)
-            if not hasattr(entry, search_field):
-                raise ValueError(f"unknown field {search_field!r}")
-
-            matches.extend(
-                match_field(search_field, getattr(entry, search_field), term, locdb)
-            )
-        else:
-            matches.extend(match_field("filename", entry.filename, search_term, locdb))
-            matches.extend(match_field("title", entry.title, search_term, locdb))
-            matches.extend(match_field("creator", entry.creator, search_term, locdb))
-            matches.extend(
-                match_field("characters", entry.characters, search_term, locdb)
-            )
-            matches.extend(
-                match_field("locations", entry.locations, search_term, locdb)
-            )
-            matches.extend(match_field("keywords", entry.keywords, search_term, locdb))
-            matches.extend(match_field("settings", entry.settings, search_term, locdb))
+            # A blank year is parsed as an empty string rather than as None.
+            if isinstance(entry.year, int):
+                years.append(entry.year)
+            else:
+                years.append(self.MISSING_YEAR)
 
-        after = len(matches)
-        if before == after:
-            # No match.
-            return []
+            for keyword in entry.keywords:
+                rows = keyword_rows[keyword.keyword]
+                # Don't count an entry twice if it repeats a keyword.
+                if not rows or rows[-1] != row:
+                    rows.append(row)
+
+        self.size = len(years)
+        self.codes = {field: self.column(values) for field, values in codes.items()}
+        self.years = self.column(years)
+        self.keyword_rows = {
+            keyword: self.column(rows) for keyword, rows in keyword_rows.items()
+        }
+
+    def column(self, values: List[int]) -> Any:
+        """
+        Returns the list of integers as a column.
+        """
+        from array import array
 
-    return matches
+        if self.numpy is not None:
+            return self.numpy.array(values, dtype=self.numpy.int64)
+        else:
+            return array("q", values)
 
+    def rows_with_keyword(self, keyword: str) -> Any:
+        """
+        Returns the rows of the entries with the given keyword.
+        """
+        rows = self.keyword_rows.get(keyword)
+        return rows if rows is not None else self.column([])
 
-def match_field(
-    field: str,
-    value: Union[Optional[str], List["KeywordField"]],
-    search_term: str,
-    locdb: Dict[str, List[str]],
-) -> List[str]:
-    if not value:
-        return []
+    def count(self, field: str, *, rows: Any = None) -> Dict[Any, int]:
+        """
+        Returns the number of entries for each value of the field (one of
+        `STATS_FIELDS`), only counting the entries at `rows` if it is not None.
 
-    if field == "locations":
-        assert isinstance(value, list)
-        return match_location(value, search_term, locdb)
+        Entries for which the field is empty are not counted. The values of the `year`
+        and `decade` fields are integers.
+        """
+        if field in self.CODED_FIELDS:
+            values = self.select(self.codes[field], rows)
+            labels = self.labels[field]
+            if self.numpy is not None:
+                counts = self.numpy.bincount(values[values >= 0], minlength=len(labels))
+                return {labels[code]: int(n) for code, n in enumerate(counts) if n}
+            else:
+                counter = Counter(values)
+                counter.pop(-1, None)
+                return {labels[code]: n for code, n in counter.items()}
+        elif field in ("year", "decade"):
+            values = self.select(self.years, rows)
+            if self.numpy is not None:
+                values = values[values != self.MISSING_YEAR]
+                if field == "decade":
+                    values = values // 10 * 10
+                keys, counts = self.numpy.unique(values, return_counts=True)
+                return {int(key): int(n) for key, n in zip(keys, counts)}
+            else:
+                counter = Counter(values)
+                counter.pop(self.MISSING_YEAR, None)
+                if field == "decade":
+                    decades: Dict[Any, int] = defaultdict(int)
+                    for year, n in counter.items():
+                        decades[year // 10 * 10] += n
+                    return dict(decades)
+                return dict(counter)
+        else:
+            raise ValueError(f"cannot count entries by {field!r}")
 
-    pattern = re.compile(r"\b" + re.escape(search_term) + r"\b", flags=re.IGNORECASE)
-    if isinstance(value, list):
-        matches = []
-        for subvalue in value:
-            if pattern.search(subvalue.keyword):
-                matches.append(f"{field}: matched keyword ({subvalue.keyword})")
-        return matches
-    else:
-        if pattern.search(str(value)):
-            return [f"{field}: matched text ({value})"]
+    def select(self, column: Any, rows: Any) -> Any:
+        """
+        Returns the values of the column at `rows`, or the whole column if `rows` is
+        None.
+        """
+        if rows is None:
+            return column
+        elif self.numpy is not None:
+            return column[rows]
         else:
-            return []
+            return [column[row] for row in rows]
 
 
-def match_location(
-    locations: List["KeywordField"], search_term: str, locdb: Dict[str, List[str]]
-) -> List[str]:
+class KeywordSuggester:
     """
-    Returns True if any of the locations match the search term.
+    A class to suggest existing keywords that are close to a new keyword, so that the
+    same keyword is not entered in several different forms.
+
+    Keywords are compared by their normalized forms (see `normalize_keyword`), which
+    ignore case, spacing, hyphenation and plurals. Beyond that, keywords whose normalized
+    forms are one edit apart (an insertion, deletion, substitution or transposition of
+    adjacent characters) are suggested as possible typos.
+
+    Keywords one edit apart are found with a deletion-neighborhood index, which maps
+    every string obtained by deleting at most one character from a normalized form to
+    the keywords with that form. Any two strings one edit apart have a deletion in
+    common, so a lookup only has to check the deletions of the new keyword, however
+    many keywords there are.
     """
-    for location in locations:
-        if location.keyword == search_term:
-            return [f"location: matched ({location.keyword})"]
 
-        enclosing = get_enclosing_locations(locdb, location.keyword)
-        if search_term in enclosing:
-            return [f"location: matched ({location.keyword})"]
+    # The maximum number of suggestions for each keyword.
+    LIMIT = 3
+
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.forms: Dict[str, str] = {}
+        # Most deletions come from a single keyword, so rather than a set of keywords,
+        # which would make the index several times larger and slower to build, each
+        # deletion maps to its keywords joined by newlines, which keywords cannot
+        # contain.
+        self.index: Dict[str, str] = {}
+        for keyword in keywords:
+            form = normalize_keyword(keyword)
+            self.forms[keyword] = form
+            for deletion in deletions(form):
+                others = self.index.get(deletion)
+                self.index[deletion] = (
+                    keyword if others is None else others + "\n" + keyword
+                )
 
-    return []
+    def suggest(self, keyword: str) -> List[str]:
+        """
+        Returns the existing keywords that are close to the keyword, closest first.
+        """
+        form = normalize_keyword(keyword)
+        candidates: Set[str] = set()
+        for deletion in deletions(form):
+            keywords = self.index.get(deletion)
+            if keywords is not None:
+                candidates.update(keywords.split("\n"))
+
+        ranked = []
+        for candidate in candidates:
+            candidate_form = self.forms[candidate]
+            if candidate == keyword:
+                continue
+            elif candidate_form == form:
+                ranked.append((0, candidate))
+            elif within_one_edit(candidate_form, form):
+                ranked.append((1, candidate))
 
+        return [candidate for _, candidate in sorted(ranked)[: self.LIMIT]]
 
-def get_enclosing_locations(locdb: Dict[str, List[str]], location: str) -> List[str]:
+
+def normalize_keyword(keyword: str) -> str:
     """
-    Returns all locations that include the given location in the database.
+    Returns the form of the keyword used to compare it to other keywords: case-folded,
+    without spaces, hyphens or underscores, and with a plural ending turned into the
+    singular, e.g. 'Cold-Wars' becomes 'coldwar'.
     """
-    if location in locdb:
-        direct_enclosing = locdb[location]
-        indirect_enclosing = []
-        for enclosing in direct_enclosing:
-            indirect_enclosing.extend(get_enclosing_locations(locdb, enclosing))
-        return direct_enclosing + indirect_enclosing
+    form = re.sub(r"[\s_-]+", "", keyword.casefold())
+    if len(form) > 4 and form.endswith("ies"):
+        return form[:-3] + "y"
+    elif len(form) > 4 and form.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return form[:-2]
+    elif len(form) > 3 and form.endswith("s") and not form.endswith(("ss", "us")):
+        return form[:-1]
     else:
-        return []
+        return form
 
 
-def collect_keywords(entries: List[Entry]) -> Set[str]:
+def deletions(word: str) -> Set[str]:
     """
-    Returns the set of all keywords on the entries in the given list.
+    Returns the word and every string obtained by deleting one character from it.
     """
-    keywords = set()
-    for entry in entries:
-        keywords.update([k.keyword for k in entry.keywords])
-    return keywords
+    return {word} | {word[:i] + word[i + 1 :] for i in range(len(word))}
+
+
+def within_one_edit(word1: str, word2: str) -> bool:
+    """
+    Returns whether the words are equal or are one insertion, deletion, substitution or
+    transposition of adjacent characters apart.
+    """
+    if len(word1) < len(word2):
+        word1, word2 = word2, word1
+
+    if len(word1) - len(word2) > 1:
+        return False
+
+    i = 0
+    while i < len(word2) and word1[i] == word2[i]:
+        i += 1
+
+    if len(word1) != len(word2):
+        return word1[i + 1 :] == word2[i:]
+
+    return word1[i + 1 :] == word2[i + 1 :] or (
+        word1[i + 2 :] == word2[i + 2 :] and word1[i : i + 2] == word2[i : i + 2][::-1]
+    )
 
 
 def split_term(term: str) -> Tuple[str, str]:
@@ -586,12 +4561,13 @@ def resolve_alias(term: str) -> str:
     """
     Resolves search term aliases (e.g., 'loc' for 'locations').
     """
+    term = term.replace("-", "_")
     if term in ("loc", "location"):
         return "locations"
     elif term == "kw":
         return "keywords"
     elif term == "setting":
-        return "setting"
+        return "settings"
     elif term == "character":
         return "characters"
     else:
@@ -604,8 +4580,12 @@ class KeywordField:
     description.
     """
 
+    __slots__ = ("keyword", "description")
+
     def __init__(self, keyword: str, description: Optional[str]) -> None:
-        self.keyword = keyword
+        # The same keywords and locations occur in many entries, so intern them to keep
+        # only one copy of each.
+        self.keyword = sys.intern(keyword)
         self.description = description
 
     @classmethod
@@ -620,6 +4600,20 @@ class KeywordField:
 
         return cls(keyword, description)
 
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Unpickle through `__init__`, so that the keyword is interned in the process
+        # that unpickles it (see `Application.parse_files`).
+        return (KeywordField, (self.keyword, self.description))
+
+    def to_json(self) -> List[Optional[str]]:
+        return [self.keyword, self.description]
+
+    @classmethod
+    def from_json(cls, data: List[Optional[str]]) -> "KeywordField":
+        keyword, description = data
+        assert keyword is not None
+        return cls(keyword, description)
+
     def __bool__(self) -> bool:
         return bool(self.keyword or self.description)
 
@@ -686,6 +4680,8 @@ class EntryStringBuilder:
             self.lines.append(f"{field}: <hidden>")
             return
 
+        import textwrap
+
         self.lines.append(f"{field}:")
         for i, paragraph in enumerate(value.splitlines()):
             if i != 0:
@@ -721,6 +4717,8 @@ class EntryStringBuilder:
         if alphabetical:
             stringvalues = sorted(stringvalues)
 
+        import textwrap
+
         self.lines.append(f"{field}:")
         for value in stringvalues:
             if self.display:
@@ -744,74 +4742,197 @@ class EntryStringBuilder:
         return "\n".join(self.lines).strip("\n")
 
 
-def parse_entry(text: str) -> Entry:
+def parse_entry(text: str, *, fields: Optional[Set[str]] = None) -> Entry:
     """
     Reads a database entry from a string.
 
+    The text is read in a single forward pass over its lines. Each line is stripped at
+    most once, and the lines of longform and list fields are consumed in place by
+    `scan_longform_field` and `scan_list_field`.
+
+    If `fields` is not None, then the longform fields that are not in it are skipped
+    over rather than parsed, and are left empty in the returned entry. The entry is
+    validated in the same way regardless, since longform fields cannot be invalid.
+
     Raises an `OeuvreError` if the entry is incorrectly formatted.
     """
-    fields: Dict[str, Union[str, int, List["KeywordField"]]] = {}
-    lines = list(enumerate(text.splitlines(), start=1))
-    lines.reverse()
-
-    while lines:
-        lineno, line = lines[-1]
-        line = line.strip()
+    title = entry_type = creator = year = language = None
+    plot_summary = quotes = notes = None
+    characters = locations = keywords = settings = None
+
+    lines = text.splitlines()
+    n = len(lines)
+    i = 0
+    while i < n:
+        line = lines[i].strip()
+        i += 1
         if not line:
-            lines.pop()
             continue
 
-        if ":" not in line:
-            raise OeuvreError("expected field definition", lineno=lineno)
+        # `i` is now the 1-based number of the line being read.
+        field, colon, value = line.partition(":")
+        if not colon:
+            raise OeuvreError("expected field definition", lineno=i)
 
-        field, value = line.split(":", maxsplit=1)
-        field = field.strip().replace("-", "_")
+        field = field.rstrip().replace("-", "_")
         value = value.strip()
 
-        if field in ("plot_summary", "quotes", "notes"):
+        if field in LIST_FIELDS:
             if value:
-                raise OeuvreError("trailing content", lineno=lineno)
-
-            lines.pop()
-            fields[field] = parse_longform_field(lines)
-        elif field in ("characters", "locations", "keywords", "settings"):
+                raise OeuvreError("trailing content", lineno=i)
+
+            keyword_fields, i = scan_list_field(lines, i)
+            if field == "keywords":
+                keywords = keyword_fields
+            elif field == "characters":
+                characters = keyword_fields
+            elif field == "locations":
+                locations = keyword_fields
+            else:
+                settings = keyword_fields
+        elif field in TEXT_FIELDS:
             if value:
-                raise OeuvreError("trailing content", lineno=lineno)
+                raise OeuvreError("trailing content", lineno=i)
 
-            lines.pop()
-            fields[field] = parse_list_field(lines)
-        elif field in ("title", "type", "creator", "language", "year"):
-            lines.pop()
-            fields[field] = validate_field(field, value, lineno=lineno)
+            if fields is not None and field not in fields:
+                i = skip_longform_field(lines, i)
+                continue
+
+            longform, i = scan_longform_field(lines, i)
+            if field == "plot_summary":
+                plot_summary = longform
+            elif field == "notes":
+                notes = longform
+            else:
+                quotes = longform
+        elif field in SCALAR_FIELDS:
+            # `validate_field` only transforms the value of the 'year' field.
+            scalar = validate_field(field, value, lineno=i)
+            if field == "title":
+                title = value
+            elif field == "type":
+                entry_type = value
+            elif field == "creator":
+                creator = value
+            elif field == "year":
+                year = scalar
+            else:
+                language = value
         else:
-            raise OeuvreError(f"unknown field {field!r}", lineno=lineno)
+            raise OeuvreError(f"unknown field {field!r}", lineno=i)
+
+    if title is None:
+        raise OeuvreError("'title' field is required")
+    if entry_type is None:
+        raise OeuvreError("'type' field is required")
+
+    return Entry(
+        title=title,
+        type=entry_type,
+        creator=creator,
+        year=year,  # type: ignore
+        language=language,
+        plot_summary=plot_summary,
+        characters=characters,
+        locations=locations,
+        keywords=keywords,
+        settings=settings,
+        quotes=quotes,
+        notes=notes,
+    )
 
-    return Entry(**fields)  # type: ignore
 
+def parse_file(
+    path: str, *, fields: Optional[Set[str]] = None
+) -> Tuple[Optional[Entry], Optional["OeuvreError"], int]:
+    """
+    Reads and parses the entry at the given path.
 
-def parse_longform_field(lines: List[Tuple[int, str]]) -> str:
+    Returns an (entry, error, bytes read) triple. Exactly one of the entry and the error
+    is None (see `try_parse_entry`).
     """
-    Parses the value of a longform field.
+    with open(path, "rb") as f:
+        data = f.read()
 
-    `lines` should be a list of (line number, line) pairs in reverse order. This
-    function will remove all lines from the end of `lines` that it uses.
+    entry, error = try_parse_entry(data.decode("utf-8"), fields=fields)
+    return (entry, error, len(data))
+
+
+def try_parse_entry(
+    text: str, *, fields: Optional[Set[str]] = None
+) -> Tuple[Optional[Entry], Optional["OeuvreError"]]:
+    """
+    Parses the entry, returning an (entry, error) pair, exactly one of which is None.
+
+    The error is returned rather than raised so that this function can be used with a
+    process pool.
+    """
+    try:
+        return (parse_entry(text, fields=fields), None)
+    except OeuvreError as e:
+        return (None, e)
+
+
+def scan_longform_field(lines: List[str], start: int) -> Tuple[str, int]:
+    """
+    Parses the value of a longform field whose first line is `lines[start]`.
+
+    Returns the value and the index of the first line after the field.
     """
     paragraphs = []
-    while lines:
-        lineno, line = lines[-1]
+    end = skip_longform_field(lines, start)
+    for line in itertools.islice(lines, start, end):
+        if line:
+            paragraphs.append(line.strip())
 
-        if not line:
-            lines.pop()
-            continue
+    return ("\n".join(paragraphs), end)
+
+
+def skip_longform_field(lines: List[str], start: int) -> int:
+    """
+    Like `scan_longform_field`, but only returns the index of the first line after the
+    field, without building its value.
+    """
+    for i in range(start, len(lines)):
+        line = lines[i]
+        if line and not line.startswith(INDENT):
+            return i
+
+    return len(lines)
+
+
+def scan_list_field(lines: List[str], start: int) -> Tuple[List["KeywordField"], int]:
+    """
+    Parses the value of a list field whose first line is `lines[start]`.
 
+    Returns the value and the index of the first line after the field.
+    """
+    values = []
+    for line in itertools.islice(lines, start, None):
+        # This is also false for empty lines, which end the field.
         if not line.startswith(INDENT):
             break
 
-        lines.pop()
-        line = line.strip()
-        paragraphs.append(line)
+        if ":" in line:
+            keyword, _, description = line.partition(":")
+            values.append(KeywordField(keyword.strip(), description.strip()))
+        else:
+            values.append(KeywordField(line.strip(), None))
+
+    # Each line of the field is one value.
+    return (values, start + len(values))
+
+
+def parse_longform_field(lines: List[Tuple[int, str]]) -> str:
+    """
+    Parses the value of a longform field.
 
-    return "\n".join(paragraphs)
+    `lines` should be a list of (line number, line) pairs in reverse order. This
+    function will remove all lines from the end of `lines` that it uses.
+    """
+    value, end = scan_longform_field([line for _, line in reversed(lines)], 0)
+    del lines[len(lines) - end :]
+    return value
 
 
 def parse_list_field(lines: List[Tuple[int, str]]) -> List["KeywordField"]:
@@ -821,26 +4942,20 @@ def parse_list_field(lines: List[Tuple[int, str]]) -> List["KeywordField"]:
     `lines` should be a list of (line number, line) pairs in reverse order. This
     function will remove all lines from the end of `lines` that it uses.
     """
-    values = []
-    while lines:
-        lineno, line = lines[-1]
-
-        if not line or not line.startswith(INDENT):
-            break
+    values, end = scan_list_field([line for _, line in reversed(lines)], 0)
+    del lines[len(lines) - end :]
+    return values
 
-        description: Optional[str]
-        if ":" in line:
-            keyword, description = line.split(":", maxsplit=1)
-            keyword = keyword.strip()
-            description = description.strip()
-        else:
-            keyword = line.strip()
-            description = None
 
-        lines.pop()
-        values.append(KeywordField(keyword, description))
+def skipped_fields(fields: Optional[Set[str]]) -> FrozenSet[str]:
+    """
+    Returns the set of longform fields that `parse_entry` skips when it is passed
+    `fields`.
+    """
+    if fields is None:
+        return frozenset()
 
-    return values
+    return frozenset(field for field in TEXT_FIELDS if field not in fields)
 
 
 REQUIRED_FIELDS = {"title", "type"}
@@ -871,6 +4986,192 @@ def validate_field(field: str, value: str, *, lineno: int) -> Union[str, int]:
     return value
 
 
+class Ranker:
+    """
+    A class to score the entries that match a query by their relevance to it, for
+    `search --rank`.
+
+    Each term of the query that is not negated is scored in each field it searches
+    with BM25, which rewards frequent occurrences of rare words in short fields. The
+    field scores are weighted by `FIELD_WEIGHTS`, so that a match in the title counts
+    for more than one in the keywords, which counts for more than one in the filename,
+    and the total is scaled by the fraction of the terms that the entry matches.
+
+    BM25 needs the number of entries that each word occurs in and the average length
+    of each field. These are counted over the matching entries rather than the whole
+    database, so that ranking takes time in proportion to the number of matches. Since
+    any entry with a word of a term in a field that the term searches matches the term,
+    the counts are usually close to those of the whole database.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    FIELD_WEIGHTS = {
+        "title": 3.0,
+        "creator": 2.0,
+        "characters": 1.5,
+        "keywords": 1.5,
+        "settings": 1.0,
+        "locations": 1.0,
+        "plot_summary": 1.0,
+        "notes": 0.5,
+        "quotes": 0.5,
+        "filename": 0.5,
+        "type": 0.2,
+        "year": 0.2,
+        "language": 0.2,
+    }
+
+    def __init__(self, query: "Query", *, locdb: LocationDatabase) -> None:
+        self.terms = query.positive_terms()
+        self.locdb = locdb
+        # The fields and words that BM25 is computed over.
+        self.fields = sorted(
+            {
+                field
+                for term in self.terms
+                if isinstance(term, (SearchTerm, TextTerm))
+                for field in term.fields
+                if field != "locations"
+            }
+        )
+        self.words = {
+            token
+            for term in self.terms
+            if isinstance(term, (SearchTerm, TextTerm))
+            for token in term.tokens
+        }
+        # Keywords recur across many entries, so the words of each are counted once.
+        self.keyword_words: Dict[str, Tuple[int, List[str]]] = {}
+
+    def top(
+        self, matching: List[Tuple[Entry, List[str]]], k: int
+    ) -> List[Tuple[Entry, List[str]]]:
+        """
+        Returns the `k` most relevant of the matching entries, most relevant first.
+
+        Entries that are equally relevant are kept in the order they were given in.
+        """
+        counts = [self.count_words(entry) for entry, _ in matching]
+
+        frequencies: Dict[Tuple[str, str], int] = defaultdict(int)
+        total_lengths: Dict[str, int] = defaultdict(int)
+        for entry_counts in counts:
+            for field, (length, field_counts) in entry_counts.items():
+                total_lengths[field] += length
+                for word in field_counts:
+                    frequencies[(field, word)] += 1
+
+        n = len(matching)
+        idf = {
+            key: math.log(1 + (n - frequency + 0.5) / (frequency + 0.5))
+            for key, frequency in frequencies.items()
+        }
+        average_lengths = {
+            field: total / n for field, total in total_lengths.items() if total
+        }
+
+        scores = [
+            self.score(entry, entry_counts, idf, average_lengths)
+            for (entry, _), entry_counts in zip(matching, counts)
+        ]
+        best = heapq.nlargest(k, range(n), key=scores.__getitem__)
+        return [matching[i] for i in best]
+
+    def count_words(self, entry: Entry) -> Dict[str, Tuple[int, Dict[str, int]]]:
+        """
+        Returns the length in words of each of the fields of the entry that BM25 is
+        computed over, and the number of occurrences of each of the query's words in
+        the field.
+        """
+        counts = {}
+        for field in self.fields:
+            value = getattr(entry, field)
+            if not value:
+                continue
+
+            field_counts: Dict[str, int] = {}
+            if isinstance(value, list):
+                length = 0
+                for subvalue in value:
+                    keyword_length, words = self.count_keyword_words(subvalue.keyword)
+                    length += keyword_length
+                    for word in words:
+                        field_counts[word] = field_counts.get(word, 0) + 1
+            else:
+                tokens = tokenize(str(value))
+                length = len(tokens)
+                for token in tokens:
+                    if token in self.words:
+                        field_counts[token] = field_counts.get(token, 0) + 1
+
+            counts[field] = (length, field_counts)
+
+        return counts
+
+    def count_keyword_words(self, keyword: str) -> Tuple[int, List[str]]:
+        """
+        Returns the length in words of the keyword, and its words that are in the
+        query.
+        """
+        try:
+            return self.keyword_words[keyword]
+        except KeyError:
+            tokens = tokenize(keyword)
+            words = [token for token in tokens if token in self.words]
+            result = self.keyword_words[keyword] = (len(tokens), words)
+            return result
+
+    def score(
+        self,
+        entry: Entry,
+        counts: Dict[str, Tuple[int, Dict[str, int]]],
+        idf: Dict[Tuple[str, str], float],
+        average_lengths: Dict[str, float],
+    ) -> float:
+        """
+        Returns the relevance of the entry, given the word counts from `count_words`
+        and the statistics computed from them.
+        """
+        total = 0.0
+        matched = 0
+        for term in self.terms:
+            term_score = 0.0
+            if isinstance(term, FuzzyTerm):
+                weight = max(self.FIELD_WEIGHTS[field] for field in term.fields)
+                term_score = weight * term.score(entry)
+            elif isinstance(term, (SearchTerm, TextTerm)):
+                for field in term.fields:
+                    if field == "locations":
+                        if match_location(entry.locations, term.term, self.locdb):
+                            term_score += self.FIELD_WEIGHTS[field]
+                        continue
+
+                    length, field_counts = counts.get(field, (0, {}))
+                    if not field_counts:
+                        continue
+
+                    norm = self.K1 * (
+                        1 - self.B + self.B * length / average_lengths[field]
+                    )
+                    for token in term.tokens:
+                        frequency = field_counts.get(token, 0)
+                        if frequency:
+                            term_score += (
+                                self.FIELD_WEIGHTS[field]
+                                * idf[(field, token)]
+                                * frequency
+                                * (self.K1 + 1)
+                                / (frequency + norm)
+                            )
+
+            if term_score > 0:
+                matched += 1
+                total += term_score
+
+        return total * matched / len(self.terms) if self.terms else 0.0
+
+
 def alphabetical_key(match_pair: Tuple[Entry, List[str]]) -> str:
     """
     Key for sort functions to sort entries alphabetically.
@@ -904,6 +5205,10 @@ class OeuvreError(Exception):
 
 
 if __name__ == "__main__":
+    status = forward_to_server(OEUVRE_DIRECTORY, sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
     app = Application(
         OEUVRE_DIRECTORY,
         stdout=sys.stdout,
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for oeuvre on synthetic databases.
+
+Usage:
+
+  python3 oeuvre_bench.py --sizes 1000,10000 --output bench.jsonl
+
+Each benchmark result is written as a line of JSON, tagged with the current git commit,
+so that results from different commits can be compared.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+from typing import Any, Callable, Dict, IO, List, Optional
+
+from oeuvre import (
+    Application,
+    Entry,
+    EntryColumns,
+    KeywordField,
+    Ranker,
+    TYPE_CHOICES,
+    VERBOSITY_FULL,
+    compile_query,
+    parse_entry,
+    shell_editor,
+)
+
+
+WORDS = """
+    abandon account across action address affair afternoon against agent alone
+    anger animal answer apartment argue army arrest artist attack autumn balance
+    bank battle beach beauty bedroom belief betray bird blood border bottle bread
+    bridge brother budget burden captain career castle cause ceiling century chair
+    chance change child church circle citizen city claim class clock coast colony
+    comfort company conflict control corner council country courage court crime
+    crisis crowd culture danger daughter death debt decade defeat desert desire
+    detail dinner disease doctor dream duty economy editor empire enemy energy
+    escape estate evening evidence exile factory failure faith family farmer father
+    fear fever field figure film fire flight forest fortune freedom friend future
+    garden ghost glass government grief guard guest harbor health heart history
+    honor horse hospital hotel hunger husband idea illness island journey judge
+    justice kingdom kitchen labor language lawyer leader letter liberty light
+    machine madness marriage memory message minister mirror money morning mother
+    mountain murder music nation nature network night novel ocean officer order
+    painter palace paper party passion patient peace people period person picture
+    plan poet police power prison promise property question railway reason rebel
+    religion revolution river road room ruin sailor school science season secret
+    servant shadow ship silence sister soldier son spirit spring station story
+    stranger street student summer surface teacher theater theory thief village
+    violence voice war water wealth weapon widow wife window winter witness woman
+    worker world writer youth
+""".split()
+
+
+class BenchmarkRunner:
+    """
+    A class to run benchmarks and record their results.
+    """
+
+    def __init__(self, *, repeat: int, output: IO) -> None:
+        self.repeat = repeat
+        self.output = output
+        self.commit = get_git_commit()
+
+    def run(
+        self, name: str, size: int, f: Callable[[], Any], *, setup=None, **extra
+    ) -> None:
+        """
+        Runs `f` `self.repeat` times and records the best time.
+
+        If `setup` is given, it is called before each run of `f` and is not timed.
+        """
+        timings = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+
+            start = time.perf_counter()
+            f()
+            timings.append(time.perf_counter() - start)
+
+        self.record(
+            name,
+            size,
+            best_seconds=min(timings),
+            mean_seconds=sum(timings) / len(timings),
+            repeat=self.repeat,
+            **extra,
+        )
+        print(f"{name:<30} size={size:<8} best={min(timings):.4f}s", file=sys.stderr)
+
+    def measure_memory(self, name: str, size: int, f: Callable[[], Any]) -> None:
+        """
+        Records the memory retained by the return value of `f`, and the peak memory
+        allocated while calling it.
+        """
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = f()
+            gc.collect()
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        del result
+        self.record(name, size, retained_bytes=retained, peak_bytes=peak)
+        print(
+            f"{name:<30} size={size:<8} retained={retained / 2 ** 20:.1f}MiB",
+            file=sys.stderr,
+        )
+
+    def record(self, name: str, size: int, **extra) -> None:
+        result: Dict[str, Any] = {
+            "benchmark": name,
+            "size": size,
+            "commit": self.commit,
+            "python": platform.python_version(),
+        }
+        result.update(extra)
+        print(json.dumps(result), file=self.output, flush=True)
+
+
+def benchmark_database(runner: BenchmarkRunner, size: int, *, seed: int) -> None:
+    """
+    Runs all the benchmarks on a synthetic database of the given size.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        generate_database(directory, size, seed=seed)
+        app = make_application(directory)
+
+        def clear_cache():
+            try:
+                os.remove(os.path.join(directory, ".oeuvre-cache"))
+            except FileNotFoundError:
+                pass
+
+        runner.run("list_entry_paths", size, app.list_entry_paths)
+
+        app.use_cache = False
+        runner.run("read_entries", size, app.read_entries)
+        runner.measure_memory("read_entries_memory", size, app.read_entries)
+
+        app.use_cache = True
+        runner.run("read_entries_cold_cache", size, app.read_entries, setup=clear_cache)
+        app.read_entries()
+        runner.run("read_entries_warm_cache", size, app.read_entries)
+
+        # Reading through a packed snapshot, which replaces the cache while it exists.
+        app.use_pack = True
+        app.read_entries()
+        app.use_pack = False
+        runner.run("read_entries_packed", size, app.read_entries)
+        os.remove(os.path.join(directory, ".oeuvre.pack"))
+
+        texts = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".txt"):
+                with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                    texts.append(f.read())
+
+        nbytes = sum(len(text.encode("utf-8")) for text in texts)
+        runner.run(
+            "parse_entry", size, lambda: [parse_entry(t) for t in texts], bytes=nbytes
+        )
+
+        entries = app.read_entries()
+        for terms in (
+            ["war"],
+            ["kw:war"],
+            ["type:book", "kw:war"],
+            ["loc:country-0"],
+            ["kw:war", "OR", "kw:peace", "NOT", "type:film"],
+            ["text:revolution"],
+        ):
+            query = compile_query(terms)
+            runner.run(
+                "filter_entries",
+                size,
+                lambda: app.filter_entries(entries, query, locdb=app.locdb),
+                terms=terms,
+            )
+
+        # A broad query, so that most of the database has to be ranked.
+        query = compile_query(["kw:war", "OR", "kw:peace"])
+        matching = list(app.filter_entries(entries, query, locdb=app.locdb))
+        runner.run(
+            "rank",
+            size,
+            lambda: Ranker(query, locdb=app.locdb).top(matching, 20),
+            terms=["kw:war", "OR", "kw:peace"],
+            matches=len(matching),
+        )
+
+        runner.run(
+            "main_keywords",
+            size,
+            lambda: app.main_keywords(argparse.Namespace(sorted=True)),
+            setup=lambda: reset_output(app),
+        )
+        runner.run("entry_columns", size, lambda: EntryColumns(entries))
+        columns = EntryColumns(entries)
+        rows = columns.rows_with_keyword("war")
+        for field in ("type", "creator", "decade"):
+            runner.run("stats_count", size, lambda: columns.count(field), field=field)
+            runner.run(
+                "stats_count",
+                size,
+                lambda: columns.count(field, rows=rows),
+                field=field,
+                keyword="war",
+            )
+        runner.run(
+            "format_for_display",
+            size,
+            lambda: [e.format_for_display(verbosity=VERBOSITY_FULL) for e in entries],
+        )
+
+        def reformat_setup():
+            reset_output(app)
+            app.stdin = StringIO("yes\n")
+
+        runner.run(
+            "main_reformat",
+            size,
+            lambda: app.main_reformat(argparse.Namespace()),
+            setup=reformat_setup,
+        )
+
+
+def benchmark_parser(runner: BenchmarkRunner, *, seed: int) -> None:
+    """
+    Measures the throughput of `parse_entry`, in megabytes per second, on a set of
+    unusually large synthetic entries, so that the time is spent in the parser rather
+    than in per-entry overhead.
+    """
+    rng = random.Random(seed)
+    places = [f"city-{i}" for i in range(100)]
+    texts = [
+        make_entry(
+            rng,
+            places=places,
+            types=sorted(TYPE_CHOICES),
+            max_keywords=400,
+            max_locations=100,
+            max_paragraphs=40,
+        ).format_for_disk()
+        for _ in range(200)
+    ]
+    nbytes = sum(len(text.encode("utf-8")) for text in texts)
+
+    for name, fields in (
+        ("parse_entry_large", None),
+        ("parse_entry_large_keywords", {"keywords"}),
+    ):
+        timings = []
+        for _ in range(runner.repeat):
+            start = time.perf_counter()
+            for text in texts:
+                parse_entry(text, fields=fields)
+            timings.append(time.perf_counter() - start)
+
+        throughput = nbytes / min(timings) / 1e6
+        runner.record(
+            name,
+            len(texts),
+            best_seconds=min(timings),
+            bytes=nbytes,
+            megabytes_per_second=throughput,
+        )
+        print(f"{name:<30} size={len(texts):<8} {throughput:.1f}MB/s", file=sys.stderr)
+
+
+def generate_database(
+    directory: str,
+    size: int,
+    *,
+    seed: int,
+    max_keywords: int = 12,
+    max_locations: int = 5,
+    max_paragraphs: int = 4,
+) -> None:
+    """
+    Writes a synthetic database of `size` entries to `directory`.
+
+    Entries have a random number of keywords, locations and paragraphs of longform text,
+    up to the given maximums. Keywords are drawn from a skewed distribution, so that
+    some keywords are much more common than others, as in a real database.
+    """
+    rng = random.Random(seed)
+
+    # Three levels of locations: cities inside regions inside countries.
+    countries = [f"country-{i}" for i in range(max(2, size // 500))]
+    regions = [f"region-{i}" for i in range(max(4, size // 100))]
+    cities = [f"city-{i}" for i in range(max(8, size // 20))]
+    locations: Dict[str, List[str]] = {}
+    for region in regions:
+        locations[region] = [rng.choice(countries)]
+    for city in cities:
+        locations[city] = [rng.choice(regions)]
+
+    with open(os.path.join(directory, "locations.json"), "w") as f:
+        json.dump(locations, f)
+
+    places = cities + regions + countries
+    types = sorted(TYPE_CHOICES)
+    mtime = time.time() - 24 * 60 * 60
+    for i in range(size):
+        entry = make_entry(
+            rng,
+            places=places,
+            types=types,
+            max_keywords=max_keywords,
+            max_locations=max_locations,
+            max_paragraphs=max_paragraphs,
+        )
+
+        path = os.path.join(directory, f"entry-{i:07}.txt")
+        with open(path, "w") as f:
+            f.write(entry.format_for_disk())
+            f.write("\n")
+
+        # Backdate the entry, since oeuvre does not cache files modified very recently.
+        os.utime(path, (mtime, mtime))
+
+
+def make_entry(
+    rng: random.Random,
+    *,
+    places: List[str],
+    types: List[str],
+    max_keywords: int,
+    max_locations: int,
+    max_paragraphs: int,
+) -> Entry:
+    return Entry(
+        title=make_sentence(rng, 1, 5).title(),
+        type=rng.choice(types),
+        creator=make_sentence(rng, 2, 3).title(),
+        year=rng.randint(1600, 2020),
+        language=rng.choice(["English", "French", "German", "Russian", "Spanish"]),
+        plot_summary=make_longform(rng, max_paragraphs),
+        characters=[
+            KeywordField(make_sentence(rng, 1, 2), make_sentence(rng, 3, 8))
+            for _ in range(rng.randint(0, 4))
+        ],
+        locations=[
+            KeywordField(rng.choice(places), None)
+            for _ in range(rng.randint(0, max_locations))
+        ],
+        keywords=[
+            KeywordField(skewed_choice(rng, WORDS), None)
+            for _ in range(rng.randint(0, max_keywords))
+        ],
+        settings=[
+            KeywordField(skewed_choice(rng, WORDS), None)
+            for _ in range(rng.randint(0, 2))
+        ],
+        notes=make_longform(rng, max_paragraphs),
+        quotes=make_longform(rng, max_paragraphs // 2),
+    )
+
+
+def make_sentence(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def make_longform(rng: random.Random, max_paragraphs: int) -> Optional[str]:
+    paragraphs = [
+        make_sentence(rng, 40, 120).capitalize() + "."
+        for _ in range(rng.randint(0, max_paragraphs))
+    ]
+    return "\n".join(paragraphs) or None
+
+
+def skewed_choice(rng: random.Random, choices: List[str]) -> str:
+    """
+    Chooses an element of `choices`, preferring elements near the front of the list.
+    """
+    return choices[min(int(rng.paretovariate(1.2)) - 1, len(choices) - 1)]
+
+
+def make_application(directory: str) -> Application:
+    app = Application(
+        directory,
+        stdout=StringIO(),
+        stderr=StringIO(),
+        stdin=StringIO(),
+        editor=shell_editor,
+    )
+    reset_output(app)
+    return app
+
+
+def reset_output(app: Application) -> None:
+    app.stdout = StringIO()
+    app.stderr = StringIO()
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        r = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+
+    return r.stdout.strip() if r.returncode == 0 else None
+
+
+def main(args: List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark oeuvre.")
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parsed_args = parser.parse_args(args)
+
+    sizes = [int(size) for size in parsed_args.sizes.split(",")]
+    output: IO
+    if parsed_args.output:
+        output = open(parsed_args.output, "a")
+    else:
+        output = sys.stdout
+
+    try:
+        runner = BenchmarkRunner(repeat=parsed_args.repeat, output=output)
+        benchmark_parser(runner, seed=parsed_args.seed)
+        for size in sizes:
+            benchmark_database(runner, size, seed=parsed_args.seed)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,12 +1,38 @@
+import json
 import os
+import pstats
 import re
 import shutil
+import socket
+import sqlite3
 import sys
 import tempfile
+import threading
 import unittest
 from io import StringIO
-
-from oeuvre import Application, KeywordField, parse_list_field, parse_longform_field
+from unittest.mock import patch
+
+import oeuvre
+from oeuvre import (
+    Application,
+    Entry,
+    EntryColumns,
+    IgnoreList,
+    KeywordField,
+    KeywordSuggester,
+    OeuvreError,
+    ResidentDatabase,
+    SearchIndex,
+    Watcher,
+    compile_locations,
+    compile_query,
+    find_subcommand,
+    forward_to_server,
+    lock_file,
+    parse_entry,
+    parse_list_field,
+    parse_longform_field,
+)
 
 
 class OeuvreTests(unittest.TestCase):
@@ -73,11 +99,192 @@ class OeuvreTests(unittest.TestCase):
 
         self.assertOutput("error: unknown field 'lol'\n", stderr=True)
 
+    def test_search_command_with_unknown_field_after_failed_term(self):
+        # The search terms are validated before any entry is read.
+        with self.assertRaises(SystemExit):
+            self.app.main(["--no-color", "search", "xyzzy", "lol:whatever"])
+
+        self.assertOutput("error: unknown field 'lol'\n", stderr=True)
+
     def test_search_command_with_partial_word_match(self):
         # Regression test for issue #4
         self.app.main(["--no-color", "search", "kw:modernist"])
         self.assertOutput("")
 
+    def test_search_command_with_limit(self):
+        self.app.main(["--no-color", "search", "type:book", "--limit", "1"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+
+    def test_search_command_with_unsorted_flag(self):
+        with open(os.path.join(self.app.directory, "a-tale.txt"), "w") as f:
+            f.write("title: The Zoo Story\ntype: play\n")
+
+        self.app.main(["--no-color", "search", "--unsorted", "txt"])
+        self.assertOutput(
+            "The Zoo Story [a-tale.txt]\n"
+            + "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+            + "Libra (Don DeLillo) [libra.txt]\n"
+        )
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--unsorted", "--limit", "1", "txt"])
+        self.assertOutput("The Zoo Story [a-tale.txt]\n")
+
+    def test_show_command_with_multiple_matches(self):
+        self.app.main(["--no-color", "show", "type:book"])
+        self.assertOutput(
+            "Multiple matching entries:\n"
+            + "  Entry(title='Crime and Punishment', type='book', "
+            + "creator='Fyodor Dostoyevsky'\n"
+            + "  Entry(title='Libra', type='book', creator='Don DeLillo'\n"
+        )
+
+    def test_show_command_with_no_matches(self):
+        self.app.main(["--no-color", "show", "type:film"])
+        self.assertOutput("No matching entries.\n")
+
+    def test_search_command_with_or_operator(self):
+        self.app.main(["--no-color", "search", "DeLillo", "OR", "loc:russia"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+            + "Libra (Don DeLillo) [libra.txt]\n"
+        )
+
+    def test_search_command_with_not_operator(self):
+        self.app.main(["--no-color", "search", "type:book", "NOT", "kw:espionage"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--", "-kw:espionage"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+
+    def test_search_command_with_parentheses(self):
+        self.app.main(
+            [
+                "--no-color",
+                "search",
+                "--detailed",
+                "(kw:espionage",
+                "OR",
+                "year:1866)",
+                "type:book",
+            ]
+        )
+        self.assertOutput(
+            "Libra (Don DeLillo) [libra.txt]\n"
+            + "  keywords: matched keyword (espionage)\n"
+            + "  type: matched text (book)\n"
+        )
+
+    def test_search_command_with_unbalanced_parentheses(self):
+        with self.assertRaises(SystemExit):
+            self.app.main(["--no-color", "search", "(kw:espionage", "OR", "DeLillo"])
+
+        self.assertOutput("error: unbalanced parentheses in query\n", stderr=True)
+
+    def test_search_command_on_longform_field(self):
+        self.app.main(["--no-color", "search", "--detailed", "plot-summary:harvey"])
+        self.assertOutput(
+            "Libra (Don DeLillo) [libra.txt]\n"
+            + "  plot_summary: matched text (...while another settles on Lee Harvey "
+            + "Oswald, a former Marine who...)\n"
+        )
+
+    def test_search_command_with_text_phrase(self):
+        self.app.main(["--no-color", "search", "text:harvey oswald"])
+        self.assertOutput("Libra (Don DeLillo) [libra.txt]\n")
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "text:oswald harvey"])
+        self.assertOutput("")
+
+    def test_search_command_with_text_proximity(self):
+        self.app.main(["--no-color", "search", 'text:"kennedy oswald"~5'])
+        self.assertOutput("Libra (Don DeLillo) [libra.txt]\n")
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", 'text:"kennedy ruby"~5'])
+        self.assertOutput("")
+
+    def test_search_command_with_phrase(self):
+        self.app.main(["--no-color", "search", "don delillo"])
+        self.assertOutput("Libra (Don DeLillo) [libra.txt]\n")
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "delillo don"])
+        self.assertOutput("")
+
+    def test_search_command_with_hyphenated_keyword(self):
+        self.app.main(["--no-color", "search", "kw:linear", "--detailed"])
+        self.assertOutput(
+            "Libra (Don DeLillo) [libra.txt]\n"
+            + "  keywords: matched keyword (non-linear)\n"
+        )
+
+    def test_search_index(self):
+        entries = self.app.read_entries()
+        index = SearchIndex({"st-petersburg": frozenset(["russia"])})
+        for i, entry in enumerate(entries):
+            index.add(i, entry)
+
+        def lookup(*terms):
+            return index.lookup(compile_query(list(terms)))
+
+        self.assertEqual(lookup("DeLillo"), {1})
+        self.assertEqual(lookup("loc:russia"), {0})
+        self.assertEqual(lookup("kw:non-linear", "creator:dostoyevsky"), set())
+        self.assertIsNone(lookup("type:book"))
+
+    def test_cycle_in_location_database(self):
+        with open(os.path.join(self.app.directory, "locations.json"), "w") as f:
+            f.write('{"st-petersburg": ["russia"], "russia": ["st-petersburg"]}')
+
+        app = Application(
+            self.app.directory,
+            stdout=self.app.stdout,
+            stderr=self.app.stderr,
+            stdin=None,
+            editor=None,
+        )
+        # The location database is only loaded by the commands that need it.
+        app.main(["keywords"])
+        self.app.stdout.truncate(0)
+        self.app.stdout.seek(0)
+
+        with self.assertRaises(SystemExit):
+            app.main(["search", "loc:russia"])
+
+        self.assertRegex(
+            self.app.stderr.getvalue(),
+            "^error: cycle in location database: "
+            + r"st-petersburg -> russia -> st-petersburg \(.*locations.json\)\n$",
+        )
+
+    def test_search_command_with_stats_flag(self):
+        self.app.main(["--no-color", "--stats", "search", "DeLillo"])
+        self.assertEqual(
+            self.app.stdout.getvalue(), "Libra (Don DeLillo) [libra.txt]\n"
+        )
+
+        stats = self.app.stderr.getvalue()
+        self.assertTrue(stats.startswith("phases:\n"))
+        self.assertRegex(stats, r"  total: [0-9.]+ ms\n")
+        self.assertIn("  files scanned: 2\n", stats)
+        self.assertIn("  regexes compiled: 1\n", stats)
+        self.assertIn("  matches found: 1\n", stats)
+
+    def test_search_command_with_profile_flag(self):
+        path = os.path.join(self._directory.name, "profile.out")
+        self.app.main(["--no-color", "--profile", path, "search", "DeLillo"])
+        self.assertOutput("Libra (Don DeLillo) [libra.txt]\n")
+        self.assertIn("main_search", str(pstats.Stats(path).stats))
+
     # See the long comment below this test class for an explanation on how the new and
     # edit commands are tested.
 
@@ -146,6 +353,33 @@ class OeuvreTests(unittest.TestCase):
             + "  film-noir\n"
         )
 
+    def test_edit_command_suggests_existing_keywords(self):
+        editor = FakeEditor()
+        editor.add_to_list_field("keywords", "Conspiracies\n  espoinage\n  sailing")
+        self.app.editor = editor
+        self.app.stdin = StringIO("yes\n")
+
+        self.app.main(["--no-color", "edit", "crime-and-punishment.txt"])
+        self.assertTrue(
+            self.app.stdout.getvalue().startswith(
+                "new keywords for crime-and-punishment.txt: "
+                + "Conspiracies, espoinage, sailing\n"
+                + "  Conspiracies: did you mean conspiracy?\n"
+                + "  espoinage: did you mean espionage?\n"
+                + "Keep? "
+            )
+        )
+
+    def test_keyword_suggester(self):
+        suggester = KeywordSuggester(
+            ["cold war", "conspiracy", "espionage", "film-noir", "war"]
+        )
+        self.assertEqual(suggester.suggest("Cold-Wars"), ["cold war"])
+        self.assertEqual(suggester.suggest("film noir"), ["film-noir"])
+        self.assertEqual(suggester.suggest("epsionage"), ["espionage"])
+        self.assertEqual(suggester.suggest("wars"), ["war"])
+        self.assertEqual(suggester.suggest("peace"), [])
+
     def test_edit_command_with_multiple_files(self):
         # Make sure the entries don't already have the keyword we are going to add.
         self.app.main(["--no-color", "search", "keywords:edited"])
@@ -191,6 +425,903 @@ class OeuvreTests(unittest.TestCase):
         self.assertIn("type: book", self.app.stdout.getvalue())
         self.assertNotIn("type: whatever", self.app.stdout.getvalue())
 
+    def test_edit_command_without_changes(self):
+        self.make_entries_old()
+        self.app.editor = lambda paths: None
+
+        self.app.main(["--no-color", "edit", "type:book"])
+        self.assertOutput("")
+
+        # The files were not rewritten.
+        for name in ("crime-and-punishment.txt", "libra.txt"):
+            st = os.stat(os.path.join(self.app.directory, name))
+            self.assertEqual(st.st_mtime, 1000000000)
+
+    def test_edit_command_with_unchanged_invalid_edit(self):
+        path = os.path.join(self.app.directory, "libra.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            original = f.read()
+
+        editor = FakeEditor()
+        editor.set_field("type", "whatever", overwrite=True)
+        # Make the edit in the first editing session, but not in the second.
+        sessions = [editor, lambda paths: None]
+        self.app.editor = lambda paths: sessions.pop(0)(paths)
+        self.app.stdin = StringIO("yes\nno\n")
+
+        with patch.object(oeuvre, "parse_entry", wraps=oeuvre.parse_entry) as mock:
+            self.app.main(["--no-color", "edit", "libra.txt"])
+
+        # The file was not changed in the second editing session, so it was not parsed
+        # again, but the error is still reported.
+        edited = [c for c in mock.call_args_list if "type: whatever" in c.args[0]]
+        self.assertEqual(len(edited), 1)
+        self.assertEqual(self.app.stderr.getvalue().count("error: 'type' must be"), 2)
+        with open(path, "r", encoding="utf-8") as f:
+            self.assertEqual(f.read(), original)
+
+    def test_new_command_without_changes(self):
+        self.app.editor = lambda paths: None
+
+        self.app.main(["--no-color", "new", "test_new_command_entry.txt"])
+        self.assertOutput("")
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(self.app.directory, "test_new_command_entry.txt")
+            )
+        )
+
+    def test_edit_command_with_locked_entry(self):
+        self.app.editor = FakeEditor()
+        lock_path = os.path.join(self.app.directory, ".oeuvre-locks", "libra.txt.lock")
+        with lock_file(lock_path, blocking=False):
+            with self.assertRaises(SystemExit):
+                self.app.main(["--no-color", "edit", "libra.txt"])
+
+        self.assertOutput(
+            "error: entry is locked by another oeuvre process (libra.txt)\n",
+            stderr=True,
+        )
+
+        # The lock is released when the editor exits.
+        editor = FakeEditor()
+        editor.set_field("creator", "Thomas Pynchon", overwrite=True)
+        self.reset_io()
+        self.app.editor = editor
+        self.app.main(["--no-color", "edit", "libra.txt"])
+        self.assertOutput(LIBRA_EDITED)
+        with lock_file(lock_path, blocking=False):
+            pass
+
+        # Lock files don't outlive their locks.
+        self.assertEqual(
+            os.listdir(os.path.join(self.app.directory, ".oeuvre-locks")), []
+        )
+
+    def test_lock_file_removed_while_waiting(self):
+        lock_path = os.path.join(self.app.directory, ".oeuvre-locks", "libra.txt.lock")
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def wait_for_lock():
+            with lock_file(lock_path, blocking=True):
+                acquired.set()
+                release.wait()
+
+        thread = threading.Thread(target=wait_for_lock)
+        with lock_file(lock_path, blocking=False):
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+
+        # The waiter locked the file that it opened just as it was removed, so it has to
+        # create the file again, or else the lock would exclude no one.
+        self.assertTrue(acquired.wait(5))
+        try:
+            self.assertTrue(os.path.exists(lock_path))
+            with self.assertRaises(OeuvreError):
+                with lock_file(lock_path, blocking=False):
+                    pass
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertFalse(os.path.exists(lock_path))
+
+    def test_reformat_command(self):
+        path = os.path.join(self.app.directory, "libra.txt")
+        os.chmod(path, 0o640)
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("type: book", "type:   book"))
+
+        other_path = os.path.join(self.app.directory, "crime-and-punishment.txt")
+        with open(other_path, "a", encoding="utf-8") as f:
+            f.write("\n\n")
+
+        self.app.stdin = StringIO("yes\n")
+        lock_path = os.path.join(
+            self.app.directory, ".oeuvre-locks", "crime-and-punishment.txt.lock"
+        )
+        with lock_file(lock_path, blocking=False):
+            self.app.main(["--no-color", "reformat"])
+
+        with open(path, "r", encoding="utf-8") as f:
+            self.assertEqual(f.read(), text)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        with open(other_path, "r", encoding="utf-8") as f:
+            self.assertTrue(f.read().endswith("\n\n\n"))
+
+        self.assertIn(
+            "warning: skipped: entry is locked by another oeuvre process "
+            + "(crime-and-punishment.txt)\n",
+            self.app.stderr.getvalue(),
+        )
+        self.assertEqual(
+            [name for name in os.listdir(self.app.directory) if name.endswith(".tmp")],
+            [],
+        )
+
+    def test_reformat_command_with_symlinked_entry(self):
+        # The entry is a link to a file outside of the database.
+        path = os.path.join(self.app.directory, "libra.txt")
+        target = os.path.join(self._directory.name, "libra.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(target, "w", encoding="utf-8") as f:
+            f.write(text.replace("type: book", "type:   book"))
+        os.remove(path)
+        os.symlink(target, path)
+
+        self.app.stdin = StringIO("yes\n")
+        self.app.main(["--no-color", "reformat"])
+
+        self.assertTrue(os.path.islink(path))
+        with open(target, "r", encoding="utf-8") as f:
+            self.assertEqual(f.read(), text)
+
+    def test_read_entries_uses_cache(self):
+        self.make_entries_old()
+        entries = self.app.read_entries()
+        self.assertTrue(
+            os.path.exists(os.path.join(self.app.directory, ".oeuvre-cache"))
+        )
+
+        # Change the file without changing its size or modification time, so that the
+        # only way to see the original title is through the cache.
+        path = os.path.join(self.app.directory, "libra.txt")
+        st = os.stat(path)
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("title: Libra", "title: Arbil"))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        cached_entries = self.app.read_entries()
+        self.assertEqual(
+            [e.title for e in cached_entries], ["Crime and Punishment", "Libra"]
+        )
+        self.assertEqual(cached_entries[1].keywords, entries[1].keywords)
+
+    def test_read_entries_reparses_modified_files(self):
+        self.make_entries_old()
+        self.app.read_entries()
+
+        path = os.path.join(self.app.directory, "libra.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("title: Libra", "title: Libra, a Novel"))
+
+        entries = self.app.read_entries()
+        self.assertEqual(entries[1].title, "Libra, a Novel")
+
+    def test_read_entries_evicts_deleted_files(self):
+        self.make_entries_old()
+        self.app.read_entries()
+        os.remove(os.path.join(self.app.directory, "libra.txt"))
+
+        entries = self.app.read_entries()
+        self.assertEqual([e.filename for e in entries], ["crime-and-punishment.txt"])
+        with open(os.path.join(self.app.directory, ".oeuvre-cache"), "rb") as f:
+            self.assertNotIn(b"libra.txt", f.read())
+
+    def test_pack_command(self):
+        self.make_entries_old()
+        self.app.main(["pack"])
+        self.assertOutput("Packed 2 entries into .oeuvre.pack.\n")
+
+        # Change the file without changing its size or modification time, so that the
+        # only way to see the original title is through the snapshot.
+        path = os.path.join(self.app.directory, "libra.txt")
+        st = os.stat(path)
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("title: Libra", "title: Arbil"))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        entries = self.app.read_entries()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.app.directory, ".oeuvre-cache"))
+        )
+        self.assertEqual([e.title for e in entries], ["Crime and Punishment", "Libra"])
+        self.assertEqual(
+            [e.filename for e in entries], ["crime-and-punishment.txt", "libra.txt"]
+        )
+        self.assertIsNotNone(entries[1].plot_summary)
+
+        # Like parsing, decoding skips the longform fields that aren't asked for.
+        projected = self.app.read_entries(fields={"keywords"})
+        self.assertEqual(projected[1].title, "Libra")
+        self.assertIsNone(projected[1].plot_summary)
+        self.assertEqual(projected[1].keywords[0].keyword, "conspiracy")
+
+        self.app.use_cache = False
+        for packed, parsed in zip(entries, self.app.read_entries()):
+            self.assertEqual(packed.format_for_disk(), parsed.format_for_disk())
+            self.assertEqual(packed.year, parsed.year)
+
+    def test_packed_snapshot_is_rebuilt_when_files_change(self):
+        self.make_entries_old()
+        self.app.main(["pack"])
+        pack_path = os.path.join(self.app.directory, ".oeuvre.pack")
+        with open(pack_path, "rb") as f:
+            original = f.read()
+
+        os.remove(os.path.join(self.app.directory, "libra.txt"))
+        with open(os.path.join(self.app.directory, "a-study.txt"), "w") as f:
+            f.write("title: A Study\ntype: book\n")
+        os.utime(os.path.join(self.app.directory, "a-study.txt"), (1000, 1000))
+
+        entries = self.app.read_entries()
+        self.assertEqual(
+            [e.filename for e in entries], ["a-study.txt", "crime-and-punishment.txt"]
+        )
+
+        with open(pack_path, "rb") as f:
+            rebuilt = f.read()
+        self.assertNotEqual(rebuilt, original)
+        self.assertIn(b"A Study", rebuilt)
+        self.assertNotIn(b"libra.txt", rebuilt)
+
+        # A corrupt snapshot is rebuilt from scratch.
+        with open(pack_path, "wb") as f:
+            f.write(rebuilt[:40])
+        self.assertEqual([e.title for e in self.app.read_entries()][0], "A Study")
+        with open(pack_path, "rb") as f:
+            self.assertEqual(f.read(), rebuilt)
+
+    def test_list_entry_paths(self):
+        d = self.app.directory
+        for path in (
+            "a/b.txt",
+            "a-c.txt",
+            "a/attachments/notes.txt",
+            "scratch/draft.txt",
+            "a/scratch/d.txt",
+            "editing/libra.txt",
+            ".hidden/e.txt",
+            "a/.f.txt",
+        ):
+            os.makedirs(os.path.dirname(os.path.join(d, path)), exist_ok=True)
+            with open(os.path.join(d, path), "w") as f:
+                f.write("title: Untitled\ntype: book\n")
+        with open(os.path.join(d, ".oeuvreignore"), "w") as f:
+            f.write("# Attachments are kept next to entries.\nattachments/\n/scratch\n")
+
+        self.assertEqual(
+            [path[len(d) + 1 :] for path in self.app.list_entry_paths()],
+            [
+                "a-c.txt",
+                "a/b.txt",
+                "a/scratch/d.txt",
+                "crime-and-punishment.txt",
+                "libra.txt",
+            ],
+        )
+
+        ignore = IgnoreList.load(d)
+        self.assertTrue(ignore.ignores_file("editing/libra.txt"))
+        self.assertTrue(ignore.ignores_file("b/attachments/c/d.txt"))
+        self.assertTrue(ignore.ignores_file("a/.f.txt"))
+        self.assertFalse(ignore.ignores_file("a/editing/libra.txt"))
+        self.assertFalse(ignore.ignores_file("libra.txt"))
+
+    def test_serve_request(self):
+        self.app.resident = ResidentDatabase(self.app)
+        request = {
+            "args": ["search", "kw:conspiracy"],
+            "stdout_isatty": False,
+            "stderr_isatty": False,
+        }
+        response = self.app.handle_request(request)
+        self.assertEqual(
+            response,
+            {"stdout": "Libra (Don DeLillo) [libra.txt]\n", "stderr": "", "status": 0},
+        )
+
+        # The resident database picks up changes to the files on disk.
+        path = os.path.join(self.app.directory, "libra.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("  conspiracy\n", "  conspiracies\n"))
+
+        response = self.app.handle_request(request)
+        self.assertEqual(response["stdout"], "")
+
+        os.remove(os.path.join(self.app.directory, "crime-and-punishment.txt"))
+        response = self.app.handle_request(
+            {
+                "args": ["search", "type:book"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+        )
+        self.assertEqual(response["stdout"], "Libra (Don DeLillo) [libra.txt]\n")
+
+    def test_serve_request_does_not_keep_flags(self):
+        self.app.resident = ResidentDatabase(self.app)
+        response = self.app.handle_request(
+            {
+                "args": ["--no-cache", "--jobs", "1", "search", "kw:conspiracy"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+        )
+        self.assertEqual(response["stdout"], "Libra (Don DeLillo) [libra.txt]\n")
+        self.assertTrue(self.app.use_cache)
+        self.assertIsNone(self.app.jobs)
+
+    def test_serve_request_with_ignore_file_changes(self):
+        self.app.resident = ResidentDatabase(self.app, watch=True)
+        self.addCleanup(self.app.resident.close)
+        d = self.app.directory
+        os.makedirs(os.path.join(d, "drafts"))
+        with open(os.path.join(d, "drafts", "dune.txt"), "w", encoding="utf-8") as f:
+            f.write("title: Dune\ntype: book\n")
+
+        def search():
+            request = {
+                "args": ["search", "type:book"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+            return self.app.handle_request(request)["stdout"]
+
+        self.assertIn("Dune [drafts/dune.txt]\n", search())
+
+        with open(os.path.join(d, ".oeuvreignore"), "w", encoding="utf-8") as f:
+            f.write("drafts/\n")
+        self.assertNotIn("Dune", search())
+
+        os.remove(os.path.join(d, ".oeuvreignore"))
+        self.assertIn("Dune [drafts/dune.txt]\n", search())
+
+        # The directory is watched again once it is no longer ignored.
+        with open(os.path.join(d, "drafts", "emma.txt"), "w", encoding="utf-8") as f:
+            f.write("title: Emma\ntype: book\n")
+        self.assertIn("Emma [drafts/emma.txt]\n", search())
+
+    def test_serve_request_with_locations_changes(self):
+        self.app.resident = ResidentDatabase(self.app, watch=True)
+        self.addCleanup(self.app.resident.close)
+        request = {
+            "args": ["search", "loc:usa"],
+            "stdout_isatty": False,
+            "stderr_isatty": False,
+        }
+        self.assertEqual(self.app.handle_request(request)["stdout"], "")
+
+        with open(os.path.join(self.app.directory, "locations.json"), "w") as f:
+            f.write('{"dallas": ["usa"]}')
+
+        # The very first request after the change sees the new locations.
+        self.assertEqual(
+            self.app.handle_request(request)["stdout"],
+            "Libra (Don DeLillo) [libra.txt]\n",
+        )
+
+    def test_serve_request_with_error(self):
+        self.app.resident = ResidentDatabase(self.app)
+        response = self.app.handle_request(
+            {
+                "args": ["search", "lol:whatever"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+        )
+        self.assertEqual(
+            response,
+            {"stdout": "", "stderr": "error: unknown field 'lol'\n", "status": 1},
+        )
+
+    def test_serve_connection(self):
+        self.app.resident = ResidentDatabase(self.app)
+        client, server = socket.socketpair()
+        with client, server:
+            request = {
+                "args": ["show", "--brief", "libra.txt"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            self.app.handle_connection(server)
+            server.close()
+            response = json.loads(client.makefile("rb").read())
+
+        self.assertEqual(response["stdout"], LIBRA_BRIEF)
+        self.assertEqual(response["status"], 0)
+
+    def test_serve_connection_with_client_gone(self):
+        self.app.resident = ResidentDatabase(self.app)
+        client, server = socket.socketpair()
+        with client, server:
+            request = {
+                "args": ["search", "kw:conspiracy"],
+                "stdout_isatty": False,
+                "stderr_isatty": False,
+            }
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            # The client goes away without reading the reply.
+            client.close()
+            self.app.handle_connection(server)
+
+    def test_serve_connection_with_malformed_request(self):
+        self.app.resident = ResidentDatabase(self.app)
+        client, server = socket.socketpair()
+        with client, server:
+            client.sendall(json.dumps({"args": ["search"]}).encode("utf-8") + b"\n")
+            self.app.handle_connection(server)
+            server.close()
+            response = json.loads(client.makefile("rb").read())
+
+        self.assertEqual(response["status"], 1)
+        self.assertIn("malformed request", response["stderr"])
+
+    def test_resident_database_with_watcher(self):
+        resident = ResidentDatabase(self.app, watch=True)
+        self.addCleanup(resident.close)
+        self.run_resident_database_test(resident)
+
+    def test_resident_database_with_polling_watcher(self):
+        with patch.object(oeuvre, "make_watcher", lambda directory: Watcher()):
+            resident = ResidentDatabase(self.app, watch=True)
+        self.run_resident_database_test(resident)
+
+    def run_resident_database_test(self, resident):
+        d = self.app.directory
+        resident.refresh()
+        self.assertEqual(resident.filenames, ["crime-and-punishment.txt", "libra.txt"])
+
+        with open(os.path.join(d, "libra.txt"), "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(os.path.join(d, "libra.txt"), "w", encoding="utf-8") as f:
+            f.write(text.replace("title: Libra", "title: Libra, a Novel"))
+        os.remove(os.path.join(d, "crime-and-punishment.txt"))
+        os.makedirs(os.path.join(d, "editing"))
+        with open(os.path.join(d, "editing", "libra.txt"), "w") as f:
+            f.write(text)
+        with open(os.path.join(d, "locations.json"), "w") as f:
+            f.write('{"dallas": ["texas"]}')
+
+        resident.refresh()
+        self.assertEqual(resident.filenames, ["libra.txt"])
+        self.assertEqual(resident.records["libra.txt"][1].title, "Libra, a Novel")
+        self.assertEqual(
+            resident.index.lookup(compile_query(["loc:texas"])), {"libra.txt"}
+        )
+        self.assertEqual(resident.index.lookup(compile_query(["title:crime"])), set())
+
+        os.makedirs(os.path.join(d, "more"))
+        with open(os.path.join(d, "more", "dune.txt"), "w", encoding="utf-8") as f:
+            f.write(text.replace("title: Libra", "title: Dune"))
+
+        resident.refresh()
+        self.assertEqual(resident.filenames, ["libra.txt", "more/dune.txt"])
+
+    def test_resident_database_with_file_deleted_during_scan(self):
+        resident = ResidentDatabase(self.app)
+        resident.refresh()
+
+        # The file is deleted between the listing and the stat.
+        listed = self.app.list_entry_files()
+        os.remove(os.path.join(self.app.directory, "crime-and-punishment.txt"))
+        with patch.object(self.app, "list_entry_files", return_value=listed):
+            resident.refresh()
+
+        self.assertEqual(resident.filenames, ["libra.txt"])
+        self.assertNotIn("crime-and-punishment.txt", resident.records)
+        self.assertEqual(resident.index.lookup(compile_query(["title:crime"])), set())
+
+    def test_forward_to_server_without_server(self):
+        self.assertIsNone(forward_to_server(self.app.directory, ["search", "war"]))
+        self.assertIsNone(forward_to_server(self.app.directory, ["new", "war.txt"]))
+        self.assertEqual(find_subcommand(["--jobs", "2", "--stats", "show"]), "show")
+
+    def test_entries_are_compact(self):
+        entries = self.app.read_entries()
+        self.assertFalse(hasattr(entries[1], "__dict__"))
+        self.assertFalse(hasattr(entries[1].keywords[0], "__dict__"))
+        # Keywords are interned, so equal keywords are the same object.
+        keyword = "".join(["conspir", "acy"])
+        self.assertIs(
+            KeywordField(keyword, None).keyword, entries[1].keywords[0].keyword
+        )
+
+    def test_entries_parsed_in_parallel_are_compact(self):
+        paths = self.app.list_entry_paths()
+        self.app.jobs = 2
+        with patch.object(oeuvre, "PARALLEL_THRESHOLD", 0):
+            entries = [entry for entry, _ in self.app.parse_files(paths)]
+
+        # Entries come back from the worker processes pickled, with their strings
+        # interned again.
+        keyword = "".join(["conspir", "acy"])
+        self.assertIs(
+            KeywordField(keyword, None).keyword, entries[1].keywords[0].keyword
+        )
+        self.assertIs(entries[1].type, sys.intern("".join(["bo", "ok"])))
+        self.assertEqual(
+            entries[1].format_for_disk(), self.app.read_entries()[1].format_for_disk()
+        )
+
+    def test_compile_locations(self):
+        locdb = compile_locations(
+            {
+                "brooklyn": ["new-york-city"],
+                "new-york-city": ["new-york-state", "north-america"],
+                "new-york-state": ["usa"],
+                "usa": ["north-america"],
+            }
+        )
+
+        self.assertEqual(
+            locdb["brooklyn"],
+            {"new-york-city", "new-york-state", "usa", "north-america"},
+        )
+        self.assertEqual(locdb["usa"], {"north-america"})
+        self.assertEqual(locdb["north-america"], set())
+
+    def test_compile_locations_with_cycle(self):
+        with self.assertRaises(OeuvreError) as cm:
+            compile_locations({"a": ["b"], "b": ["c"], "c": ["b"]})
+
+        self.assertEqual(str(cm.exception), "cycle in location database: b -> c -> b")
+
+    def test_read_entries_in_parallel(self):
+        self.app.use_cache = False
+        self.app.jobs = 2
+        with patch.object(oeuvre, "PARALLEL_THRESHOLD", 1):
+            entries = self.app.read_entries()
+
+        self.assertEqual(
+            [e.filename for e in entries], ["crime-and-punishment.txt", "libra.txt"]
+        )
+        self.assertEqual(entries[1].keywords[0], KeywordField("conspiracy", None))
+
+    def test_read_entries_in_parallel_with_errors(self):
+        self.app.use_cache = False
+        self.app.jobs = 2
+        for name in ("a.txt", "b.txt"):
+            with open(os.path.join(self.app.directory, name), "w") as f:
+                f.write("title: Whatever\ntype: whatever\n")
+
+        with patch.object(oeuvre, "PARALLEL_THRESHOLD", 1):
+            entries = self.app.read_entries(best_effort=True)
+            self.assertEqual(len(entries), 2)
+            self.assertEqual(self.app.stderr.getvalue().count("warning: "), 2)
+
+            self.reset_io()
+            with self.assertRaises(SystemExit):
+                self.app.read_entries()
+
+        self.assertRegex(self.app.stderr.getvalue(), r"^error: .*a\.txt, line 2\)\n$")
+
+    def test_search_command_with_fuzzy_term(self):
+        self.app.main(["--no-color", "search", "~Dostoevsky"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--fuzzy", "--detailed", "delilo"])
+        self.assertOutput(
+            "Libra (Don DeLillo) [libra.txt]\n"
+            + "  creator: fuzzy matched text (Don DeLillo)\n"
+        )
+
+        # Fuzzy search also matches the fields that it doesn't compare fuzzily.
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--fuzzy", "conspiracy"])
+        self.assertOutput("Libra (Don DeLillo) [libra.txt]\n")
+
+        # Terms without any words are matched exactly.
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--fuzzy", "--", "-"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+            + "Libra (Don DeLillo) [libra.txt]\n"
+        )
+
+        self.reset_io()
+        with self.assertRaises(SystemExit):
+            self.app.main(["--no-color", "search", "kw:~espionage"])
+
+        self.assertOutput(
+            "error: fuzzy search is only supported on: title, creator, characters\n",
+            stderr=True,
+        )
+
+    def test_search_command_ranks_fuzzy_matches(self):
+        with open(os.path.join(self.app.directory, "the-idiot.txt"), "w") as f:
+            f.write("title: The Idiot\ntype: book\ncreator: Fyodor Dostoevsky\n")
+
+        for flags in ([], ["--sqlite"]):
+            self.reset_io()
+            self.app.main(["--no-color", *flags, "search", "~Dostoevsky"])
+            self.assertOutput(
+                "The Idiot (Fyodor Dostoevsky) [the-idiot.txt]\n"
+                + "Crime and Punishment (Fyodor Dostoyevsky) "
+                + "[crime-and-punishment.txt]\n"
+            )
+
+    def test_search_command_with_fuzzy_term_uses_vocabulary(self):
+        self.make_entries_old()
+        expected = (
+            "The Idiot (Fyodor Dostoevsky) [the-idiot.txt]\n"
+            + "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+
+        # The similar words are looked up in the vocabulary of the cache or the packed
+        # snapshot rather than the term being compared to every word, including the
+        # words of entries that were only just parsed.
+        for packed in (False, True):
+            if packed:
+                self.app.main(["pack"])
+            else:
+                self.app.main(["search", "kw:espionage"])
+
+            with open(os.path.join(self.app.directory, "the-idiot.txt"), "w") as f:
+                f.write(
+                    f"title: The Idiot {packed}\ntype: book\n"
+                    + "creator: Fyodor Dostoevsky\n"
+                )
+
+            self.reset_io()
+            with patch("oeuvre.trigram_similarity") as trigram_similarity:
+                self.app.main(["--no-color", "search", "~Dostoevsky"])
+
+            trigram_similarity.assert_not_called()
+            self.assertOutput(expected.replace("Idiot", f"Idiot {packed}", 1))
+            os.remove(os.path.join(self.app.directory, "the-idiot.txt"))
+
+    def test_search_command_with_rank_flag(self):
+        with open(os.path.join(self.app.directory, "a-study.txt"), "w") as f:
+            f.write("title: A Study\ntype: book\nkeywords:\n  murder\n")
+        with open(os.path.join(self.app.directory, "the-murder.txt"), "w") as f:
+            f.write("title: The Murder\ntype: book\n")
+
+        self.app.main(["--no-color", "search", "murder"])
+        self.assertOutput("A Study [a-study.txt]\nThe Murder [the-murder.txt]\n")
+
+        for flags in ([], ["--sqlite"]):
+            self.reset_io()
+            self.app.main(["--no-color", *flags, "search", "--rank", "murder"])
+            self.assertOutput("The Murder [the-murder.txt]\nA Study [a-study.txt]\n")
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", "--rank", "--limit", "1", "murder"])
+        self.assertOutput("The Murder [the-murder.txt]\n")
+
+        self.reset_io()
+        with self.assertRaises(SystemExit):
+            self.app.main(["--no-color", "search", "--rank", "--unsorted", "murder"])
+
+        self.assertOutput("error: --rank cannot be used with --unsorted\n", stderr=True)
+
+    def test_stats_command(self):
+        with open(os.path.join(self.app.directory, "white-noise.txt"), "w") as f:
+            f.write(
+                "title: White Noise\ncreator: Don DeLillo\ntype: book\nyear: 1985\n"
+                + "keywords:\n  postmodernist\n"
+            )
+        with open(os.path.join(self.app.directory, "underworld.txt"), "w") as f:
+            f.write("title: Underworld\ncreator: Don DeLillo\ntype: book\nyear: 1997\n")
+
+        self.app.main(["stats", "creator", "--sorted"])
+        self.assertOutput("Don DeLillo (3)\nFyodor Dostoyevsky (1)\n")
+
+        self.reset_io()
+        self.app.main(["stats", "decade"])
+        self.assertOutput("1980s (2)\n1990s (1)\n")
+
+        self.reset_io()
+        self.app.main(["stats", "year", "--keyword", "postmodernist"])
+        self.assertOutput("1985 (1)\n1988 (1)\n")
+
+        self.reset_io()
+        self.app.main(["stats", "language", "--keyword", "nonexistent"])
+        self.assertOutput("")
+
+    def test_entry_columns(self):
+        entries = self.app.read_entries()
+        entries.append(Entry(title="Untitled", type="film", year=1980))
+        columns = [EntryColumns(entries, use_numpy=False)]
+        try:
+            import numpy  # type: ignore  # noqa: F401
+
+            columns.append(EntryColumns(entries))
+        except ImportError:
+            pass
+
+        for c in columns:
+            self.assertEqual(c.count("type"), {"book": 2, "film": 1})
+            self.assertEqual(c.count("language"), {"Russian": 1, "English": 1})
+            self.assertEqual(c.count("decade"), {1980: 2})
+            rows = c.rows_with_keyword("espionage")
+            self.assertEqual(c.count("year", rows=rows), {1988: 1})
+            self.assertEqual(c.count("type", rows=rows), {"book": 1})
+
+    def test_search_index_finds_similar_words(self):
+        entries = self.app.read_entries()
+        index = SearchIndex({})
+        for i, entry in enumerate(entries):
+            index.add(i, entry)
+
+        self.assertEqual(index.lookup(compile_query(["~Dostoevski"])), {0})
+        self.assertEqual(
+            index.lookup(compile_query(["~Dostoevski", "~Dellilo"])), set()
+        )
+        self.assertEqual(index.lookup(compile_query(["creator:~Libra"])), set())
+
+    def test_search_command_with_sqlite(self):
+        self.app.main(["--no-color", "--sqlite", "search", "locations:russia"])
+        self.assertOutput(
+            "Crime and Punishment (Fyodor Dostoyevsky) [crime-and-punishment.txt]\n"
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(self.app.directory, ".oeuvre.sqlite3"))
+        )
+
+        self.reset_io()
+        self.app.main(["--no-color", "search", 'text:"harvey oswald"', "--detailed"])
+        expected = self.app.stdout.getvalue()
+        self.reset_io()
+        self.app.main(
+            ["--no-color", "--sqlite", "search", 'text:"harvey oswald"', "--detailed"]
+        )
+        self.assertOutput(expected)
+
+        self.reset_io()
+        self.app.main(["--sqlite", "keywords"])
+        self.assertIn("conspiracy (1)\n", self.app.stdout.getvalue())
+
+    def test_sqlite_mirror_syncs_changes(self):
+        self.make_entries_old()
+        self.app.main(["--sqlite", "search", "kw:conspiracy"])
+        mirror = self.app.mirror
+
+        path = os.path.join(self.app.directory, "libra.txt")
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text.replace("  conspiracy\n", "  conspiracies\n"))
+        os.remove(os.path.join(self.app.directory, "crime-and-punishment.txt"))
+
+        mirror.sync(self.app)
+        self.assertEqual(mirror.lookup(compile_query(["kw:conspiracy"])), set())
+        self.assertEqual(
+            mirror.lookup(compile_query(["kw:conspiracies"])), {"libra.txt"}
+        )
+        self.assertEqual([e.filename for e in mirror.read_entries()], ["libra.txt"])
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("title: Whatever\ntype: whatever\n")
+
+        self.reset_io()
+        with self.assertRaises(SystemExit):
+            self.app.main(["--sqlite", "search", "kw:conspiracies"])
+
+        self.assertRegex(
+            self.app.stderr.getvalue(), r"^error: .*libra\.txt, line 2\)\n$"
+        )
+
+    def test_sqlite_mirror_locked_by_another_process(self):
+        self.app.main(["--sqlite", "search", "kw:conspiracy"])
+        self.app.mirror = None
+
+        other = sqlite3.connect(os.path.join(self.app.directory, ".oeuvre.sqlite3"))
+        self.addCleanup(other.close)
+        other.execute("BEGIN IMMEDIATE")
+
+        self.reset_io()
+        with patch.object(oeuvre.SqliteMirror, "TIMEOUT", 0.01):
+            with self.assertRaises(SystemExit):
+                self.app.main(["--sqlite", "search", "kw:conspiracy"])
+
+        self.assertOutput(
+            "error: could not update the SQLite mirror: database is locked\n",
+            stderr=True,
+        )
+
+    def test_query_planner_evaluates_cheap_terms_first(self):
+        query = compile_query(["DeLillo", "kw:espionage", "type:book"])
+        self.assertEqual(
+            [child.field for _, child in query.root.plan], ["type", "keywords", ""]
+        )
+
+    def test_parse_entry_with_fields(self):
+        with open(os.path.join(self.app.directory, "libra.txt"), encoding="utf-8") as f:
+            text = f.read()
+
+        entry = parse_entry(text, fields={"keywords"})
+        self.assertIsNone(entry.plot_summary)
+        self.assertEqual(entry.keywords, parse_entry(text).keywords)
+
+        # The entry is validated even if the fields are not needed.
+        with self.assertRaises(OeuvreError):
+            parse_entry(text.replace("type: book", "type: whatever"), fields=set())
+
+    def test_parse_entry_round_trip(self):
+        for entry in self.app.read_entries():
+            text = entry.format_for_disk()
+            reparsed = parse_entry(text)
+            reparsed.filename = entry.filename
+            self.assertEqual(reparsed.to_json(), entry.to_json())
+            self.assertEqual(reparsed.format_for_disk(), text)
+
+        entry = Entry(
+            title="The Plague",
+            type="book",
+            creator="Albert Camus",
+            year=1947,
+            language="French",
+            plot_summary="First paragraph.\nSecond: with a colon.",
+            characters=[
+                KeywordField("Dr. Rieux", "a doctor"),
+                KeywordField("Tarrou", None),
+            ],
+            locations=[KeywordField("Oran", None)],
+            keywords=[
+                KeywordField("epidemics", None),
+                KeywordField("quarantine", None),
+            ],
+            settings=[KeywordField("plague", None)],
+            quotes="They fancied themselves free.",
+            notes="Read in 2020.",
+        )
+        self.assertEqual(
+            parse_entry(entry.format_for_disk()).to_json(), entry.to_json()
+        )
+
+    def test_parse_entry_errors(self):
+        cases = [
+            ("title: T\ntype: book\n\nbogus\n", "expected field definition", 4),
+            ("title: T\n\ntype: book\nnotes: x\n", "trailing content", 4),
+            ("title: T\ntype: book\nkeywords:\n  a\nfoo: bar\n", "unknown field", 5),
+            ("title: T\ntype: book\r\n\r\nyear: soon\r\n", "must be an integer", 4),
+            ("type: book\n", "'title' field is required", None),
+        ]
+        for text, message, lineno in cases:
+            with self.assertRaises(OeuvreError) as cm:
+                parse_entry(text)
+
+            self.assertIn(message, str(cm.exception))
+            self.assertEqual(cm.exception.lineno, lineno)
+
+    def test_read_entries_with_fields_uses_cache(self):
+        self.make_entries_old()
+        self.app.main(["keywords"])
+        entries = self.app.read_entries(fields={"keywords"})
+        self.assertIsNone(entries[1].plot_summary)
+
+        # Entries cached without their longform fields are not used when those fields
+        # are needed.
+        entries = self.app.read_entries()
+        self.assertTrue(entries[1].plot_summary.startswith("In the aftermath"))
+
     def test_parse_longform_field(self):
         text = "  Paragraph one\n\n  Paragraph two\n\nfoo: bar"
         lines = list(enumerate(text.splitlines(), start=1))
@@ -225,6 +1356,12 @@ class OeuvreTests(unittest.TestCase):
         self.assertEqual(stream.getvalue(), expected)
         self.assertEqual(other_stream.getvalue(), "")
 
+    def make_entries_old(self):
+        # Files modified very recently are never cached, so backdate the test entries.
+        for name in os.listdir(self.app.directory):
+            path = os.path.join(self.app.directory, name)
+            os.utime(path, (1000000000, 1000000000))
+
     def reset_io(self):
         self.app.stdin = None
         self.app.stdout = FakeStdout()
@@ -239,18 +1376,18 @@ class FakeStdout(StringIO):
     # Make sure we are using the real stdout and not the one that we patched.
     original_stdout = sys.stdout
 
-    def fileno(self):
-        # oeuvre calls sys.stdout.fileno() to check if standard output is a terminal or
+    def isatty(self):
+        # oeuvre calls sys.stdout.isatty() to check if standard output is a terminal or
         # not (and thus whether it should use colored output), so we have to define this
         # method on the StringIO class we are using to patch sys.stdout.
-        return self.original_stdout.fileno()
+        return self.original_stdout.isatty()
 
 
 class FakeStderr(StringIO):
     original_stderr = sys.stderr
 
-    def fileno(self):
-        return self.original_stderr.fileno()
+    def isatty(self):
+        return self.original_stderr.isatty()
 
 
 class FakeEditor: